@@ -1,6 +1,5 @@
 import os
 import csv
-import xml.etree.ElementTree as ET
 import requests
 import matplotlib.pyplot as plt
 from matplotlib.patches import PathPatch
@@ -11,25 +10,16 @@ from datetime import date, datetime
 import numpy as np
 from shapely.geometry import Polygon, MultiPolygon, Point
 
+from services.vector_stream import iterar_kml
+
 # -----------------------------
 # Leer polígonos del KML (con huecos)
 # -----------------------------
 def parse_kml_polygons(kml_file):
-    tree = ET.parse(kml_file)
-    root = tree.getroot()
-    ns = {'kml': 'http://www.opengis.net/kml/2.2'}
+    # Lectura incremental: no carga el documento completo en memoria
     polygons = []
-    for placemark in root.findall(".//kml:Placemark", ns):
-        for polygon in placemark.findall(".//kml:Polygon", ns):
-            rings = []
-            for ring_tag in ["outerBoundaryIs", "innerBoundaryIs"]:
-                for ring in polygon.findall(f".//kml:{ring_tag}/kml:LinearRing/kml:coordinates", ns):
-                    coords = []
-                    for c in ring.text.strip().split():
-                        lon, lat, *_ = map(float, c.split(","))
-                        coords.append((lon, lat))
-                    rings.append(coords)
-            polygons.append(rings)
+    for feature in iterar_kml(kml_file):
+        polygons.append([[tuple(c) for c in ring.tolist()] for ring in feature["anillos"]])
     return polygons
 
 # -----------------------------
@@ -186,6 +176,10 @@ def polygons_to_shapely(polygons):
     return MultiPolygon(geoms)
 
 def calcular_porcentaje_pixeles(parcela_polygons, capa_img, bbox, umbral=250):
+    return calcular_porcentajes_umbrales(parcela_polygons, capa_img, bbox, [umbral])[umbral]
+
+def calcular_porcentajes_umbrales(parcela_polygons, capa_img, bbox, umbrales):
+    """Porcentaje afectado para varios umbrales con una sola máscara e histograma"""
     parcela_geom = polygons_to_shapely(parcela_polygons)
 
     width, height = capa_img.size
@@ -200,12 +194,16 @@ def calcular_porcentaje_pixeles(parcela_polygons, capa_img, bbox, umbral=250):
 
     arr = np.array(capa_img.convert("L"))
     arr_masked = arr[mask]
-
-    afectados = np.sum(arr_masked < umbral)
     total = arr_masked.size
 
-    porcentaje = (afectados / total) * 100 if total > 0 else 0
-    return porcentaje
+    # acumulado[u] = píxeles con luminancia < u
+    acumulado = np.concatenate(([0], np.cumsum(np.bincount(arr_masked, minlength=256))))
+
+    porcentajes = {}
+    for u in umbrales:
+        afectados = acumulado[min(max(int(u), 0), 256)]
+        porcentajes[u] = (afectados / total) * 100 if total > 0 else 0
+    return porcentajes
 
 # -----------------------------
 # Ejecución principal (batch desde carpeta KMLs)
@@ -257,8 +255,9 @@ if __name__ == "__main__":
 
                 # Calcular porcentajes por píxel
                 capa_img = download_wms_image(base_url, layer, style, bbox, format="image/png")
+                porcentajes = calcular_porcentajes_umbrales(polygons, capa_img, bbox, umbrales)
                 for u in umbrales:
-                    porcentaje = calcular_porcentaje_pixeles(polygons, capa_img, bbox, umbral=u)
+                    porcentaje = porcentajes[u]
                     resultados.append(f"{capa} (umbral {u}): {porcentaje:.2f}%")
             except Exception as e:
                 resultados.append(f"{capa}: Error en cálculo ({e})")
@@ -8,15 +8,24 @@ from fastapi.responses import HTMLResponse
 from pathlib import Path
 
 from config import settings
-from database import Base, engine
+from database import asegurar_esquema, async_engine
 from routers import auth, subscriptions, catastro, analysis
+from auth.utils import cerrar_ejecutor_hash
+from services import layer_registry, usage_stats
 
 
 # ============================
 #   Inicializar Base de Datos
 # ============================
-# Crear todas las tablas declaradas en los modelos
-Base.metadata.create_all(bind=engine)
+# Crear las tablas declaradas en los modelos y completar las existentes
+asegurar_esquema()
+# Contadores de uso: se calculan del historial sólo la primera vez
+usage_stats.inicializar()
+# Análisis que quedaron en cola o en curso en un proceso anterior
+analysis.recuperar_trabajos()
+
+# Registro de capas: se carga una vez y se recarga si cambia el archivo
+layer_registry.configurar(settings.CAPAS_REGISTRO)
 
 
 # ============================
@@ -42,6 +51,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],  # Paginación del historial de consultas
 )
 
 
@@ -92,6 +102,18 @@ async def root():
     """
 
 
+# ============================
+#   Apagado
+# ============================
+@app.on_event("shutdown")
+async def shutdown():
+    # Detener los procesos del ejecutor de análisis
+    analysis.cerrar_ejecutor()
+    cerrar_ejecutor_hash()
+    # Cerrar las conexiones del pool asíncrono
+    await async_engine.dispose()
+
+
 # ============================
 #   Health Check
 # ============================
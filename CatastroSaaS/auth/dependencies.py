@@ -3,20 +3,26 @@ Dependencias de autenticación para FastAPI
 """
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
-from database import get_db
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload
+from typing import Optional
+from database import get_async_db
 from auth.jwt import verify_token
 import models
 
 # OAuth2 scheme
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="api/auth/login")
 
+# Para flujos SSE: EventSource no envía cabeceras, el token puede ir en ?token=
+oauth2_scheme_optional = OAuth2PasswordBearer(tokenUrl="api/auth/login", auto_error=False)
 
-async def get_current_user(
-    token: str = Depends(oauth2_scheme),
-    db: Session = Depends(get_db)
-) -> models.User:
-    """Obtener usuario actual desde token"""
+
+async def user_from_token(db: AsyncSession, token: Optional[str]) -> models.User:
+    """
+    Usuario del token JWT (401 si no es válido), con su suscripción
+    cargada en la misma consulta.
+    """
     
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -24,12 +30,16 @@ async def get_current_user(
         headers={"WWW-Authenticate": "Bearer"},
     )
     
-    email = verify_token(token)
+    email = verify_token(token) if token else None
     
     if email is None:
         raise credentials_exception
     
-    user = db.query(models.User).filter(models.User.email == email).first()
+    user = (await db.execute(
+        select(models.User)
+        .options(joinedload(models.User.subscription))
+        .where(models.User.email == email)
+    )).scalars().first()
     
     if user is None:
         raise credentials_exception
@@ -37,6 +47,22 @@ async def get_current_user(
     return user
 
 
+async def get_current_user(
+    token: str = Depends(oauth2_scheme),
+    db: AsyncSession = Depends(get_async_db)
+) -> models.User:
+    """
+    Obtener usuario actual desde token.
+    
+    FastAPI resuelve get_async_db una sola vez por petición, así que el usuario
+    (y su suscripción) queda en la sesión que reciben el resto de
+    dependencias y el endpoint: `current_user.subscription` no vuelve a
+    consultar la base de datos.
+    """
+    
+    return await user_from_token(db, token)
+
+
 async def get_current_active_user(
     current_user: models.User = Depends(get_current_user)
 ) -> models.User:
@@ -49,14 +75,11 @@ async def get_current_active_user(
 
 
 async def check_subscription_active(
-    current_user: models.User = Depends(get_current_active_user),
-    db: Session = Depends(get_db)
+    current_user: models.User = Depends(get_current_active_user)
 ) -> models.User:
     """Verificar que el usuario tenga suscripción activa"""
     
-    subscription = db.query(models.Subscription).filter(
-        models.Subscription.user_id == current_user.id
-    ).first()
+    subscription = current_user.subscription
     
     if not subscription:
         raise HTTPException(
@@ -73,20 +96,57 @@ async def check_subscription_active(
     return current_user
 
 
+def _query_limit_exception(queries_limit: int) -> HTTPException:
+    return HTTPException(
+        status_code=403,
+        detail=f"Query limit reached ({queries_limit}). Please upgrade your plan."
+    )
+
+
 async def check_query_limit(
-    current_user: models.User = Depends(check_subscription_active),
-    db: Session = Depends(get_db)
+    current_user: models.User = Depends(check_subscription_active)
 ) -> models.User:
-    """Verificar que el usuario no haya excedido su límite de consultas"""
+    """
+    Verificar que el usuario no haya excedido su límite de consultas.
+    
+    Es sólo una comprobación previa con la suscripción ya cargada; la
+    cuota se consume de forma atómica con consume_query_quota.
+    """
     
-    subscription = db.query(models.Subscription).filter(
-        models.Subscription.user_id == current_user.id
-    ).first()
+    subscription = current_user.subscription
     
     if subscription.queries_used >= subscription.queries_limit:
-        raise HTTPException(
-            status_code=403,
-            detail=f"Query limit reached ({subscription.queries_limit}). Please upgrade your plan."
-        )
+        raise _query_limit_exception(subscription.queries_limit)
     
     return current_user
+
+
+async def consume_query_quota(db: AsyncSession, user: models.User) -> models.PlanType:
+    """
+    Consume una consulta de la cuota con un único UPDATE condicional
+    (queries_used < queries_limit) y devuelve el plan. Si la cuota está
+    agotada, 403: las peticiones concurrentes no pueden superar el límite
+    porque la comprobación y el incremento son la misma sentencia.
+    
+    No hace commit: la consulta se confirma en la misma transacción.
+    """
+    
+    Subscription = models.Subscription
+    plan_type = (await db.execute(
+        update(Subscription)
+        .where(
+            Subscription.user_id == user.id,
+            Subscription.status == models.SubscriptionStatus.ACTIVE,
+            Subscription.queries_used < Subscription.queries_limit,
+        )
+        .values(queries_used=Subscription.queries_used + 1)
+        .returning(Subscription.plan_type)
+        .execution_options(synchronize_session=False)
+    )).scalar_one_or_none()
+    
+    if plan_type is None:
+        queries_limit = user.subscription.queries_limit
+        await db.rollback()
+        raise _query_limit_exception(queries_limit)
+    
+    return plan_type
@@ -1,10 +1,30 @@
 """
 Utilidades de autenticación
 """
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
 from passlib.context import CryptContext
 
-# Contexto para hashing de contraseñas
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+from config import settings
+
+# Contexto para hashing de contraseñas. Los hashes con un coste distinto
+# de BCRYPT_ROUNDS se marcan para actualizar y se rehacen en el login.
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__rounds=settings.BCRYPT_ROUNDS
+)
+
+# Hilos dedicados al hashing (bcrypt libera el GIL): cada hash cuesta
+# ~100-300 ms de CPU y no debe bloquear el event loop ni ocupar el
+# threadpool por defecto de la API. Las peticiones que superan
+# PASSWORD_HASH_WORKERS esperan turno en la cola del ejecutor.
+_ejecutor_hash = ThreadPoolExecutor(
+    max_workers=settings.PASSWORD_HASH_WORKERS,
+    thread_name_prefix="password-hash"
+)
 
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
@@ -15,3 +35,35 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
 def get_password_hash(password: str) -> str:
     """Hashear contraseña"""
     return pwd_context.hash(password)
+
+
+async def _en_ejecutor_hash(funcion, *args):
+    return await asyncio.get_running_loop().run_in_executor(_ejecutor_hash, funcion, *args)
+
+
+async def hash_password(password: str) -> str:
+    """Hashear contraseña sin bloquear el event loop"""
+    return await _en_ejecutor_hash(pwd_context.hash, password)
+
+
+async def verify_and_update_password(
+    plain_password: str, hashed_password: Optional[str]
+) -> Tuple[bool, Optional[str]]:
+    """
+    Verificar contraseña sin bloquear el event loop. Devuelve (válida,
+    nuevo_hash): nuevo_hash no es None si el hash guardado usa otro coste
+    y hay que sustituirlo.
+    
+    Sin hash (usuario inexistente) se hace una verificación ficticia del
+    mismo coste, para que el tiempo de respuesta no revele qué emails
+    están registrados.
+    """
+    if hashed_password is None:
+        await _en_ejecutor_hash(pwd_context.dummy_verify)
+        return False, None
+    return await _en_ejecutor_hash(pwd_context.verify_and_update, plain_password, hashed_password)
+
+
+def cerrar_ejecutor_hash():
+    """Detiene los hilos de hashing al apagar la aplicación"""
+    _ejecutor_hash.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,62 @@
+"""
+Carga mixta sobre los endpoints de consultas catastrales.
+
+Cada cliente alterna GET /api/catastro/queries?limit=20 y
+GET /api/catastro/stats y, con --mezcla mixta, una de cada cuatro
+peticiones es un POST /api/catastro/query (consumo de cuota, encolado del
+trabajo y contadores de uso) con una referencia distinta cada vez. Los
+trabajos se quedan en cola: sin worker.py sólo se mide la API.
+
+Con --usuarios 1 todos los POST consumen la cuota de la misma
+suscripción y esperan a su bloqueo de fila; con tantos usuarios como
+clientes cada cliente usa el suyo (el caso habitual en producción).
+
+Mide el rendimiento y las latencias por endpoint y, en paralelo, /health
+para ver si las peticiones bloquean el event loop.
+
+Uso:
+    python benchmarks/carga_api.py --database-url postgresql://... --mezcla mixta
+"""
+from comun import SondaHealth, Servidor, cargar, crear_usuario, describir, parser_base, preparar_entorno
+
+
+def main():
+    parser = parser_base(__doc__.strip().splitlines()[0])
+    parser.add_argument("--mezcla", choices=["lectura", "mixta"], default="mixta")
+    parser.add_argument("--historial", type=int, default=50,
+                        help="Consultas previas de cada usuario de prueba")
+    parser.add_argument("--usuarios", type=int, default=1,
+                        help="Usuarios de prueba; los clientes se reparten entre ellos")
+    args = parser.parse_args()
+
+    trabajo = preparar_entorno(args)
+    usuarios = [crear_usuario(historial=args.historial)[1] for _ in range(args.usuarios)]
+    ejecucion = trabajo.name[-6:]
+
+    def peticion(cliente, url, hilo, n):
+        cabeceras = usuarios[hilo % len(usuarios)]
+        if args.mezcla == "mixta" and n % 4 == 3:
+            referencia = f"{ejecucion}{hilo:03d}{n:06d}".upper()
+            r = cliente.post(url + "/api/catastro/query",
+                             json={"referencia_catastral": referencia}, headers=cabeceras)
+            return "POST /query", r.status_code == 200
+        if n % 2:
+            r = cliente.get(url + "/api/catastro/stats", headers=cabeceras)
+            return "GET /stats", r.status_code == 200
+        r = cliente.get(url + "/api/catastro/queries?limit=20", headers=cabeceras)
+        return "GET /queries", r.status_code == 200
+
+    print(f"# carga_api mezcla={args.mezcla} usuarios={args.usuarios} {describir(args)}")
+    with Servidor(args, trabajo) as servidor:
+        for clientes in args.clientes:
+            with SondaHealth(servidor.url) as sonda:
+                resultados, segundos = cargar(servidor.url, clientes, args.duracion, peticion)
+            total = sum(len(r.valores) for r in resultados.values())
+            print(f"clientes={clientes}: {total / segundos:.1f} peticiones/s")
+            for tipo, latencias in sorted(resultados.items()):
+                print(f"  {tipo}: {latencias.resumen(segundos)}")
+            print(f"  /health: {sonda.latencias.resumen()}")
+
+
+if __name__ == "__main__":
+    main()
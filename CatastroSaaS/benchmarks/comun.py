@@ -0,0 +1,280 @@
+"""
+Utilidades comunes de los benchmarks de carga.
+
+Cada benchmark arranca la API con uvicorn en un subproceso (sobre el
+árbol de --app-dir, para poder comparar con otra versión del código),
+crea sus datos de prueba con los modelos de ese mismo árbol y lanza
+clientes HTTP concurrentes, uno por hilo.
+
+La base de datos es la de --database-url (o DATABASE_URL); sin ella se
+usa un SQLite temporal. En PostgreSQL conviene una base de datos vacía
+dedicada: el esquema se crea al arrancar y los usuarios de prueba llevan
+un email único por ejecución.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from pathlib import Path
+
+import httpx
+
+APP_DIR = Path(__file__).resolve().parent.parent
+
+# Valores de prueba para los ajustes obligatorios que no estén definidos
+AJUSTES_PRUEBA = {
+    "SECRET_KEY": "benchmark",
+    "ALGORITHM": "HS256",
+    "ACCESS_TOKEN_EXPIRE_MINUTES": "60",
+    "STRIPE_SECRET_KEY": "sk_test_benchmark",
+    "STRIPE_PUBLISHABLE_KEY": "pk_test_benchmark",
+    "STRIPE_WEBHOOK_SECRET": "whsec_benchmark",
+    "APP_NAME": "Catastro SaaS (benchmark)",
+    "APP_URL": "http://127.0.0.1",
+    "FRONTEND_URL": "http://127.0.0.1",
+    "AEMET_API_KEY": "benchmark",
+    "PLAN_FREE_QUERIES": "3",
+    "PLAN_PRO_QUERIES": "100",
+    "PLAN_PRO_PRICE": "29.99",
+    "PLAN_ENTERPRISE_PRICE": "149.99",
+}
+
+TIMEOUT_HTTP = 10
+
+
+def parser_base(descripcion):
+    """Argumentos comunes a todos los benchmarks"""
+    parser = argparse.ArgumentParser(description=descripcion)
+    parser.add_argument("--app-dir", default=str(APP_DIR),
+                        help="Carpeta de la aplicación (otra versión para comparar)")
+    parser.add_argument("--database-url", default=None,
+                        help="Base de datos (por defecto DATABASE_URL o un SQLite temporal)")
+    parser.add_argument("--puerto", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=1, help="Workers de uvicorn")
+    parser.add_argument("--clientes", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--duracion", type=float, default=10, help="Segundos por medición")
+    return parser
+
+
+def preparar_entorno(args):
+    """
+    Configura el entorno (también el del servidor) e importa el árbol de
+    --app-dir. Devuelve la carpeta de trabajo temporal, donde el servidor
+    crea sus carpetas (static, job_events...).
+    """
+    app_dir = Path(args.app_dir).resolve()
+    trabajo = Path(tempfile.mkdtemp(prefix="catastro-bench-"))
+
+    # El .env de la aplicación, si existe, sin pisar el entorno
+    env_file = app_dir / ".env"
+    if env_file.exists():
+        from dotenv import dotenv_values
+        for clave, valor in dotenv_values(env_file).items():
+            if valor is not None:
+                os.environ.setdefault(clave, valor)
+    for clave, valor in AJUSTES_PRUEBA.items():
+        os.environ.setdefault(clave, valor)
+
+    if args.database_url:
+        os.environ["DATABASE_URL"] = args.database_url
+    elif "DATABASE_URL" not in os.environ:
+        os.environ["DATABASE_URL"] = f"sqlite:///{trabajo / 'benchmark.db'}"
+
+    os.environ["PYTHONPATH"] = str(app_dir)
+    sys.path.insert(0, str(app_dir))
+    os.chdir(trabajo)
+
+    import database
+    import models
+    if hasattr(database, "asegurar_esquema"):
+        database.asegurar_esquema()
+    else:
+        models.Base.metadata.create_all(bind=database.engine)
+    return trabajo
+
+
+def crear_usuario(limite=10**6, historial=0, password=None):
+    """
+    Crea un usuario con suscripción activa (límite de consultas `limite`)
+    y `historial` consultas previas. Devuelve (email, cabeceras con token).
+    """
+    import database
+    import models
+    from auth.jwt import create_access_token
+
+    email = f"bench-{uuid.uuid4().hex[:12]}@example.com"
+    if password:
+        from auth.utils import get_password_hash
+        hashed_password = get_password_hash(password)
+    else:
+        hashed_password = "!"
+
+    db = database.SessionLocal()
+    try:
+        user = models.User(email=email, hashed_password=hashed_password)
+        db.add(user)
+        db.flush()
+        db.add(models.Subscription(
+            user_id=user.id,
+            plan_type=models.PlanType.FREE,
+            status=models.SubscriptionStatus.ACTIVE,
+            queries_limit=limite,
+            queries_used=0
+        ))
+        for i in range(historial):
+            db.add(models.Query(user_id=user.id, referencia_catastral=f"BENCH{i:06d}"))
+        db.commit()
+    finally:
+        db.close()
+
+    token = create_access_token({"sub": email})
+    return email, {"Authorization": f"Bearer {token}"}
+
+
+class Servidor:
+    """La API en un subproceso uvicorn; se detiene al salir del bloque"""
+
+    def __init__(self, args, trabajo):
+        self.args = args
+        self.trabajo = trabajo
+        self.url = f"http://127.0.0.1:{args.puerto}"
+        self.proceso = None
+
+    def __enter__(self):
+        self.proceso = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "app:app",
+             "--app-dir", str(Path(self.args.app_dir).resolve()),
+             "--port", str(self.args.puerto),
+             "--workers", str(self.args.workers),
+             "--log-level", "warning"],
+            cwd=self.trabajo, env=os.environ.copy()
+        )
+        limite = time.monotonic() + 60
+        while time.monotonic() < limite:
+            if self.proceso.poll() is not None:
+                raise RuntimeError("El servidor no ha arrancado")
+            try:
+                if httpx.get(self.url + "/health", timeout=1).status_code == 200:
+                    time.sleep(1)
+                    return self
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.3)
+        self.__exit__()
+        raise RuntimeError("El servidor no responde en /health")
+
+    def __exit__(self, *_):
+        if self.proceso and self.proceso.poll() is None:
+            self.proceso.terminate()
+            try:
+                self.proceso.wait(10)
+            except subprocess.TimeoutExpired:
+                self.proceso.kill()
+                self.proceso.wait()
+
+
+class Latencias:
+    """Latencias de un tipo de petición (seguro entre hilos)"""
+
+    def __init__(self):
+        self.valores = []
+        self.errores = 0
+        self._lock = threading.Lock()
+
+    def anotar(self, segundos, correcta=True):
+        with self._lock:
+            self.valores.append(segundos)
+            if not correcta:
+                self.errores += 1
+
+    def percentil(self, p):
+        valores = sorted(self.valores)
+        if not valores:
+            return 0.0
+        return valores[min(len(valores) - 1, int(len(valores) * p))]
+
+    def resumen(self, duracion=None):
+        texto = f"{len(self.valores)} peticiones, {self.errores} errores"
+        if duracion:
+            texto += f", {len(self.valores) / duracion:.1f}/s"
+        return texto + (
+            f", p50 {self.percentil(0.5) * 1000:.0f} ms"
+            f", p95 {self.percentil(0.95) * 1000:.0f} ms"
+            f", p99 {self.percentil(0.99) * 1000:.0f} ms"
+        )
+
+
+def cargar(url, clientes, duracion, peticion, parar=None):
+    """
+    Lanza `clientes` hilos que repiten peticion(cliente, url, hilo, n)
+    durante `duracion` segundos (o hasta que se active el evento `parar`).
+    peticion devuelve (tipo, correcta); las latencias se agrupan por tipo.
+    Devuelve ({tipo: Latencias}, segundos).
+    """
+    resultados = {}
+    lock = threading.Lock()
+    barrera = threading.Barrier(clientes)
+
+    def hilo(indice):
+        with httpx.Client(timeout=TIMEOUT_HTTP) as cliente:
+            barrera.wait()
+            fin = time.perf_counter() + duracion
+            n = 0
+            while time.perf_counter() < fin and not (parar and parar.is_set()):
+                inicio = time.perf_counter()
+                try:
+                    tipo, correcta = peticion(cliente, url, indice, n)
+                except httpx.HTTPError:
+                    tipo, correcta = "error de conexión", False
+                with lock:
+                    latencias = resultados.setdefault(tipo, Latencias())
+                latencias.anotar(time.perf_counter() - inicio, correcta)
+                n += 1
+
+    hilos = [threading.Thread(target=hilo, args=(i,)) for i in range(clientes)]
+    inicio = time.perf_counter()
+    for h in hilos:
+        h.start()
+    for h in hilos:
+        h.join()
+    return resultados, time.perf_counter() - inicio
+
+
+class SondaHealth:
+    """Mide /health cada 50 ms mientras dura el bloque (latencia del event loop)"""
+
+    def __init__(self, url):
+        self.url = url
+        self.latencias = Latencias()
+        self._parar = threading.Event()
+        self._hilo = threading.Thread(target=self._medir)
+
+    def _medir(self):
+        with httpx.Client(timeout=TIMEOUT_HTTP) as cliente:
+            while not self._parar.is_set():
+                inicio = time.perf_counter()
+                try:
+                    correcta = cliente.get(self.url + "/health").status_code == 200
+                except httpx.HTTPError:
+                    correcta = False
+                self.latencias.anotar(time.perf_counter() - inicio, correcta)
+                self._parar.wait(0.05)
+
+    def __enter__(self):
+        self._hilo.start()
+        return self
+
+    def __exit__(self, *_):
+        self._parar.set()
+        self._hilo.join()
+
+
+def describir(args):
+    """Cabecera de los resultados: árbol, base de datos y workers"""
+    url = os.environ["DATABASE_URL"]
+    motor = url.split(":", 1)[0]
+    return f"app-dir={args.app_dir} db={motor} workers={args.workers}"
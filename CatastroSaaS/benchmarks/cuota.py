@@ -0,0 +1,64 @@
+"""
+Carrera por la cuota de consultas.
+
+Un usuario con --limite consultas recibe POST /api/catastro/query desde
+todos los clientes a la vez hasta que la API responde 403 a todos. Con un
+consumo atómico de la cuota las consultas aceptadas nunca superan el
+límite, sea cual sea la concurrencia.
+
+Uso:
+    python benchmarks/cuota.py --database-url postgresql://... --workers 4 --limite 50
+"""
+import threading
+
+from comun import Servidor, cargar, crear_usuario, describir, parser_base, preparar_entorno
+
+
+def main():
+    parser = parser_base(__doc__.strip().splitlines()[0])
+    parser.add_argument("--limite", type=int, default=50)
+    parser.set_defaults(clientes=[32], duracion=5)
+    args = parser.parse_args()
+
+    trabajo = preparar_entorno(args)
+    ejecucion = trabajo.name[-6:]
+
+    import database
+    import models
+
+    print(f"# cuota limite={args.limite} {describir(args)}")
+    with Servidor(args, trabajo) as servidor:
+        for clientes in args.clientes:
+            email, cabeceras = crear_usuario(limite=args.limite)
+            agotada = threading.Event()
+
+            def peticion(cliente, url, hilo, n):
+                referencia = f"{ejecucion}{hilo:03d}{n:06d}".upper()
+                r = cliente.post(url + "/api/catastro/query",
+                                 json={"referencia_catastral": referencia}, headers=cabeceras)
+                if r.status_code == 403:
+                    agotada.set()
+                    return "403", True
+                return ("aceptada", True) if r.status_code == 200 else (f"HTTP {r.status_code}", False)
+
+            resultados, _ = cargar(servidor.url, clientes, args.duracion, peticion, parar=agotada)
+
+            db = database.SessionLocal()
+            try:
+                user = db.query(models.User).filter(models.User.email == email).one()
+                consultas = db.query(models.Query).filter(models.Query.user_id == user.id).count()
+                usadas = user.subscription.queries_used
+            finally:
+                db.close()
+
+            aceptadas = len(resultados["aceptada"].valores) if "aceptada" in resultados else 0
+            veredicto = "OK" if consultas <= args.limite else "LÍMITE SUPERADO"
+            print(f"clientes={clientes}: {aceptadas} aceptadas, {consultas} consultas guardadas, "
+                  f"queries_used={usadas}, límite {args.limite} -> {veredicto}")
+            for tipo, latencias in sorted(resultados.items()):
+                if tipo not in ("aceptada", "403"):
+                    print(f"  {tipo}: {latencias.resumen()}")
+
+
+if __name__ == "__main__":
+    main()
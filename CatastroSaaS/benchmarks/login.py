@@ -0,0 +1,48 @@
+"""
+Ráfaga de logins.
+
+Los clientes repiten POST /api/auth/login con la contraseña correcta
+(y, con --desconocidos, una fracción con emails no registrados) mientras
+se mide /health: el hash de bcrypt cuesta cientos de milisegundos de CPU
+y no debe bloquear el event loop para el resto de peticiones.
+
+Uso:
+    python benchmarks/login.py --database-url postgresql://... --clientes 1 8
+"""
+from comun import SondaHealth, Servidor, cargar, crear_usuario, describir, parser_base, preparar_entorno
+
+PASSWORD = "benchmark-password"
+
+
+def main():
+    parser = parser_base(__doc__.strip().splitlines()[0])
+    parser.add_argument("--desconocidos", type=float, default=0,
+                        help="Fracción de logins con emails no registrados (0-1)")
+    parser.set_defaults(clientes=[1, 8], duracion=8)
+    args = parser.parse_args()
+
+    trabajo = preparar_entorno(args)
+    email, _ = crear_usuario(password=PASSWORD)
+    cada = round(1 / args.desconocidos) if args.desconocidos else 0
+
+    def peticion(cliente, url, hilo, n):
+        if cada and n % cada == 0:
+            r = cliente.post(url + "/api/auth/login",
+                             data={"username": "nadie@example.com", "password": PASSWORD})
+            return "login (email desconocido)", r.status_code == 401
+        r = cliente.post(url + "/api/auth/login", data={"username": email, "password": PASSWORD})
+        return "login", r.status_code == 200
+
+    print(f"# login desconocidos={args.desconocidos} {describir(args)}")
+    with Servidor(args, trabajo) as servidor:
+        for clientes in args.clientes:
+            with SondaHealth(servidor.url) as sonda:
+                resultados, segundos = cargar(servidor.url, clientes, args.duracion, peticion)
+            print(f"clientes={clientes}:")
+            for tipo, latencias in sorted(resultados.items()):
+                print(f"  {tipo}: {latencias.resumen(segundos)}")
+            print(f"  /health: {sonda.latencias.resumen()}")
+
+
+if __name__ == "__main__":
+    main()
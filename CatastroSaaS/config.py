@@ -3,12 +3,22 @@ from pydantic_settings import BaseSettings, SettingsConfigDict
 class Settings(BaseSettings):
     # Database
     DATABASE_URL: str
+    # Pool del engine asíncrono de la API (por proceso)
+    DB_POOL_SIZE: int = 10
+    DB_MAX_OVERFLOW: int = 20
+    DB_POOL_TIMEOUT: int = 30            # Segundos esperando una conexión libre
+    DB_POOL_RECYCLE: int = 1800          # Segundos antes de renovar una conexión
 
     # JWT
     SECRET_KEY: str
     ALGORITHM: str
     ACCESS_TOKEN_EXPIRE_MINUTES: int
 
+    # Contraseñas: coste de bcrypt (los hashes con otro coste se rehacen al
+    # hacer login) e hilos dedicados al hashing por proceso
+    BCRYPT_ROUNDS: int = 12
+    PASSWORD_HASH_WORKERS: int = 4
+
     # Stripe
     STRIPE_SECRET_KEY: str
     STRIPE_PUBLISHABLE_KEY: str
@@ -36,6 +46,32 @@ class Settings(BaseSettings):
     PLAN_PRO_PRICE: float
     PLAN_ENTERPRISE_PRICE: float
 
+    # Análisis ambiental: carpeta con leyenda_<capa>.csv (desglose por clases)
+    LEYENDAS_DIR: str | None = None
+    # Carpeta base de las capas raster locales (backend 'local')
+    CAPAS_DIR: str | None = None
+    # Registro JSON de capas WMS/locales (por defecto services/capas.json)
+    CAPAS_REGISTRO: str | None = None
+    # Procesos dedicados a ejecutar análisis (independientes de los workers de la API)
+    ANALYSIS_WORKERS: int = 2
+    # Carpeta privada de los trabajos de análisis (fuera de static): los
+    # archivos se descargan por la API, con autenticación
+    ANALYSIS_DIR: str = "analysis_jobs"
+    # Segundos tras los que un análisis en cola o en curso se da por perdido
+    ANALYSIS_JOB_TIMEOUT: int = 3600
+
+    # Cola de trabajos (worker.py)
+    WORKER_CONCURRENCY: int = 2          # Trabajos simultáneos por proceso worker
+    WORKER_POLL_INTERVAL: float = 2.0    # Segundos de espera con la cola vacía
+    JOB_VISIBILITY_TIMEOUT: int = 600    # Segundos antes de que otro worker pueda reclamarlo
+    JOB_MAX_ATTEMPTS: int = 3
+    JOB_RETRY_BACKOFF: int = 30          # Espera base (exponencial) entre reintentos
+    # Horas durante las que se reutiliza el resultado de una referencia ya procesada
+    CATASTRO_FRESHNESS_HOURS: int = 24
+    # Eventos de progreso de los trabajos (carpeta compartida por API y workers)
+    JOB_EVENTS_DIR: str = "job_events"
+    JOB_EVENTS_RETENTION_DAYS: int = 7
+
     model_config = SettingsConfigDict(env_file=".env", extra="ignore")
 
 
@@ -1,7 +1,8 @@
 """
 Configuración de la base de datos
 """
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import declarative_base, sessionmaker
 from config import settings
 
@@ -11,7 +12,11 @@ DATABASE_URL = settings.DATABASE_URL.replace(
     "postgresql+psycopg://"
 )
 
-# Crear engine
+# psycopg tiene modo síncrono y asíncrono con la misma URL; SQLite
+# necesita aiosqlite para el engine asíncrono
+ASYNC_DATABASE_URL = DATABASE_URL.replace("sqlite://", "sqlite+aiosqlite://")
+
+# Engine síncrono: worker.py y creación del esquema
 engine = create_engine(
     DATABASE_URL,
     pool_pre_ping=True,
@@ -21,6 +26,25 @@ engine = create_engine(
 # Session local
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Engine asíncrono de la API: las consultas de los routers no bloquean el
+# event loop. El pool es por proceso: pool_size + max_overflow conexiones
+# como máximo por cada worker de uvicorn.
+async_engine = create_async_engine(
+    ASYNC_DATABASE_URL,
+    pool_size=settings.DB_POOL_SIZE,
+    max_overflow=settings.DB_MAX_OVERFLOW,
+    pool_timeout=settings.DB_POOL_TIMEOUT,
+    pool_recycle=settings.DB_POOL_RECYCLE,
+    pool_pre_ping=True,
+    echo=False
+)
+
+# Sin expirar al confirmar: tras el commit los objetos se siguen leyendo
+# sin volver a la base de datos (la carga perezosa no existe en asyncio)
+AsyncSessionLocal = async_sessionmaker(
+    async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False
+)
+
 # Base para modelos
 Base = declarative_base()
 
@@ -31,4 +55,33 @@ def get_db():
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+
+async def get_async_db():
+    """Dependency para obtener sesión asíncrona de BD (routers de la API)"""
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+def asegurar_esquema():
+    """
+    Crea las tablas que falten y completa las existentes (sin migraciones):
+    añade las columnas nuevas que admiten NULL y los índices declarados
+    que aún no existen. Es idempotente; se llama al arrancar.
+    """
+    Base.metadata.create_all(bind=engine)
+
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for tabla in Base.metadata.sorted_tables:
+            existentes = {c["name"] for c in inspector.get_columns(tabla.name)}
+            for columna in tabla.columns:
+                if columna.name in existentes or not columna.nullable:
+                    continue
+                tipo = columna.type.compile(dialect=engine.dialect)
+                conn.execute(text(f'ALTER TABLE {tabla.name} ADD COLUMN {columna.name} {tipo}'))
+                print(f"✓ Columna añadida: {tabla.name}.{columna.name}")
+
+            for indice in tabla.indexes:
+                indice.create(bind=conn, checkfirst=True)
@@ -1,7 +1,7 @@
 """
 Modelos de base de datos
 """
-from sqlalchemy import Boolean, Column, Integer, String, Float, DateTime, ForeignKey, Enum as SQLEnum
+from sqlalchemy import Boolean, Column, Integer, String, Float, Text, JSON, DateTime, ForeignKey, Index, Enum as SQLEnum, text
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from database import Base
@@ -28,6 +28,14 @@ class SubscriptionStatus(str, enum.Enum):
     PAST_DUE = "past_due"
 
 
+class JobStatus(str, enum.Enum):
+    """Estados de un trabajo de la cola"""
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+
 class User(Base):
     """Modelo de Usuario"""
     __tablename__ = "users"
@@ -58,7 +66,7 @@ class Subscription(Base):
     
     # Stripe
     stripe_customer_id = Column(String)
-    stripe_subscription_id = Column(String)
+    stripe_subscription_id = Column(String, index=True)  # Búsqueda desde el webhook
     stripe_price_id = Column(String)
     
     # Límites
@@ -90,11 +98,21 @@ class Query(Base):
     has_socioeconomic_data = Column(Boolean, default=False)
     has_pdf = Column(Boolean, default=False)
     
+    # Trabajo que genera (o generó) los resultados; varias consultas de la
+    # misma referencia pueden compartirlo
+    job_id = Column(String, ForeignKey("jobs.id"), nullable=True, index=True)
+    
     # Metadata
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     
     # Relaciones
     user = relationship("User", back_populates="queries")
+    
+    __table_args__ = (
+        # Historial por usuario (GET /api/catastro/queries): filtro, orden y
+        # cursor salen del índice, sin recorrer ni ordenar el resto
+        Index("ix_queries_user_created", "user_id", "created_at", "id"),
+    )
 
 
 class Payment(Base):
@@ -119,3 +137,73 @@ class Payment(Base):
     
     # Relaciones
     user = relationship("User", back_populates="payments")
+
+
+class UsageStats(Base):
+    """
+    Contadores de uso por usuario (services/usage_stats.py). Se actualizan
+    al crear consultas y al completar sus trabajos, para servir las
+    estadísticas sin recorrer el historial.
+    """
+    __tablename__ = "usage_stats"
+    
+    user_id = Column(String, ForeignKey("users.id"), primary_key=True)
+    
+    total_queries = Column(Integer, default=0, nullable=False)
+    # Consultas del mes natural `month` (YYYY-MM)
+    month = Column(String(7))
+    month_queries = Column(Integer, default=0, nullable=False)
+    
+    # Resultados generados
+    pdfs_generated = Column(Integer, default=0, nullable=False)
+    climate_datasets = Column(Integer, default=0, nullable=False)
+    
+    last_query_at = Column(DateTime(timezone=True))
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+
+class Job(Base):
+    """
+    Trabajo de la cola persistente (ver services/job_queue.py).
+    
+    Un worker lo reclama poniéndolo en RUNNING con locked_until; si el
+    worker muere, al vencer locked_until otro worker puede reclamarlo.
+    """
+    __tablename__ = "jobs"
+    
+    id = Column(String, primary_key=True, default=generate_uuid)
+    job_type = Column(String, nullable=False)
+    payload = Column(JSON, nullable=False, default=dict)
+    user_id = Column(String, ForeignKey("users.id"), nullable=True)
+    # Clave de deduplicación (p. ej. la referencia catastral) y resultado
+    dedup_key = Column(String, nullable=True)
+    result = Column(JSON, nullable=True)
+    
+    # Planificación
+    status = Column(SQLEnum(JobStatus), default=JobStatus.PENDING, nullable=False)
+    priority = Column(Integer, default=0, nullable=False)  # Mayor = antes
+    run_after = Column(DateTime(timezone=True), nullable=False)
+    
+    # Reintentos y visibilidad
+    attempts = Column(Integer, default=0, nullable=False)
+    max_attempts = Column(Integer, default=3, nullable=False)
+    locked_by = Column(String, nullable=True)
+    locked_until = Column(DateTime(timezone=True), nullable=True)
+    last_error = Column(Text, nullable=True)
+    
+    # Metadata
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    finished_at = Column(DateTime(timezone=True), nullable=True)
+    
+    __table_args__ = (
+        # Selección del siguiente trabajo: estado, prioridad y fecha
+        Index("ix_jobs_status_priority_run_after", "status", "priority", "run_after"),
+        # Un solo trabajo activo por clave: las peticiones concurrentes se unen a él
+        Index(
+            "ux_jobs_dedup_activo", "job_type", "dedup_key", unique=True,
+            postgresql_where=text("status IN ('PENDING', 'RUNNING')"),
+            sqlite_where=text("status IN ('PENDING', 'RUNNING')"),
+        ),
+        # Reutilización de resultados recientes
+        Index("ix_jobs_dedup_finished", "job_type", "dedup_key", "finished_at"),
+    )
@@ -1,116 +1,466 @@
 """
 Router para análisis catastrales avanzados (KML, GeoJSON)
 """
-from fastapi import APIRouter, UploadFile, File, HTTPException, BackgroundTasks, Depends
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi import APIRouter, UploadFile, File, HTTPException, Depends, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
+from typing import Optional
+from collections import defaultdict
+import asyncio
+import multiprocessing
+import threading
 import shutil
 import uuid
-import os
 import json
 
-from auth.dependencies import get_current_active_user, check_query_limit
+from auth.dependencies import (
+    get_current_active_user, check_query_limit, oauth2_scheme_optional, user_from_token
+)
+from config import settings
+from database import AsyncSessionLocal
 import models
 from services.advanced_analysis import AnalizadorAfeccionesAmbientales
+from services.vector_stream import CopiaLectura
+from services import analysis_jobs, job_events
+from services.analysis_jobs import (
+    PDF_FILENAME, ESTADO_FILENAME, ESTADO_JOB, INFORME_JSON, INFORME_LOTE_JSON,
+    EN_COLA, PROCESANDO, COMPLETADO, ERROR, escribir_estado, leer_estado
+)
 
 router = APIRouter(prefix="/api/analysis", tags=["Análisis Avanzado"])
 
 # Directorio temporal para procesamiento
 TEMP_DIR = Path("temp_analysis")
-OUTPUT_DIR = Path("static/analysis_results")
+# Carpetas de los trabajos: privadas (fuera de static), los archivos se
+# sirven con download_result tras comprobar el usuario
+OUTPUT_DIR = Path(settings.ANALYSIS_DIR)
+
+# Archivos internos del trabajo que nunca se descargan
+ARCHIVOS_PRIVADOS = {ESTADO_JOB, ESTADO_FILENAME}
+
+# Este proceso, como propietario de los trabajos que encola en su ejecutor
+PROPIETARIO = analysis_jobs.proceso_actual()
 
 # Asegurar directorios
 TEMP_DIR.mkdir(exist_ok=True)
 OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 
+# Resultados por capa reutilizables entre subidas de la misma geometría
+CACHE_DIR = Path("cache_analysis")
+
+EXTENSIONES_VALIDAS = ('.kml', '.geojson', '.json')
+
+# Un lock por análisis para no generar el mismo PDF dos veces
+_pdf_locks = defaultdict(threading.Lock)
+_pdf_locks_guard = threading.Lock()
+
+# Ejecutor de análisis: procesos propios, dimensionados con
+# settings.ANALYSIS_WORKERS e independientes de los workers de la API
+_ejecutor = None
+_ejecutor_lock = threading.Lock()
+
+
+def obtener_ejecutor() -> ProcessPoolExecutor:
+    """Devuelve el ejecutor de análisis (lo crea o lo recrea si se ha roto)"""
+    global _ejecutor
+    with _ejecutor_lock:
+        if _ejecutor is None or getattr(_ejecutor, "_broken", False):
+            _ejecutor = ProcessPoolExecutor(
+                max_workers=settings.ANALYSIS_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=analysis_jobs.inicializar_worker,
+                initargs=(settings.CAPAS_REGISTRO, str(CACHE_DIR), settings.JOB_EVENTS_DIR),
+            )
+        return _ejecutor
+
+
+def cerrar_ejecutor():
+    """Detiene el ejecutor al apagar la aplicación (los trabajos en cola se cancelan)"""
+    global _ejecutor
+    with _ejecutor_lock:
+        if _ejecutor is not None:
+            _ejecutor.shutdown(wait=False, cancel_futures=True)
+            _ejecutor = None
+
+
+def asegurar_pdf(job_dir: Path) -> Path:
+    """
+    Genera el PDF del análisis si aún no existe (a partir del estado
+    guardado) y devuelve su ruta. Seguro ante llamadas concurrentes.
+    """
+    pdf_path = job_dir / PDF_FILENAME
+    if pdf_path.exists():
+        return pdf_path
+
+    with _pdf_locks_guard:
+        lock = _pdf_locks[job_dir.name]
+
+    with lock:
+        if not pdf_path.exists():
+            estado_path = job_dir / ESTADO_FILENAME
+            try:
+                analizador = AnalizadorAfeccionesAmbientales.cargar_estado(str(estado_path))
+            except FileNotFoundError:
+                # El trabajo pudo terminar su PDF (y borrar el estado) ahora mismo
+                if not pdf_path.exists():
+                    raise FileNotFoundError(pdf_path)
+            else:
+                analizador.generar_pdf(str(pdf_path))
+                estado_path.unlink(missing_ok=True)
+
+    with _pdf_locks_guard:
+        _pdf_locks.pop(job_dir.name, None)
+
+    return pdf_path
+
+
+def _directorio_trabajo(analysis_id: str) -> Path:
+    """Carpeta de un análisis; 404 si el id no es válido o no existe"""
+    try:
+        uuid.UUID(analysis_id)
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Análisis no encontrado")
+    job_dir = OUTPUT_DIR / analysis_id
+    if not job_dir.is_dir():
+        raise HTTPException(status_code=404, detail="Análisis no encontrado")
+    return job_dir
+
+
+def _marcar_error(job_dir: Path, error: str) -> dict:
+    """Da el trabajo por fallido y cierra su flujo de eventos"""
+    estado = escribir_estado(job_dir, ERROR, error=error)
+    job_events.EmisorProgreso(settings.JOB_EVENTS_DIR, job_dir.name).terminar(job_events.ERROR, error)
+    return estado
+
+
+def _estado_propio(job_dir: Path, user: models.User) -> dict:
+    """
+    Estado del trabajo, sólo para el usuario que lo lanzó. Un trabajo que
+    lleva más de ANALYSIS_JOB_TIMEOUT en cola o en curso se da por perdido,
+    salvo que el proceso que lo encoló siga vivo en este host (su ejecutor
+    lo terminará o lo marcará como fallido).
+    """
+    estado = leer_estado(job_dir)
+    if estado is None or estado.get("usuario_id") != user.id:
+        raise HTTPException(status_code=404, detail="Análisis no encontrado")
+    if (analysis_jobs.caducado(estado, settings.ANALYSIS_JOB_TIMEOUT)
+            and not analysis_jobs.propietario_vivo(estado)):
+        estado = _marcar_error(job_dir, "Análisis interrumpido (sin respuesta del proceso de análisis)")
+    return estado
+
+
+def recuperar_trabajos():
+    """
+    Al arrancar: los análisis en cola o en curso de procesos de la API que
+    ya no existen (reinicio, despliegue) pasan a error; sus futures se
+    perdieron con el proceso y nadie más los terminaría.
+    """
+    huerfanos = analysis_jobs.trabajos_huerfanos(OUTPUT_DIR, settings.ANALYSIS_JOB_TIMEOUT)
+    for job_dir in huerfanos:
+        _marcar_error(job_dir, "Análisis interrumpido por un reinicio del servidor")
+    if huerfanos:
+        print(f"⚠ {len(huerfanos)} análisis interrumpidos marcados como error")
+    return len(huerfanos)
+
 
-@router.post("/kml")
+def _al_terminar(job_dir: Path):
+    """Marca el trabajo como fallido si el proceso murió o se canceló"""
+    def callback(future):
+        if future.cancelled():
+            error = "Análisis cancelado"
+        elif future.exception() is not None:
+            error = str(future.exception())
+        else:
+            return
+        _marcar_error(job_dir, error)
+    return callback
+
+
+def _extension_subida(file: UploadFile) -> str:
+    """Valida la extensión del archivo subido y la devuelve"""
+    nombre = (file.filename or '').lower()
+    for extension in EXTENSIONES_VALIDAS:
+        if nombre.endswith(extension):
+            return extension
+    raise HTTPException(status_code=400, detail="El archivo debe ser un KML (.kml) o GeoJSON (.geojson)")
+
+
+def _ingerir_subida(file: UploadFile, destino: Path, parsear):
+    """
+    Parsea la subida directamente desde el stream mientras se copia a disco,
+    sin cargar el documento completo en memoria.
+    """
+    with open(destino, "wb") as buffer:
+        lector = CopiaLectura(file.file, buffer)
+        parsear(lector)
+        lector.vaciar()
+
+
+@router.post("/kml", status_code=202)
 async def analyze_kml(
-    background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
+    antialias: bool = False,
+    progresivo: bool = False,
     current_user: models.User = Depends(check_query_limit)
 ):
     """
-    Sube un archivo KML para realizar un análisis de afecciones ambientales detallado.
+    Sube un archivo KML (o GeoJSON) para realizar un análisis de afecciones ambientales detallado.
+    
+    La subida se valida y se guarda, y el análisis se encola en el
+    ejecutor de análisis. Devuelve el id del trabajo al momento (202):
     
-    El proceso:
-    1. Guarda el KML temporalmente.
-    2. Ejecuta el AnalizadorAfeccionesAmbientales.
-    3. Genera PDF, JSON e imágenes.
-    4. Devuelve los resultados JSON y enlaces de descarga.
+    - `GET /api/analysis/jobs/{analysis_id}`: estado del trabajo.
+    - `GET /api/analysis/jobs/{analysis_id}/events`: progreso por SSE.
+    - `GET /api/analysis/jobs/{analysis_id}/result`: resultados JSON y
+      enlaces de descarga cuando está completado.
+    
+    El PDF se genera tras el JSON; si se descarga antes de que esté
+    listo, se genera en ese momento.
+    
+    Con `antialias=true` los píxeles del contorno se ponderan por su
+    cobertura fraccional (recomendado para parcelas pequeñas).
+    Con `progresivo=true` cada capa se evalúa primero a baja resolución y
+    sólo se descarga a resolución completa si su cobertura es mixta.
     """
     
-    if not file.filename.lower().endswith('.kml'):
-        raise HTTPException(status_code=400, detail="El archivo debe ser un KML (.kml)")
+    extension = _extension_subida(file)
 
     # Generar ID único para este análisis
     analysis_id = str(uuid.uuid4())
     job_dir = OUTPUT_DIR / analysis_id
     job_dir.mkdir(parents=True, exist_ok=True)
 
-    # Guardar archivo subido
-    kml_path = job_dir / "parcela.kml"
+    # Parsear la subida en streaming mientras se guarda (fuera del event loop)
+    kml_path = job_dir / f"parcela{extension}"
+    analizador = AnalizadorAfeccionesAmbientales(str(kml_path))
     try:
-        with open(kml_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        await run_in_threadpool(_ingerir_subida, file, kml_path, analizador.parsear_kml)
+    except ValueError as e:
+        shutil.rmtree(job_dir)
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         shutil.rmtree(job_dir)
         raise HTTPException(status_code=500, detail=f"Error guardando archivo: {e}")
 
-    # Ejecutar análisis (síncrono por ahora para devolver resultado inmediato, 
-    # aunque idealmente debería ser background tarea para archivos grandes)
+    escribir_estado(
+        job_dir, EN_COLA, usuario_id=current_user.id, archivo=kml_path.name,
+        antialias=antialias, progresivo=progresivo, propietario=PROPIETARIO
+    )
+    job_events.EmisorProgreso(settings.JOB_EVENTS_DIR, analysis_id)("en_cola", 0, "Análisis en cola")
+
     try:
-        # Instanciar analizador
-        analizador = AnalizadorAfeccionesAmbientales(str(kml_path))
-        
-        # Ejecutar pipeline
-        analizador.parsear_kml()
-        analizador.validar_con_catastro() # Intenta obtener referencia oficial
-        analizador.analizar_todas_capas(width=1000, height=1000)
-        
-        # Generar salidas
-        output_imgs_dir = job_dir / "imagenes"
-        analizador.guardar_imagenes(str(output_imgs_dir))
-        
-        json_path = job_dir / "informe.json"
-        analizador.exportar_json(str(json_path))
-        
-        pdf_path = job_dir / "informe_completo.pdf"
-        analizador.generar_pdf(str(pdf_path))
+        future = obtener_ejecutor().submit(
+            analysis_jobs.ejecutar_analisis_kml, str(job_dir), kml_path.name,
+            antialias, progresivo, settings.LEYENDAS_DIR, settings.CAPAS_DIR
+        )
+    except (BrokenProcessPool, RuntimeError) as e:
+        _marcar_error(job_dir, str(e))
+        raise HTTPException(status_code=503, detail="Servicio de análisis no disponible")
+    future.add_done_callback(_al_terminar(job_dir))
+
+    return {
+        "status": EN_COLA,
+        "analysis_id": analysis_id,
+        "status_url": f"/api/analysis/jobs/{analysis_id}",
+        "events_url": f"/api/analysis/jobs/{analysis_id}/events",
+        "result_url": f"/api/analysis/jobs/{analysis_id}/result"
+    }
+
+
+@router.get("/jobs/{analysis_id}")
+async def analysis_status(
+    analysis_id: str,
+    current_user: models.User = Depends(get_current_active_user)
+):
+    """Estado de un análisis encolado: en_cola, procesando, completado o error"""
+    estado = _estado_propio(_directorio_trabajo(analysis_id), current_user)
+    return {
+        "analysis_id": analysis_id,
+        "status": estado["estado"],
+        "created_at": estado.get("creado"),
+        "started_at": estado.get("inicio"),
+        "finished_at": estado.get("fin"),
+        "error": estado.get("error")
+    }
+
+
+async def _usuario_de_token(token: Optional[str]) -> models.User:
+    """Usuario del token con una sesión breve (no se mantiene durante el flujo)"""
+    async with AsyncSessionLocal() as db:
+        user = await user_from_token(db, token)
+        if not user.is_active:
+            raise HTTPException(status_code=400, detail="Inactive user")
+        return user
+
+
+@router.get("/jobs/{analysis_id}/events")
+async def analysis_events(
+    analysis_id: str,
+    request: Request,
+    token: Optional[str] = None,
+    bearer: Optional[str] = Depends(oauth2_scheme_optional)
+):
+    """
+    Progreso del análisis como Server-Sent Events: en_cola, parseo, capas
+    (una por capa analizada), imagenes, informe y un evento final
+    (completado o error). Admite `Last-Event-ID` para reanudar y el token
+    en `?token=` para EventSource.
+    """
+    user = await _usuario_de_token(bearer or token)
+    job_dir = _directorio_trabajo(analysis_id)
+    estado = _estado_propio(job_dir, user)
+
+    ruta = job_events.ruta_eventos(settings.JOB_EVENTS_DIR, analysis_id)
+    if estado["estado"] in (COMPLETADO, ERROR) and not ruta.exists():
+        # Eventos ya purgados: sólo el resultado
+        final = {"etapa": estado["estado"], "mensaje": estado.get("error"), "final": True}
+        async def flujo():
+            yield f"id: 0\nevent: progreso\ndata: {json.dumps(final, ensure_ascii=False)}\n\n"
+        return StreamingResponse(flujo(), media_type="text/event-stream")
+
+    try:
+        desde = int(request.headers.get("last-event-id", -1)) + 1
+    except ValueError:
+        desde = 0
+
+    return StreamingResponse(
+        job_events.flujo_sse(ruta, desde, espera_maxima=settings.JOB_VISIBILITY_TIMEOUT),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@router.get("/jobs/{analysis_id}/result")
+async def analysis_result(
+    analysis_id: str,
+    current_user: models.User = Depends(get_current_active_user)
+):
+    """
+    Resultados de un análisis completado. Mientras no termina responde 202
+    con el estado; si falló, 500 con el error.
+    """
+    job_dir = _directorio_trabajo(analysis_id)
+    estado = _estado_propio(job_dir, current_user)
+
+    if estado["estado"] == ERROR:
+        raise HTTPException(status_code=500, detail=f"Error durante el análisis: {estado.get('error')}")
+    if estado["estado"] != COMPLETADO:
+        return JSONResponse(
+            status_code=202,
+            content={"status": estado["estado"], "analysis_id": analysis_id}
+        )
+
+    # Leer resultado JSON para devolverlo
+    with open(job_dir / INFORME_JSON, 'r', encoding='utf-8') as f:
+        resultados = json.load(f)
+
+    # Descargas autenticadas (la carpeta del trabajo no es pública)
+    base_url = f"/api/analysis/download/{analysis_id}"
+
+    return {
+        "status": "success",
+        "analysis_id": analysis_id,
+        "summary": resultados.get("afecciones", {}),
+        "catastro_data": resultados.get("catastro", {}),
+        "download_urls": {
+            "pdf": f"{base_url}/{PDF_FILENAME}",
+            "json": f"{base_url}/{INFORME_JSON}",
+            "kml": f"{base_url}/{estado.get('archivo')}"
+        }
+    }
+
+
+@router.post("/kml/batch")
+async def analyze_kml_batch(
+    file: UploadFile = File(...),
+    current_user: models.User = Depends(check_query_limit)
+):
+    """
+    Analiza un KML o GeoJSON con varios polígonos (uno por Placemark/Feature).
+    
+    Cada capa se descarga una sola vez sobre el extent común (o unos pocos
+    extents agrupados) y se devuelven resultados por polígono. El análisis
+    se ejecuta en el ejecutor de análisis, sin bloquear el event loop.
+    """
+    
+    extension = _extension_subida(file)
+
+    analysis_id = str(uuid.uuid4())
+    job_dir = OUTPUT_DIR / analysis_id
+    job_dir.mkdir(parents=True, exist_ok=True)
+
+    kml_path = job_dir / f"parcelas{extension}"
+    analizador = AnalizadorAfeccionesAmbientales(str(kml_path))
+    try:
+        await run_in_threadpool(_ingerir_subida, file, kml_path, analizador.parsear_kml_lote)
+    except ValueError as e:
+        shutil.rmtree(job_dir)
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        shutil.rmtree(job_dir)
+        raise HTTPException(status_code=500, detail=f"Error guardando archivo: {e}")
+
+    # El estado guarda el usuario para autorizar las descargas
+    escribir_estado(
+        job_dir, PROCESANDO, usuario_id=current_user.id, archivo=kml_path.name,
+        propietario=PROPIETARIO
+    )
+
+    try:
+        resultados = await asyncio.wrap_future(obtener_ejecutor().submit(
+            analysis_jobs.ejecutar_analisis_lote, str(job_dir), kml_path.name,
+            settings.LEYENDAS_DIR, settings.CAPAS_DIR
+        ))
+        escribir_estado(job_dir, COMPLETADO)
         
-        # Leer resultado JSON para devolverlo
-        with open(json_path, 'r', encoding='utf-8') as f:
-            resultados = json.load(f)
-            
-        # Construir URLs de descarga (asumiendo que static está montado)
-        base_url = "/static/analysis_results/" + analysis_id
+        base_url = f"/api/analysis/download/{analysis_id}"
         
         return {
             "status": "success",
             "analysis_id": analysis_id,
-            "summary": resultados.get("afecciones", {}),
-            "catastro_data": resultados.get("catastro", {}),
+            "total_poligonos": len(resultados),
+            "poligonos": resultados,
             "download_urls": {
-                "pdf": f"{base_url}/informe_completo.pdf",
-                "json": f"{base_url}/informe.json",
-                "kml": f"{base_url}/parcela.kml"
+                "json": f"{base_url}/{INFORME_LOTE_JSON}",
+                "kml": f"{base_url}/{kml_path.name}"
             }
         }
 
+    except ValueError as e:
+        escribir_estado(job_dir, ERROR, error=str(e))
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
-        # Limpiar en caso de error grave
-        # shutil.rmtree(job_dir) 
         import traceback
         traceback.print_exc()
+        escribir_estado(job_dir, ERROR, error=str(e))
         raise HTTPException(status_code=500, detail=f"Error durante el análisis: {str(e)}")
 
 
 @router.get("/download/{analysis_id}/{filename}")
-async def download_result(analysis_id: str, filename: str):
-    """Descargar un archivo específico de un análisis previo"""
-    file_path = OUTPUT_DIR / analysis_id / filename
+async def download_result(
+    analysis_id: str,
+    filename: str,
+    current_user: models.User = Depends(get_current_active_user)
+):
+    """Descargar un archivo específico de un análisis previo (sólo su propietario)"""
+    job_dir = _directorio_trabajo(analysis_id)
+    _estado_propio(job_dir, current_user)
+    
+    if filename in ARCHIVOS_PRIVADOS or filename.startswith(".") or filename.endswith(".tmp"):
+        raise HTTPException(status_code=404, detail="Archivo no encontrado")
+    file_path = job_dir / filename
+    
+    # El PDF se genera bajo demanda si la tarea en segundo plano no terminó
+    if filename == PDF_FILENAME and not file_path.exists():
+        try:
+            file_path = await run_in_threadpool(asegurar_pdf, job_dir)
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail="Archivo no encontrado")
     
-    if not file_path.exists():
+    if not file_path.is_file():
         raise HTTPException(status_code=404, detail="Archivo no encontrado")
         
     return FileResponse(file_path)
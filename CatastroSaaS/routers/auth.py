@@ -3,11 +3,12 @@ Router de autenticación
 """
 from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import timedelta
 
-from database import get_db
-from auth.utils import verify_password, get_password_hash
+from database import get_async_db
+from auth.utils import hash_password, verify_and_update_password
 from auth.jwt import create_access_token
 from auth.dependencies import get_current_active_user
 import models
@@ -18,11 +19,13 @@ router = APIRouter(prefix="/api/auth", tags=["Authentication"])
 
 
 @router.post("/register", response_model=schemas.UserResponse, status_code=status.HTTP_201_CREATED)
-async def register(user_data: schemas.UserCreate, db: Session = Depends(get_db)):
+async def register(user_data: schemas.UserCreate, db: AsyncSession = Depends(get_async_db)):
     """Registrar nuevo usuario"""
     
     # Verificar si el email ya existe
-    existing_user = db.query(models.User).filter(models.User.email == user_data.email).first()
+    existing_user = (await db.execute(
+        select(models.User).where(models.User.email == user_data.email)
+    )).scalars().first()
     if existing_user:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -30,7 +33,7 @@ async def register(user_data: schemas.UserCreate, db: Session = Depends(get_db))
         )
     
     # Crear usuario
-    hashed_password = get_password_hash(user_data.password)
+    hashed_password = await hash_password(user_data.password)
     new_user = models.User(
         email=user_data.email,
         full_name=user_data.full_name,
@@ -38,10 +41,9 @@ async def register(user_data: schemas.UserCreate, db: Session = Depends(get_db))
     )
     
     db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    await db.flush()
     
-    # Crear suscripción gratuita
+    # Crear suscripción gratuita (en la misma transacción)
     subscription = models.Subscription(
         user_id=new_user.id,
         plan_type=models.PlanType.FREE,
@@ -50,7 +52,8 @@ async def register(user_data: schemas.UserCreate, db: Session = Depends(get_db))
     )
     
     db.add(subscription)
-    db.commit()
+    await db.commit()
+    await db.refresh(new_user)
     
     return new_user
 
@@ -58,14 +61,26 @@ async def register(user_data: schemas.UserCreate, db: Session = Depends(get_db))
 @router.post("/login", response_model=schemas.Token)
 async def login(
     form_data: OAuth2PasswordRequestForm = Depends(),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    """Login de usuario"""
+    """
+    Login de usuario.
+    
+    La verificación de la contraseña se hace en los hilos de hashing, sin
+    bloquear el event loop. Si el hash guardado usa un coste distinto de
+    BCRYPT_ROUNDS, se sustituye por uno nuevo con la contraseña recibida.
+    """
     
     # Buscar usuario
-    user = db.query(models.User).filter(models.User.email == form_data.username).first()
+    user = (await db.execute(
+        select(models.User).where(models.User.email == form_data.username)
+    )).scalars().first()
+    
+    valid, new_hash = await verify_and_update_password(
+        form_data.password, user.hashed_password if user else None
+    )
     
-    if not user or not verify_password(form_data.password, user.hashed_password):
+    if not valid:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect email or password",
@@ -78,6 +93,11 @@ async def login(
             detail="Inactive user"
         )
     
+    # Migrar el hash al coste configurado
+    if new_hash:
+        user.hashed_password = new_hash
+        await db.commit()
+    
     # Crear token
     access_token_expires = timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
@@ -90,15 +110,12 @@ async def login(
 
 @router.get("/me", response_model=schemas.UserWithSubscription)
 async def get_me(
-    current_user: models.User = Depends(get_current_active_user),
-    db: Session = Depends(get_db)
+    current_user: models.User = Depends(get_current_active_user)
 ):
     """Obtener información del usuario actual"""
     
-    # Cargar suscripción
-    subscription = db.query(models.Subscription).filter(
-        models.Subscription.user_id == current_user.id
-    ).first()
+    # La suscripción llega cargada con el usuario
+    subscription = current_user.subscription
     
     response = schemas.UserWithSubscription.from_orm(current_user)
     if subscription:
@@ -1,112 +1,183 @@
 """
 Router de consultas catastrales
 """
-from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks
-from sqlalchemy.orm import Session
-from typing import List
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
+from sqlalchemy import literal, select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List, Optional
 from pathlib import Path
 
-from database import get_db, SessionLocal
-from auth.dependencies import get_current_active_user, check_query_limit
+from config import settings
+from database import get_async_db, AsyncSessionLocal
+from auth.dependencies import (
+    get_current_active_user, check_query_limit, consume_query_quota,
+    oauth2_scheme_optional, user_from_token
+)
 import models
 import schemas
-from services.catastro_engine import procesar_y_comprimir
+from services import job_queue, job_events, usage_stats
 
 router = APIRouter(prefix="/api/catastro", tags=["Catastro"])
 
+# Directorio de salida (dentro de static para poder descargar); compartido con los workers
+OUTPUT_DIR = Path("static/downloads")
+
+
+def clave_referencia(referencia: str) -> str:
+    """
+    Clave de deduplicación: la referencia sin espacios y en mayúsculas
+    (Catastro no distingue mayúsculas y minúsculas)
+    """
+    return referencia.replace(" ", "").strip().upper()
 
-def run_catastro_process(query_id: str, ref: str, output_dir: str):
-    """Tarea en segundo plano para procesar la referencia catastral"""
-    db = SessionLocal()
-    try:
-        print(f"🔄 Iniciando procesamiento para {ref}...")
-        zip_path, results = procesar_y_comprimir(ref, output_dir)
-        
-        # Actualizar estado en BD
-        query = db.query(models.Query).filter(models.Query.id == query_id).first()
-        if query:
-            query.has_pdf = results.get('informe_pdf', False)
-            # Mapeamos 'capas_afecciones' a 'has_climate_data' como proxy temporal
-            query.has_climate_data = results.get('capas_afecciones', False)
-            
-            # Si hay ZIP, podríamos guardar la URL si el modelo tuviera campo. 
-            # Por ahora asumimos que el frontend construye la URL: /static/downloads/{ref}/{ref}_completo.zip
-            
-            db.commit()
-            print(f"✅ Procesamiento finalizado para {ref}")
-    except Exception as e:
-        print(f"❌ Error procesando {ref}: {e}")
-    finally:
-        db.close()
+
+def _archivos_disponibles(job: models.Job) -> bool:
+    """Un resultado sólo se reutiliza si su ZIP sigue en disco"""
+    zip_path = (job.result or {}).get("zip_path")
+    return bool(zip_path) and Path(zip_path).exists()
+
+
+def _aplicar_resultado(query: models.Query, resultado: dict):
+    query.has_pdf = resultado.get("has_pdf", False)
+    query.has_climate_data = resultado.get("has_climate_data", False)
 
 
 @router.post("/query", response_model=schemas.QueryResponse)
 async def create_query(
     query_data: schemas.QueryCreate,
-    background_tasks: BackgroundTasks,
     current_user: models.User = Depends(check_query_limit),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Crear nueva consulta catastral
     
     Este endpoint:
     1. Verifica que el usuario tenga consultas disponibles
-    2. Crea el registro de consulta
-    3. Incrementa el contador de consultas usadas
-    4. Lanza el procesamiento en segundo plano
+    2. Incrementa el contador de consultas usadas (un UPDATE condicional)
+    3. Encola el procesamiento para los workers
+    4. Crea el registro de consulta
     5. Devuelve la información de la consulta
+    
+    El procesamiento se encola en la tabla `jobs` en la misma transacción
+    que la consulta y el consumo de la cuota, y lo ejecuta un worker
+    (worker.py) con prioridad según el plan del usuario. Las consultas de
+    una referencia que ya se está procesando se unen a ese trabajo, y si
+    se procesó hace menos de CATASTRO_FRESHNESS_HOURS se reutilizan sus
+    archivos. Cada consulta cuenta en la cuota de su usuario y en sus
+    contadores de uso (services/usage_stats.py).
     """
     
+    # Consumir la cuota (UPDATE condicional atómico; 403 si está agotada)
+    plan_type = await consume_query_quota(db, current_user)
+    
+    # Encolar el procesamiento o unirse al de la misma referencia
+    # (se confirma junto con la consulta y la cuota). job_queue es síncrono
+    # (lo comparte worker.py): se ejecuta sobre la misma conexión con run_sync
+    job, modo = await db.run_sync(
+        job_queue.encolar_unico, "catastro", clave_referencia(query_data.referencia_catastral),
+        {
+            "referencia": query_data.referencia_catastral.strip().upper(),
+            "output_dir": str(OUTPUT_DIR)
+        },
+        user_id=current_user.id,
+        priority=job_queue.prioridad_plan(plan_type),
+        max_attempts=settings.JOB_MAX_ATTEMPTS,
+        frescura=settings.CATASTRO_FRESHNESS_HOURS * 3600,
+        reutilizable=_archivos_disponibles
+    )
+    
     # Crear consulta
     new_query = models.Query(
         user_id=current_user.id,
         referencia_catastral=query_data.referencia_catastral,
         has_climate_data=False,
         has_socioeconomic_data=False,
-        has_pdf=False
+        has_pdf=False,
+        job_id=job.id
     )
-    
     db.add(new_query)
+    if modo == "reutilizado":
+        _aplicar_resultado(new_query, job.result)
     
-    # Incrementar contador de consultas
-    subscription = db.query(models.Subscription).filter(
-        models.Subscription.user_id == current_user.id
-    ).first()
+    await db.execute(usage_stats.incremento(
+        current_user.id,
+        consultas=1,
+        pdfs=int(bool(new_query.has_pdf)),
+        datos_climaticos=int(bool(new_query.has_climate_data))
+    ))
     
-    subscription.queries_used += 1
+    await db.commit()
     
-    db.commit()
-    db.refresh(new_query)
+    if modo == "nuevo":
+        job_events.EmisorProgreso(settings.JOB_EVENTS_DIR, job.id)(
+            "en_cola", 0, "Consulta en cola"
+        )
     
-    # Directorio de salida (dentro de static para poder descargar)
-    # IMPORTANTE: Asegurarse de que este directorio existe en el Dockerfile o se crea aquí
-    output_dir = Path("static/downloads")
-    output_dir.mkdir(parents=True, exist_ok=True)
+    # Si el trabajo terminó mientras se confirmaba la consulta, el worker
+    # pudo no verla: copiar ya el resultado
+    if modo == "en_curso":
+        await db.refresh(job)
+        if job.status == models.JobStatus.DONE and job.result:
+            await db.run_sync(
+                usage_stats.aplicar_resultado, models.Query.id == new_query.id, job.result
+            )
+            await db.commit()
     
-    # Lanzar tarea en segundo plano
-    background_tasks.add_task(
-        run_catastro_process,
-        query_id=new_query.id,
-        ref=query_data.referencia_catastral,
-        output_dir=str(output_dir)
-    )
+    await db.refresh(new_query)
     
     return new_query
 
 
 @router.get("/queries", response_model=List[schemas.QueryResponse])
 async def get_my_queries(
+    response: Response,
     current_user: models.User = Depends(get_current_active_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
+    cursor: Optional[str] = None,
     skip: int = 0,
     limit: int = 100
 ):
-    """Obtener historial de consultas del usuario"""
+    """
+    Obtener historial de consultas del usuario (más recientes primero).
+    
+    Paginación por cursor: si hay más resultados, la cabecera
+    `X-Next-Cursor` trae el valor de `cursor` para la página siguiente
+    (el id de la última consulta devuelta). Cada página se lee del índice
+    (user_id, created_at, id) a partir de esa posición, así que el coste
+    no crece con el historial. Un cursor desconocido devuelve una lista vacía.
+    `skip` se mantiene por compatibilidad (OFFSET) cuando no hay cursor.
+    """
+    
+    if limit < 1:
+        raise HTTPException(status_code=400, detail="limit must be positive")
+    
+    consulta = (
+        select(models.Query)
+        .where(models.Query.user_id == current_user.id)
+        .order_by(models.Query.created_at.desc(), models.Query.id.desc())
+    )
+    
+    if cursor:
+        # La posición del cursor se lee de la propia fila (búsqueda por clave
+        # primaria): se compara el valor guardado, sin convertir fechas
+        created_at_cursor = select(models.Query.created_at).where(
+            models.Query.id == cursor,
+            models.Query.user_id == current_user.id
+        ).scalar_subquery()
+        consulta = consulta.where(
+            tuple_(models.Query.created_at, models.Query.id)
+            < tuple_(created_at_cursor, literal(cursor))
+        )
+    elif skip:
+        consulta = consulta.offset(skip)
     
-    queries = db.query(models.Query).filter(
-        models.Query.user_id == current_user.id
-    ).order_by(models.Query.created_at.desc()).offset(skip).limit(limit).all()
+    # Una fila de más indica si hay página siguiente
+    queries = (await db.execute(consulta.limit(limit + 1))).scalars().all()
+    
+    if len(queries) > limit:
+        queries = queries[:limit]
+        response.headers["X-Next-Cursor"] = queries[-1].id
     
     return queries
 
@@ -115,14 +186,16 @@ async def get_my_queries(
 async def get_query(
     query_id: str,
     current_user: models.User = Depends(get_current_active_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Obtener detalles de una consulta específica"""
     
-    query = db.query(models.Query).filter(
-        models.Query.id == query_id,
-        models.Query.user_id == current_user.id
-    ).first()
+    query = (await db.execute(
+        select(models.Query).where(
+            models.Query.id == query_id,
+            models.Query.user_id == current_user.id
+        )
+    )).scalars().first()
     
     if not query:
         raise HTTPException(status_code=404, detail="Query not found")
@@ -130,23 +203,98 @@ async def get_query(
     return query
 
 
+async def _trabajo_de_consulta(token: Optional[str], query_id: str):
+    """
+    Comprueba el token y la consulta; devuelve (job_id, estado del trabajo).
+    Usa una sesión propia que se cierra antes de empezar el flujo.
+    """
+    async with AsyncSessionLocal() as db:
+        user = await user_from_token(db, token)
+        if not user.is_active:
+            raise HTTPException(status_code=400, detail="Inactive user")
+        
+        fila = (await db.execute(
+            select(models.Query.job_id, models.Job.status)
+            .outerjoin(models.Job, models.Job.id == models.Query.job_id)
+            .where(
+                models.Query.id == query_id,
+                models.Query.user_id == user.id
+            )
+        )).first()
+        
+        if fila is None:
+            raise HTTPException(status_code=404, detail="Query not found")
+        return fila.job_id, fila.status
+
+
+@router.get("/queries/{query_id}/events")
+async def stream_query_events(
+    query_id: str,
+    request: Request,
+    token: Optional[str] = None,
+    bearer: Optional[str] = Depends(oauth2_scheme_optional)
+):
+    """
+    Progreso del procesamiento de una consulta como Server-Sent Events.
+    
+    Cada evento `progreso` lleva la etapa (en_cola, inicio, coordenadas,
+    gml, kml, imagenes, afecciones, documentos, informe, zip) y el
+    porcentaje; el último tiene `final: true` (completado o error). Admite
+    `Last-Event-ID` para reanudar. El token puede ir en la cabecera o en
+    `?token=` (EventSource no envía cabeceras).
+    
+    La base de datos sólo se consulta al conectar: después se sigue el
+    archivo de eventos del trabajo.
+    """
+    job_id, estado = await _trabajo_de_consulta(bearer or token, query_id)
+    if job_id is None:
+        raise HTTPException(status_code=404, detail="Query has no job")
+    
+    ruta = job_events.ruta_eventos(settings.JOB_EVENTS_DIR, job_id)
+    terminado = estado in (models.JobStatus.DONE, models.JobStatus.FAILED)
+    
+    if terminado and not ruta.exists():
+        # Eventos ya purgados: sólo el resultado
+        final = job_events.COMPLETADO if estado == models.JobStatus.DONE else job_events.ERROR
+        async def flujo():
+            yield f'id: 0\nevent: progreso\ndata: {{"etapa": "{final}", "final": true}}\n\n'
+        return StreamingResponse(flujo(), media_type="text/event-stream")
+    
+    try:
+        desde = int(request.headers.get("last-event-id", -1)) + 1
+    except ValueError:
+        desde = 0
+    
+    return StreamingResponse(
+        job_events.flujo_sse(ruta, desde, espera_maxima=settings.JOB_VISIBILITY_TIMEOUT),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
 @router.get("/stats")
 async def get_stats(
     current_user: models.User = Depends(get_current_active_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    """Obtener estadísticas de uso del usuario"""
+    """
+    Obtener estadísticas de uso del usuario.
     
-    subscription = db.query(models.Subscription).filter(
-        models.Subscription.user_id == current_user.id
-    ).first()
+    La suscripción llega cargada con el usuario y los contadores son una
+    fila por clave primaria (usage_stats): el coste no depende del
+    tamaño del historial.
+    """
     
-    total_queries = db.query(models.Query).filter(
-        models.Query.user_id == current_user.id
-    ).count()
+    subscription = current_user.subscription
+    stats = await db.get(models.UsageStats, current_user.id)
+    mes = usage_stats.mes_actual()
     
     return {
-        "total_queries": total_queries,
+        "total_queries": stats.total_queries if stats else 0,
+        "queries_this_month": stats.month_queries if stats and stats.month == mes else 0,
+        "pdfs_generated": stats.pdfs_generated if stats else 0,
+        "climate_datasets": stats.climate_datasets if stats else 0,
+        "last_query_at": stats.last_query_at if stats else None,
         "queries_used_this_period": subscription.queries_used if subscription else 0,
         "queries_limit": subscription.queries_limit if subscription else 0,
         "queries_remaining": (subscription.queries_limit - subscription.queries_used) if subscription else 0,
@@ -2,11 +2,12 @@
 Router de suscripciones
 """
 from fastapi import APIRouter, Depends, HTTPException, Request
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import datetime
 from typing import List
 
-from database import get_db
+from database import get_async_db
 from auth.dependencies import get_current_active_user
 from services.stripe_service import stripe_service
 import models
@@ -66,7 +67,7 @@ async def get_plans():
 async def create_subscription(
     subscription_data: schemas.SubscriptionCreate,
     current_user: models.User = Depends(get_current_active_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Crear o actualizar suscripción"""
     
@@ -75,9 +76,7 @@ async def create_subscription(
         raise HTTPException(status_code=400, detail="Cannot create free subscription")
     
     # Obtener suscripción actual
-    subscription = db.query(models.Subscription).filter(
-        models.Subscription.user_id == current_user.id
-    ).first()
+    subscription = current_user.subscription
     
     if not subscription:
         raise HTTPException(status_code=404, detail="Subscription not found")
@@ -123,8 +122,8 @@ async def create_subscription(
             stripe_subscription.current_period_end
         )
         
-        db.commit()
-        db.refresh(subscription)
+        await db.commit()
+        await db.refresh(subscription)
         
         return subscription
     
@@ -135,13 +134,11 @@ async def create_subscription(
 @router.post("/cancel")
 async def cancel_subscription(
     current_user: models.User = Depends(get_current_active_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Cancelar suscripción"""
     
-    subscription = db.query(models.Subscription).filter(
-        models.Subscription.user_id == current_user.id
-    ).first()
+    subscription = current_user.subscription
     
     if not subscription or not subscription.stripe_subscription_id:
         raise HTTPException(status_code=404, detail="No active subscription found")
@@ -154,7 +151,7 @@ async def cancel_subscription(
         subscription.status = models.SubscriptionStatus.CANCELLED
         subscription.cancelled_at = datetime.utcnow()
         
-        db.commit()
+        await db.commit()
         
         return {"message": "Subscription cancelled successfully"}
     
@@ -163,7 +160,7 @@ async def cancel_subscription(
 
 
 @router.post("/webhook")
-async def stripe_webhook(request: Request, db: Session = Depends(get_db)):
+async def stripe_webhook(request: Request, db: AsyncSession = Depends(get_async_db)):
     """Webhook de Stripe para eventos de suscripción"""
     
     payload = await request.body()
@@ -179,9 +176,11 @@ async def stripe_webhook(request: Request, db: Session = Depends(get_db)):
         subscription_data = event.data.object
         
         # Buscar suscripción en BD
-        subscription = db.query(models.Subscription).filter(
-            models.Subscription.stripe_subscription_id == subscription_data.id
-        ).first()
+        subscription = (await db.execute(
+            select(models.Subscription).where(
+                models.Subscription.stripe_subscription_id == subscription_data.id
+            )
+        )).scalars().first()
         
         if subscription:
             # Actualizar estado
@@ -189,17 +188,19 @@ async def stripe_webhook(request: Request, db: Session = Depends(get_db)):
             subscription.current_period_end = datetime.fromtimestamp(
                 subscription_data.current_period_end
             )
-            db.commit()
+            await db.commit()
     
     elif event.type == "customer.subscription.deleted":
         subscription_data = event.data.object
         
-        subscription = db.query(models.Subscription).filter(
-            models.Subscription.stripe_subscription_id == subscription_data.id
-        ).first()
+        subscription = (await db.execute(
+            select(models.Subscription).where(
+                models.Subscription.stripe_subscription_id == subscription_data.id
+            )
+        )).scalars().first()
         
         if subscription:
             subscription.status = models.SubscriptionStatus.CANCELLED
-            db.commit()
+            await db.commit()
     
     return {"status": "success"}
@@ -78,6 +78,7 @@ class QueryResponse(BaseModel):
     has_climate_data: bool
     has_socioeconomic_data: bool
     has_pdf: bool
+    job_id: Optional[str] = None
     created_at: datetime
     
     class Config:
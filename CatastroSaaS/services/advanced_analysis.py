@@ -5,12 +5,116 @@ import numpy as np
 from io import BytesIO
 from collections import Counter
 from datetime import datetime
+import hashlib
 import json
 import os
+import pickle
+import shutil
+import tempfile
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+import matplotlib
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
 from matplotlib.backends.backend_pdf import PdfPages
 
+from services.vector_stream import iterar_vectorial, formato_de_archivo
+from services.raster_probe import sondear_imagen, huella_contenido
+from services.legend_classifier import ClasificadorLeyenda, clasificador_para
+from services.analysis_cache import huella_geometria, version_configuracion
+from services.raster_sources import leer_ventana, resolver_ruta
+from services.layer_registry import obtener_registro, comparador_para, parametros_bbox
+
+# Tamaño máximo de las miniaturas que se conservan en memoria
+TAM_MINIATURA = (400, 400)
+
+# Distancia de color asignada a píxeles sin dato (transparentes): queda
+# fuera de cualquier tolerancia 0-255
+SIN_DISTANCIA = 256
+
+# Margen (±) de tolerancia para la banda de sensibilidad del informe
+MARGEN_SENSIBILIDAD = 10
+
+# Tolerancia por defecto al asignar píxeles a colores de leyenda
+TOLERANCIA_LEYENDA = 10
+
+
+def _popcount(bits):
+    """Número de bits a 1 en un array uint8"""
+    if hasattr(np, 'bitwise_count'):
+        # Contar sobre palabras de 64 bits: 8 veces menos elementos
+        palabras = len(bits) // 8 * 8
+        return (int(np.bitwise_count(bits[:palabras].view(np.uint64)).sum()) +
+                int(np.bitwise_count(bits[palabras:]).sum()))
+    return int(_BITS_POR_BYTE[bits].sum(dtype=np.int64))
+
+
+_BITS_POR_BYTE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+class MascaraBits:
+    """
+    Píxeles del polígono afectados por una capa, empaquetados a 1 bit por
+    píxel en el orden de self.mascara. Si la capa es uniforme (sin afección
+    o afección total) sólo se guarda el valor.
+    """
+    __slots__ = ('bits', 'num_pixels', 'uniforme')
+    
+    def __init__(self, bits=None, num_pixels=0, uniforme=None):
+        self.bits = bits
+        self.num_pixels = num_pixels
+        self.uniforme = uniforme
+    
+    @classmethod
+    def desde(cls, afectados):
+        """Crea la máscara a partir del vector de afectados (o de un escalar)"""
+        if afectados is None:
+            return None
+        if np.ndim(afectados) == 0:
+            return cls(uniforme=bool(afectados))
+        return cls(np.packbits(afectados), len(afectados))
+    
+    def empaquetar(self, num_pixels):
+        """Bits para un polígono de num_pixels píxeles"""
+        if self.uniforme is None:
+            if self.num_pixels != num_pixels:
+                raise ValueError("La máscara de afección no corresponde a la máscara actual del polígono")
+            return self.bits
+        bits = np.full((num_pixels + 7) // 8, 0xFF if self.uniforme else 0, dtype=np.uint8)
+        sobrantes = num_pixels % 8
+        if self.uniforme and sobrantes:
+            # Los bits de relleno del último byte quedan a 0, como en np.packbits
+            bits[-1] = (0xFF << (8 - sobrantes)) & 0xFF
+        return bits
+    
+    def __getstate__(self):
+        return self.bits, self.num_pixels, self.uniforme
+    
+    def __setstate__(self, estado):
+        self.bits, self.num_pixels, self.uniforme = estado
+
+
+class ResultadoCapa(dict):
+    """
+    Resultado compacto de una capa: 'analisis', 'miniatura', 'afectados'
+    (MascaraBits) e 'histograma' de distancias de color en memoria y el
+    raster completo volcado a disco. La clave 'imagen' no se guarda:
+    se abre desde disco cada vez que se pide (la decodificación de PIL es
+    perezosa) y se libera al dejar de usarse.
+    """
+    
+    def __init__(self, analisis, miniatura=None, ruta=None, afectados=None, histograma=None):
+        super().__init__(analisis=analisis, miniatura=miniatura,
+                         afectados=afectados, histograma=histograma)
+        self.ruta = ruta
+    
+    def __missing__(self, clave):
+        if clave == 'imagen':
+            return Image.open(self.ruta) if self.ruta else None
+        raise KeyError(clave)
+
+
 class AnalizadorAfeccionesAmbientales:
     """
     Analiza afecciones ambientales desde KML calculando porcentajes
@@ -24,53 +128,25 @@ class AnalizadorAfeccionesAmbientales:
         self.bbox = None
         self.coordenadas = []
         self.mascara = None
+        self.cobertura = None
         self.datos_catastro = None
-        
-        # Capas WMS con múltiples variantes de color
-        self.capas = {
-            'montes_publicos': {
-                'url': 'https://www.ign.es/wms-inspire/cubierta-tierra',
-                'layer': 'LC.ForestManagementUnit',
-                'colores_posibles': [
-                    (34, 139, 34),   # Verde forestal
-                    (0, 128, 0),     # Verde oscuro
-                    (46, 125, 50),   # Verde material
-                    (76, 175, 80),   # Verde claro
-                ],
-                'tolerancia': 40
-            },
-            'red_natura': {
-                'url': 'https://servicios.idee.es/wms-inspire/protectedsites',
-                'layer': 'PS.ProtectedSite',
-                'colores_posibles': [
-                    (0, 128, 0),     # Verde protegido
-                    (34, 139, 34),   # Verde forestal
-                    (0, 100, 0),     # Verde oscuro
-                    (60, 179, 113),  # Verde medio
-                ],
-                'tolerancia': 45
-            },
-            'vias_pecuarias': {
-                'url': 'https://www.mapa.gob.es/servicios/wms/vias-pecuarias',
-                'layer': 'viaspecuarias',
-                'colores_posibles': [
-                    (165, 42, 42),   # Marrón
-                    (139, 69, 19),   # Marrón silla
-                    (160, 82, 45),   # Siena
-                    (205, 133, 63),  # Perú
-                ],
-                'tolerancia': 35
-            },
-            'patrimonio_geologico': {
-                'url': 'https://www.ign.es/wms-inspire/geologia',
-                'layer': 'GE.GeologicUnit',
-                'colores_posibles': [
-                    (128, 128, 128), # Gris
-                    (169, 169, 169), # Gris oscuro
-                ],
-                'tolerancia': 50
-            }
-        }
+        self.poligonos = []
+        self.resultados_lote = []
+        # Directorio donde se vuelcan los rasters descargados (temporal si es None)
+        self.directorio_rasters = None
+        # Directorio con leyenda_<capa>.csv para el desglose por clases (opcional)
+        self.directorio_leyendas = None
+        # Directorio base de las capas locales (backend 'local')
+        self.directorio_capas = None
+        # Caché de resultados por capa (CacheAnalisis, opcional)
+        self.cache = None
+        self._parametros_cache = None
+        # Función opcional progreso(etapa, porcentaje, mensaje, **datos)
+        self.progreso = None
+        
+        # Capas WMS / locales con múltiples variantes de color, definidas en
+        # el registro compartido (services/capas.json, se recarga en caliente)
+        self.capas = obtener_registro().capas_analisis()
         
         self.resultados = {}
     
@@ -229,10 +305,14 @@ class AnalizadorAfeccionesAmbientales:
                     lon_centro, lat_centro
                 )
         
-        # Consultar datos completos
+        # Consultar datos completos y geometría (independientes entre sí)
         if self.referencia_catastral:
-            print(f"\n📋 Consultando datos de: {self.referencia_catastral}")
-            self.datos_catastro = self.consultar_datos_catastro(self.referencia_catastral)
+            print(f"\n📋 Consultando datos y geometría de: {self.referencia_catastral}")
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                futuro_datos = executor.submit(self.consultar_datos_catastro, self.referencia_catastral)
+                futuro_geometria = executor.submit(self.obtener_geometria_catastro, self.referencia_catastral)
+                self.datos_catastro = futuro_datos.result()
+                coords_catastro = futuro_geometria.result()
             
             if self.datos_catastro:
                 print("\n" + "─"*70)
@@ -270,10 +350,7 @@ class AnalizadorAfeccionesAmbientales:
                     else:
                         print(f"   ❌ Diferencia significativa - verificar delimitación")
             
-            # Intentar obtener geometría de Catastro
-            print(f"\n🗺️ Obteniendo geometría catastral...")
-            coords_catastro = self.obtener_geometria_catastro(self.referencia_catastral)
-            
+            # Geometría de Catastro
             if coords_catastro:
                 print(f"✓ Se puede comparar con geometría oficial")
                 # Aquí se podría implementar comparación de geometrías
@@ -282,56 +359,94 @@ class AnalizadorAfeccionesAmbientales:
         
         print("="*70)
     
-    def parsear_kml(self):
-        """Extrae coordenadas y calcula bbox del KML"""
-        tree = ET.parse(self.kml_path)
-        root = tree.getroot()
-        
-        # Namespaces comunes en KML
-        ns = {'kml': 'http://www.opengis.net/kml/2.2'}
-        
-        # Buscar coordenadas
-        coords_elem = root.find('.//kml:coordinates', ns)
-        if coords_elem is None:
-            coords_elem = root.find('.//coordinates')
+    def _iterar_poligonos(self, fuente=None):
+        """Recorre los polígonos del archivo (KML o GeoJSON) de forma incremental"""
+        fuente = fuente if fuente is not None else self.kml_path
+        return iterar_vectorial(fuente, formato_de_archivo(self.kml_path))
+    
+    def parsear_kml(self, fuente=None):
+        """
+        Extrae coordenadas y calcula bbox del primer polígono del archivo.
         
-        if coords_elem is None:
-            print("⚠ No se encontraron coordenadas como texto simple en coordinates, intentando LinearRing...")
-            # Intento alternativo para polígonos complejos
-            coords_elem = root.find('.//kml:LinearRing/kml:coordinates', ns)
+        `fuente` puede ser un stream binario (p. ej. la subida HTTP); por
+        defecto se lee self.kml_path. Admite KML y GeoJSON.
+        """
+        primero = next(iter(self._iterar_poligonos(fuente)), None)
         
-        if coords_elem is None:
-             raise ValueError("No se encontraron coordenadas en el KML")
+        if primero is None:
+            raise ValueError("No se encontraron coordenadas en el KML")
         
-        coords_text = coords_elem.text.strip()
-        self.coordenadas = []
-        
-        for linea in coords_text.split():
-            if linea.strip():
-                partes = linea.split(',')
-                if len(partes) >= 2:
-                    lon, lat = float(partes[0]), float(partes[1])
-                    self.coordenadas.append((lon, lat))
+        self.coordenadas = [tuple(c) for c in primero['anillos'][0].tolist()]
         
         if not self.coordenadas:
             raise ValueError("No se pudieron parsear las coordenadas")
         
         # Calcular bbox
-        lons = [c[0] for c in self.coordenadas]
-        lats = [c[1] for c in self.coordenadas]
-        
-        self.bbox = {
-            'minx': min(lons),
-            'miny': min(lats),
-            'maxx': max(lons),
-            'maxy': max(lats)
-        }
+        self.bbox = self._bbox_de(self.coordenadas)
         
         print(f"✓ KML parseado: {len(self.coordenadas)} coordenadas")
         print(f"✓ BBox: {self.bbox}")
     
-    def crear_mascara_poligono(self, width, height):
-        """Crea una máscara binaria del polígono KML"""
+    def parsear_kml_lote(self, fuente=None):
+        """
+        Extrae todos los polígonos del archivo para el análisis por lotes.
+        Cada polígono usa su anillo exterior.
+        """
+        self.poligonos = []
+        nombres_usados = set()
+        
+        for i, feature in enumerate(self._iterar_poligonos(fuente), 1):
+            coordenadas = [tuple(c) for c in feature['anillos'][0].tolist()]
+            
+            nombre = feature['nombre']
+            if nombre in nombres_usados:
+                nombre = f"{nombre}_{i}"
+            nombres_usados.add(nombre)
+            
+            self.poligonos.append({
+                'nombre': nombre,
+                'coordenadas': coordenadas,
+                'bbox': self._bbox_de(coordenadas)
+            })
+        
+        if not self.poligonos:
+            raise ValueError("No se encontraron polígonos en el KML")
+        
+        # BBox envolvente de todo el lote
+        self.bbox = self._unir_bbox([p['bbox'] for p in self.poligonos])
+        self.coordenadas = self.poligonos[0]['coordenadas']
+        
+        print(f"✓ KML parseado: {len(self.poligonos)} polígonos")
+        print(f"✓ BBox envolvente: {self.bbox}")
+        return self.poligonos
+    
+    @staticmethod
+    def _bbox_de(coordenadas):
+        """BBox de una lista de (lon, lat)"""
+        lons = [c[0] for c in coordenadas]
+        lats = [c[1] for c in coordenadas]
+        return {'minx': min(lons), 'miny': min(lats), 'maxx': max(lons), 'maxy': max(lats)}
+    
+    @staticmethod
+    def _unir_bbox(bboxes):
+        """BBox envolvente de varios bbox"""
+        return {
+            'minx': min(b['minx'] for b in bboxes),
+            'miny': min(b['miny'] for b in bboxes),
+            'maxx': max(b['maxx'] for b in bboxes),
+            'maxy': max(b['maxy'] for b in bboxes)
+        }
+    
+    def crear_mascara_poligono(self, width, height, antialias=False, supersampling=4):
+        """
+        Crea una máscara binaria del polígono KML.
+        
+        Con antialias=True calcula además una máscara de cobertura fraccional
+        (self.cobertura): cada píxel del borde recibe la fracción de su área
+        que cae dentro del polígono, estimada con supersampling×supersampling
+        muestras. Los píxeles interiores valen 1 y los exteriores 0, de modo
+        que el supermuestreo sólo se aplica a lo largo del contorno.
+        """
         mascara = Image.new('L', (width, height), 0)
         draw = ImageDraw.Draw(mascara)
         
@@ -346,25 +461,112 @@ class AnalizadorAfeccionesAmbientales:
         draw.polygon(coords_pixel, fill=255)
         
         self.mascara = np.array(mascara) > 0
+        self.cobertura = None
+        
+        if antialias:
+            self.cobertura = self._calcular_cobertura(width, height, supersampling)
+            self.mascara = self.cobertura > 0
+            print(f"✓ Máscara de cobertura: {self.cobertura.sum():,.2f} píxeles equivalentes "
+                  f"({supersampling}x{supersampling} muestras en bordes)")
+        
         pixels_poligono = np.sum(self.mascara)
         
         print(f"✓ Máscara creada: {pixels_poligono:,} píxeles dentro del polígono")
         return self.mascara
     
-    def descargar_capa_wms(self, nombre_capa, width=1200, height=1200):
-        """Descarga una imagen WMS de la capa especificada"""
+    def _calcular_cobertura(self, width, height, supersampling=4):
+        """
+        Calcula la fracción de cada píxel cubierta por el polígono.
+        
+        El interior se rasteriza con PIL usando coordenadas exactas; sólo los
+        píxeles de la banda del contorno se evalúan por supermuestreo con un
+        test punto-en-polígono vectorizado.
+        """
+        ancho_grados = self.bbox['maxx'] - self.bbox['minx']
+        alto_grados = self.bbox['maxy'] - self.bbox['miny']
+        vx = np.array([(lon - self.bbox['minx']) / ancho_grados * width for lon, _ in self.coordenadas])
+        vy = np.array([(self.bbox['maxy'] - lat) / alto_grados * height for _, lat in self.coordenadas])
+        vertices = list(zip(vx.tolist(), vy.tolist()))
+        
+        # Interior binario (centros de píxel) y banda de borde de 3 píxeles
+        img_interior = Image.new('L', (width, height), 0)
+        ImageDraw.Draw(img_interior).polygon(vertices, fill=255)
+        img_borde = Image.new('L', (width, height), 0)
+        ImageDraw.Draw(img_borde).line(vertices + [vertices[0]], fill=255, width=3)
+        
+        cobertura = (np.array(img_interior) > 0).astype(np.float32)
+        filas, cols = np.nonzero(np.array(img_borde))
+        if len(filas) == 0:
+            return cobertura
+        
+        # Posiciones de las muestras dentro de cada píxel del borde
+        offsets = (np.arange(supersampling) + 0.5) / supersampling
+        ox, oy = np.meshgrid(offsets, offsets)
+        px = cols[:, None] + ox.ravel()[None, :]
+        py = filas[:, None] + oy.ravel()[None, :]
+        
+        dentro = self._puntos_en_poligono(px.ravel(), py.ravel(), vx, vy)
+        fraccion = dentro.reshape(len(filas), -1).mean(axis=1)
+        cobertura[filas, cols] = fraccion
+        
+        return cobertura
+    
+    @staticmethod
+    def _puntos_en_poligono(px, py, vx, vy):
+        """Test par-impar vectorizado sobre todos los puntos a la vez"""
+        dentro = np.zeros(px.shape, dtype=bool)
+        x2, y2 = np.roll(vx, -1), np.roll(vy, -1)
+        
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for x_a, y_a, x_b, y_b in zip(vx, vy, x2, y2):
+                if y_a == y_b:
+                    continue
+                cruza = (y_a > py) != (y_b > py)
+                x_corte = x_a + (py - y_a) * (x_b - x_a) / (y_b - y_a)
+                dentro ^= cruza & (px < x_corte)
+        
+        return dentro
+    
+    def obtener_capa(self, nombre_capa, width=1200, height=1200, bbox=None):
+        """
+        Imagen de la capa sobre el bbox según su backend: 'wms' (por
+        defecto) o 'local' (GeoTIFF/COG en config['ruta'], relativa a
+        directorio_capas), que no necesita red y sólo lee los bloques bajo
+        la parcela.
+        """
+        config = self.capas[nombre_capa]
+        if config.get('backend', 'wms') == 'local':
+            return self.leer_capa_local(nombre_capa, width, height, bbox)
+        return self.descargar_capa_wms(nombre_capa, width, height, bbox)
+    
+    def leer_capa_local(self, nombre_capa, width=1200, height=1200, bbox=None):
+        """Lee la ventana del bbox de una capa raster local"""
         config = self.capas[nombre_capa]
+        bbox = bbox or self.bbox
+        ruta = resolver_ruta(config['ruta'], self.directorio_capas)
+        
+        try:
+            img = leer_ventana(ruta, bbox, width, height)
+            print(f"✓ Leída capa local: {nombre_capa} ({img.size[0]}x{img.size[1]})")
+            return img
+        except Exception as e:
+            print(f"✗ Error leyendo capa local {nombre_capa}: {e}")
+            return None
+    
+    def descargar_capa_wms(self, nombre_capa, width=1200, height=1200, bbox=None):
+        """Descarga una imagen WMS de la capa especificada (por defecto sobre self.bbox)"""
+        config = self.capas[nombre_capa]
+        bbox = bbox or self.bbox
         
         params = {
             'SERVICE': 'WMS',
-            'VERSION': '1.3.0',
+            'VERSION': config.get('version', '1.3.0'),
             'REQUEST': 'GetMap',
             'LAYERS': config['layer'],
-            'BBOX': f"{self.bbox['miny']},{self.bbox['minx']},{self.bbox['maxy']},{self.bbox['maxx']}",
-            'CRS': 'EPSG:4326',
+            **parametros_bbox(config, bbox),
             'WIDTH': width,
             'HEIGHT': height,
-            'FORMAT': 'image/png',
+            'FORMAT': config.get('formato', 'image/png'),
             'TRANSPARENT': 'TRUE',
             'STYLES': ''
         }
@@ -373,7 +575,16 @@ class AnalizadorAfeccionesAmbientales:
             response = requests.get(config['url'], params=params, timeout=30)
             response.raise_for_status()
             
+            # Si el servidor no admite PNG de 8 bits responde con una excepción XML
+            if (params['FORMAT'] != 'image/png' and
+                    not response.headers.get('Content-Type', '').startswith('image')):
+                params['FORMAT'] = 'image/png'
+                response = requests.get(config['url'], params=params, timeout=30)
+                response.raise_for_status()
+            
             img = Image.open(BytesIO(response.content))
+            # Huella para reutilizar el sondeo de teselas vacías ya vistas
+            img.info['sha1'] = huella_contenido(response.content)
             print(f"✓ Descargada capa: {nombre_capa} ({img.size[0]}x{img.size[1]})")
             return img
         
@@ -383,164 +594,858 @@ class AnalizadorAfeccionesAmbientales:
     
     def detectar_color_multiple(self, pixels, colores_posibles, tolerancia):
         """
-        Detecta píxeles que coincidan con cualquiera de los colores posibles
+        Detecta píxeles que coincidan con cualquiera de los colores posibles.
+        Acepta arrays (..., 3): imagen completa o lista de píxeles.
         """
-        mask_total = np.zeros(pixels.shape[:2], dtype=bool)
-        
-        for color in colores_posibles:
-            diferencias = np.abs(pixels - color)
-            mask_color = np.all(diferencias <= tolerancia, axis=2)
-            mask_total = mask_total | mask_color
-        
-        return mask_total
+        return self.distancia_colores(pixels, colores_posibles) <= tolerancia
+    
+    def distancia_colores(self, pixels, colores_posibles):
+        """
+        Distancia de cada píxel al color buscado más cercano, medida como
+        la mayor diferencia entre canales. Un píxel coincide con tolerancia
+        t si su distancia es <= t, así que un único mapa de distancias sirve
+        para cualquier tolerancia. Acepta arrays (..., 3) int16.
+        Los colores se compilan una vez por proceso (ver layer_registry).
+        """
+        return comparador_para(colores_posibles).distancias(pixels)
     
     def analizar_pixeles(self, imagen, nombre_capa):
         """
         Analiza los píxeles de la imagen usando máscara geométrica
-        y detectando múltiples variantes de color
+        y detectando múltiples variantes de color.
+        
+        Si existe máscara de cobertura (antialias), cada píxel cuenta con
+        su fracción de área dentro del polígono.
+        """
+        return self._analizar_pixeles(imagen, nombre_capa)[0]
+    
+    def _analizar_pixeles(self, imagen, nombre_capa):
+        """
+        Igual que analizar_pixeles, pero devuelve (analisis, afectados,
+        histograma): afectados es el vector booleano de los píxeles del
+        polígono afectados por la capa (un escalar si la imagen es uniforme)
+        e histograma cuenta los píxeles por distancia al color buscado.
         """
         if imagen is None:
-            return {'error': 'Imagen no disponible'}
+            return {'error': 'Imagen no disponible'}, None, None
         
         config = self.capas[nombre_capa]
         
-        # Convertir a RGB
-        if imagen.mode != 'RGB':
-            imagen = imagen.convert('RGB')
+        pesos = None
+        if self.mascara is not None and self.cobertura is not None:
+            pesos = self.cobertura[self.mascara]
         
-        # Obtener array de píxeles
-        pixels = np.array(imagen)
+        blancos, distancias, color_counts = self._clasificar(imagen, config)
+        pixels_afectados_mask = distancias <= config['tolerancia']
         
-        # Aplicar máscara del polígono
         if self.mascara is not None:
-            pixels_dentro = pixels[self.mascara]
-            total_pixels_poligono = len(pixels_dentro)
+            num_pixels = int(self.mascara.sum())
+        else:
+            num_pixels = imagen.size[0] * imagen.size[1]
+        
+        # Píxeles por distancia de color: da la afección para cualquier tolerancia
+        if np.ndim(distancias) == 0:
+            histograma = np.zeros(SIN_DISTANCIA + 1)
+            histograma[distancias] = num_pixels if pesos is None else pesos.sum()
         else:
-            pixels_dentro = pixels.reshape(-1, 3)
-            total_pixels_poligono = len(pixels_dentro)
+            histograma = np.bincount(distancias, weights=pesos, minlength=SIN_DISTANCIA + 1)
+        
+        def contar(seleccion=True):
+            if np.ndim(seleccion) == 0:
+                # Imagen uniforme: cuentan todos los píxeles o ninguno
+                if pesos is None:
+                    return num_pixels if seleccion else 0
+                return round(float(pesos.sum()), 2) if seleccion else 0.0
+            if pesos is None:
+                return int(np.sum(seleccion))
+            return round(float(pesos[seleccion].sum()), 2)
+        
+        total_pixels_poligono = contar()
         
-        # Detectar píxeles blancos/transparentes
-        blancos = np.all(pixels_dentro > 240, axis=0)
-        pixels_blancos = np.sum(blancos)
+        # Píxeles blancos/transparentes
+        pixels_blancos = contar(blancos)
         
         # Área útil (dentro del polígono, sin blancos)
         area_util = total_pixels_poligono - pixels_blancos
         
-        # Detectar píxeles afectados (con múltiples colores)
-        if self.mascara is not None:
-            # Crear una versión completa para análisis
-            pixels_full_masked = pixels.copy()
-            pixels_full_masked[~self.mascara] = [255, 255, 255]  # Blanquear fuera
-            pixels_afectados_mask = self.detectar_color_multiple(
-                pixels_full_masked, 
-                config['colores_posibles'], 
-                config['tolerancia']
-            )
-            pixels_afectados_mask = pixels_afectados_mask & self.mascara
-            num_afectados = np.sum(pixels_afectados_mask)
-        else:
-            pixels_reshaped = pixels_dentro.reshape(pixels.shape[0], pixels.shape[1], 3)
-            pixels_afectados_mask = self.detectar_color_multiple(
-                pixels_reshaped,
-                config['colores_posibles'],
-                config['tolerancia']
-            )
-            num_afectados = np.sum(pixels_afectados_mask)
+        # Píxeles afectados (con múltiples colores)
+        num_afectados = contar(pixels_afectados_mask)
         
         # Calcular porcentajes
-        if area_util == 0:
+        if area_util <= 0:
             porcentaje_afectacion = 0
             porcentaje_sobre_total = 0
         else:
             porcentaje_afectacion = (num_afectados / area_util) * 100
             porcentaje_sobre_total = (num_afectados / total_pixels_poligono) * 100
         
-        # Analizar colores únicos dentro del polígono
-        pixels_tuple = [tuple(p) for p in pixels_dentro]
-        color_counts = Counter(pixels_tuple)
+        # Colores más frecuentes dentro del polígono
         top_colores = color_counts.most_common(10)
         
         # Calcular superficie aproximada (si se conocen las dimensiones reales)
         superficie_ha = self._calcular_superficie_aproximada()
         superficie_afectada = (superficie_ha * porcentaje_afectacion / 100) if superficie_ha else None
         
-        return {
-            'total_pixels_poligono': int(total_pixels_poligono),
-            'pixels_blancos': int(pixels_blancos),
-            'area_util': int(area_util),
-            'pixels_afectados': int(num_afectados),
+        analisis = {
+            'total_pixels_poligono': total_pixels_poligono,
+            'pixels_blancos': pixels_blancos,
+            'area_util': round(area_util, 2) if pesos is not None else area_util,
+            'pixels_afectados': num_afectados,
             'porcentaje_afectacion': round(porcentaje_afectacion, 2),
             'porcentaje_sobre_total': round(porcentaje_sobre_total, 2),
             'colores_detectados': len(color_counts),
             'top_colores': [(color, count) for color, count in top_colores],
             'colores_buscados': config['colores_posibles'],
             'tolerancia_usada': config['tolerancia'],
+            'cobertura_fraccional': pesos is not None,
             'superficie_ha': superficie_ha,
             'superficie_afectada_ha': round(superficie_afectada, 4) if superficie_afectada else None
         }
+        
+        # Afección con la tolerancia ± MARGEN_SENSIBILIDAD
+        tolerancia = config['tolerancia']
+        banda = self._afeccion_por_tolerancia(
+            histograma, [max(0, tolerancia - MARGEN_SENSIBILIDAD), min(255, tolerancia + MARGEN_SENSIBILIDAD)],
+            area_util, total_pixels_poligono, pesos is not None
+        )
+        analisis['banda_sensibilidad'] = {
+            'tolerancia_min': banda[0]['tolerancia'],
+            'porcentaje_min': banda[0]['porcentaje_afectacion'],
+            'tolerancia_max': banda[1]['tolerancia'],
+            'porcentaje_max': banda[1]['porcentaje_afectacion']
+        }
+        
+        # Desglose por clases de la leyenda, si la capa tiene leyenda
+        clasificador = self._clasificador_leyenda(nombre_capa)
+        if clasificador:
+            analisis['clases_leyenda'] = clasificador.clasificar(
+                imagen, self.mascara, pesos, superficie_ha
+            )
+        
+        return analisis, pixels_afectados_mask, histograma
+    
+    def _clasificador_leyenda(self, nombre_capa):
+        """
+        Clasificador compilado de la leyenda de una capa: config['leyenda']
+        o leyenda_<capa>.csv en directorio_leyendas. None si no hay leyenda.
+        """
+        config = self.capas[nombre_capa]
+        ruta = config.get('leyenda')
+        if not ruta and self.directorio_leyendas:
+            ruta = os.path.join(self.directorio_leyendas, f"leyenda_{nombre_capa}.csv")
+        if not ruta or not os.path.exists(ruta):
+            return None
+        try:
+            return clasificador_para(ruta, config.get('tolerancia_leyenda', TOLERANCIA_LEYENDA))
+        except (OSError, ValueError) as e:
+            print(f"⚠ Leyenda no válida para {nombre_capa}: {e}")
+            return None
+    
+    def clasificar_por_leyenda(self, nombre_capa, leyenda, tolerancia=TOLERANCIA_LEYENDA):
+        """
+        Desglose por clases de una capa ya analizada con una leyenda
+        cualquiera (lista de registros con 'color' y 'etiqueta', p. ej. la
+        de IntersectionService.obtener_leyenda_local). Usa el raster ya
+        descargado: no repite la descarga.
+        """
+        datos = self.resultados.get(nombre_capa)
+        imagen = datos['imagen'] if datos else None
+        if imagen is None:
+            return None
+        
+        if not isinstance(leyenda, ClasificadorLeyenda):
+            leyenda = ClasificadorLeyenda(leyenda, tolerancia=tolerancia, nombre=nombre_capa)
+        
+        mascara, pesos = self._mascara_para(imagen)
+        return leyenda.clasificar(imagen, mascara, pesos, self._calcular_superficie_aproximada())
+    
+    def _mascara_para(self, imagen):
+        """
+        Máscara del polígono (y pesos de cobertura) para el tamaño de la
+        imagen; las capas resueltas en la pasada gruesa tienen otro tamaño.
+        """
+        if self.mascara is None:
+            return None, None
+        if self.mascara.shape == (imagen.height, imagen.width):
+            pesos = self.cobertura[self.mascara] if self.cobertura is not None else None
+            return self.mascara, pesos
+        mascara = np.array(Image.fromarray(self.mascara).resize(imagen.size, Image.NEAREST))
+        return mascara, None
+    
+    @staticmethod
+    def _afeccion_por_tolerancia(histograma, tolerancias, area_util, total, ponderado):
+        """Afección para cada tolerancia a partir del histograma de distancias"""
+        acumulado = np.cumsum(histograma)
+        resultados = []
+        for tolerancia in tolerancias:
+            afectados = float(acumulado[min(int(tolerancia), SIN_DISTANCIA - 1)])
+            afectados = round(afectados, 2) if ponderado else int(afectados)
+            resultados.append({
+                'tolerancia': int(tolerancia),
+                'pixels_afectados': afectados,
+                'porcentaje_afectacion': round(afectados / area_util * 100, 2) if area_util > 0 else 0,
+                'porcentaje_sobre_total': round(afectados / total * 100, 2) if area_util > 0 else 0
+            })
+        return resultados
+    
+    def barrido_tolerancias(self, nombre_capa, tolerancias=range(0, 101, 5)):
+        """
+        Afección de una capa ya analizada para una serie de tolerancias,
+        calculada con el histograma de distancias guardado (sin volver a
+        descargar ni recorrer la imagen). Sirve para calibrar la tolerancia
+        de cada capa.
+        """
+        datos = self.resultados.get(nombre_capa)
+        if not datos or datos.get('histograma') is None:
+            return []
+        analisis = datos['analisis']
+        return self._afeccion_por_tolerancia(
+            datos['histograma'], tolerancias, analisis['area_util'],
+            analisis['total_pixels_poligono'], analisis['cobertura_fraccional']
+        )
+    
+    def _seleccionar(self, array, mascara=None):
+        """Aplica la máscara (por defecto la del polígono) a un array (H, W, ...) y lo aplana"""
+        mascara = self.mascara if mascara is None else mascara
+        if mascara is not None:
+            return array[mascara]
+        return array.reshape(-1, *array.shape[2:])
+    
+    def _clasificar(self, imagen, config, mascara=None):
+        """
+        Clasifica los píxeles dentro del polígono eligiendo el método según
+        la imagen. Devuelve (blancos, distancias, Counter de colores), con
+        distancias = distancia de cada píxel al color buscado más cercano.
+        """
+        sondeo = sondear_imagen(imagen)
+        if sondeo is not None:
+            # Tesela vacía o de un solo color: no hace falta recorrer píxeles
+            return self._clasificar_uniforme(sondeo, config, mascara, imagen.size)
+        if imagen.mode == 'P':
+            # Imagen de paleta: se clasifican las (≤256) entradas una vez
+            # y cada píxel se resuelve con una búsqueda por índice
+            return self._clasificar_paleta(imagen, config, mascara)
+        return self._clasificar_rgb(imagen, config, mascara)
+    
+    def _clasificar_uniforme(self, sondeo, config, mascara, tamano):
+        """
+        Clasifica una imagen de un único color. blancos y distancias son
+        escalares (se aplican a todos los píxeles del polígono).
+        """
+        rgb, transparente = sondeo
+        if transparente:
+            return np.bool_(True), np.int16(SIN_DISTANCIA), Counter()
+        
+        color = np.array(rgb, dtype=np.int16)
+        blanco = np.all(color > 240)
+        distancia = self.distancia_colores(color, config['colores_posibles'])
+        
+        mascara = self.mascara if mascara is None else mascara
+        num_pixels = int(mascara.sum()) if mascara is not None else tamano[0] * tamano[1]
+        color_counts = Counter({tuple(int(c) for c in rgb): num_pixels}) if num_pixels else Counter()
+        
+        return np.bool_(blanco), distancia[()], color_counts
+    
+    def _clasificar_rgb(self, imagen, config, mascara=None):
+        """
+        Clasifica los píxeles RGB dentro del polígono.
+        Devuelve (blancos, distancias, Counter de colores).
+        """
+        transparentes = None
+        if imagen.mode in ('RGBA', 'LA', 'PA'):
+            transparentes = self._seleccionar(np.asarray(imagen.getchannel('A')), mascara) == 0
+        if imagen.mode != 'RGB':
+            imagen = imagen.convert('RGB')
+        
+        # int16 para poder restar colores
+        pixels_dentro = self._seleccionar(np.asarray(imagen), mascara).astype(np.int16)
+        
+        blancos = np.all(pixels_dentro > 240, axis=1)
+        distancias = self.distancia_colores(pixels_dentro, config['colores_posibles'])
+        
+        # Los píxeles transparentes no tienen dato: cuentan como blancos
+        if transparentes is not None:
+            blancos |= transparentes
+            distancias[transparentes] = SIN_DISTANCIA
+        
+        # Conteo de colores empaquetando RGB en un entero de 24 bits
+        empaquetados = (pixels_dentro[:, 0].astype(np.int32) << 16) | \
+                       (pixels_dentro[:, 1].astype(np.int32) << 8) | pixels_dentro[:, 2]
+        valores, cuentas = np.unique(empaquetados, return_counts=True)
+        color_counts = Counter({
+            (int(v >> 16), int((v >> 8) & 0xFF), int(v & 0xFF)): int(c)
+            for v, c in zip(valores, cuentas)
+        })
+        
+        return blancos, distancias, color_counts
+    
+    def _paleta_rgb(self, imagen):
+        """Paleta de una imagen 'P' como array (256, 3) int16"""
+        paleta = imagen.getpalette() or []
+        paleta = paleta[:768] + [0] * (768 - len(paleta[:768]))
+        return np.array(paleta, dtype=np.int16).reshape(256, 3)
+    
+    def _tablas_paleta(self, imagen, config):
+        """
+        Tablas de búsqueda (256,) de blancos y distancias de color para una
+        imagen 'P'. Las entradas transparentes de la paleta cuentan como
+        blancas y sin distancia.
+        """
+        paleta = self._paleta_rgb(imagen)
+        lut_blancos = np.all(paleta > 240, axis=1)
+        # Tabla compartida: la misma paleta sólo se compara una vez por proceso
+        lut_distancias = comparador_para(config['colores_posibles']).tabla_paleta(paleta)
+        
+        transparencia = imagen.info.get('transparency')
+        if isinstance(transparencia, int) and transparencia < 256:
+            lut_blancos[transparencia] = True
+            lut_distancias[transparencia] = SIN_DISTANCIA
+        elif isinstance(transparencia, bytes):
+            alfa = np.full(256, 255, dtype=np.uint8)
+            alfa[:len(transparencia)] = np.frombuffer(transparencia[:256], dtype=np.uint8)
+            lut_blancos |= alfa == 0
+            lut_distancias[alfa == 0] = SIN_DISTANCIA
+        
+        return paleta, lut_blancos, lut_distancias
     
-    def _calcular_superficie_aproximada(self):
+    def _clasificar_paleta(self, imagen, config, mascara=None):
+        """
+        Clasifica una imagen de paleta sin expandirla a RGB: las reglas de
+        color se evalúan sobre las entradas de la paleta y los píxeles se
+        resuelven con una tabla de búsqueda por índice.
+        """
+        paleta, lut_blancos, lut_distancias = self._tablas_paleta(imagen, config)
+        
+        indices = self._seleccionar(np.asarray(imagen), mascara)
+        
+        # Entradas distintas de la paleta pueden repetir color
+        cuentas = np.bincount(indices, minlength=256)
+        color_counts = Counter()
+        for indice in np.nonzero(cuentas)[0]:
+            color_counts[tuple(int(c) for c in paleta[indice])] += int(cuentas[indice])
+        
+        return lut_blancos[indices], lut_distancias[indices], color_counts
+    
+    def _calcular_superficie_aproximada(self, bbox=None):
         """Calcula superficie aproximada en hectáreas usando lat/lon"""
-        if not self.bbox:
+        bbox = bbox or self.bbox
+        if not bbox:
             return None
         
         # Aproximación simple (solo válida para áreas pequeñas)
-        lat_medio = (self.bbox['miny'] + self.bbox['maxy']) / 2
+        lat_medio = (bbox['miny'] + bbox['maxy']) / 2
         
         # Metros por grado a esta latitud
         m_por_grado_lon = 111320 * np.cos(np.radians(lat_medio))
         m_por_grado_lat = 110540
         
-        ancho_m = (self.bbox['maxx'] - self.bbox['minx']) * m_por_grado_lon
-        alto_m = (self.bbox['maxy'] - self.bbox['miny']) * m_por_grado_lat
+        ancho_m = (bbox['maxx'] - bbox['minx']) * m_por_grado_lon
+        alto_m = (bbox['maxy'] - bbox['miny']) * m_por_grado_lat
         
         area_m2 = ancho_m * alto_m
         area_ha = area_m2 / 10000
         
         return round(area_ha, 2)
     
-    def analizar_todas_capas(self, width=1200, height=1200):
-        """Analiza todas las capas ambientales disponibles"""
+    def analizar_todas_capas(self, width=1200, height=1200, antialias=False,
+                             progresivo=False, tam_inicial=256):
+        """
+        Analiza todas las capas ambientales disponibles.
+        
+        antialias=True pondera cada píxel por su cobertura fraccional, lo que
+        da precisión sub-píxel en parcelas pequeñas sin subir la resolución.
+        
+        progresivo=True descarga primero cada capa a tam_inicial píxeles; si
+        dentro de la parcela (más un píxel de margen) no hay ningún píxel
+        afectado, o lo están todos, el resultado ya es exacto y la capa no se
+        vuelve a descargar. Sólo las capas con píxeles mixtos se refinan a
+        la resolución completa.
+        """
         if not self.bbox:
             self.parsear_kml()
         
-        # Crear máscara del polígono
-        self.crear_mascara_poligono(width, height)
-        
         print("\n" + "="*70)
         print("INICIANDO ANÁLISIS DE AFECCIONES AMBIENTALES")
         print("="*70)
         
-        for nombre_capa in self.capas.keys():
+        # Máscara del polígono a resolución completa. Su huella entra en la
+        # clave de caché: la huella de la geometría no distingue orientación
+        # ni vértice inicial, y PIL no rellena igual un anillo invertido o rotado
+        self.crear_mascara_poligono(width, height, antialias=antialias)
+        
+        # Las capas ya analizadas para esta geometría salen de la caché
+        self._parametros_cache = {
+            'width': width, 'height': height, 'antialias': antialias,
+            'progresivo': progresivo, 'tam_inicial': tam_inicial if progresivo else None,
+            'mascara': self._huella_mascara()
+        }
+        pendientes = self._cargar_de_cache(list(self.capas.keys()))
+        
+        if progresivo and pendientes and max(width, height) > tam_inicial:
+            escala = tam_inicial / max(width, height)
+            w0 = max(1, round(width * escala))
+            h0 = max(1, round(height * escala))
+            num_capas = len(pendientes)
+            pendientes = self._analizar_pasada_gruesa(w0, h0, pendientes)
+            print(f"\n🔎 Pasada gruesa {w0}x{h0}: "
+                  f"{num_capas - len(pendientes)} capa(s) resueltas, "
+                  f"{len(pendientes)} a refinar")
+            # La pasada gruesa sustituye la máscara: volver a la completa
+            self.crear_mascara_poligono(width, height, antialias=antialias)
+        
+        for i, nombre_capa in enumerate(pendientes, 1):
             print(f"\n{'─'*70}")
             print(f"📡 {nombre_capa.replace('_', ' ').upper()}")
             print(f"{'─'*70}")
             
+            if self.progreso:
+                self.progreso('capa', None, f"Analizando {nombre_capa}",
+                              capa=nombre_capa, indice=i, total=len(pendientes))
+            
             # Descargar imagen
-            imagen = self.descargar_capa_wms(nombre_capa, width, height)
+            imagen = self.obtener_capa(nombre_capa, width, height)
             
             # Analizar píxeles
-            analisis = self.analizar_pixeles(imagen, nombre_capa)
+            analisis, afectados, histograma = self._analizar_pixeles(imagen, nombre_capa)
             
-            # Guardar resultados
-            self.resultados[nombre_capa] = {
-                'imagen': imagen,
-                'analisis': analisis
-            }
+            # Guardar resultados (el raster se vuelca a disco)
+            self._almacenar_resultado(nombre_capa, imagen, analisis, afectados, histograma)
+            del imagen
             
-            # Mostrar resultados
-            if 'error' not in analisis:
-                print(f"  Píxeles en polígono: {analisis['total_pixels_poligono']:,}")
-                print(f"  Área útil analizada: {analisis['area_util']:,} píxeles")
-                print(f"  Píxeles afectados: {analisis['pixels_afectados']:,}")
-                print(f"  🎯 AFECTACIÓN: {analisis['porcentaje_afectacion']}% (del área útil)")
-                print(f"  📊 Sobre total: {analisis['porcentaje_sobre_total']}%")
-                if analisis['superficie_afectada_ha']:
-                    print(f"  📐 Superficie afectada: ~{analisis['superficie_afectada_ha']} ha")
-                print(f"  Colores detectados: {analisis['colores_detectados']}")
-                print(f"  Tolerancia: ±{analisis['tolerancia_usada']} RGB")
+            self._mostrar_analisis(analisis)
+        
+        # Mismo orden de capas que la configuración, vengan de donde vengan
+        self.resultados = {n: self.resultados[n] for n in self.capas if n in self.resultados}
+    
+    def analizar_con_validacion(self, width=1200, height=1200, **opciones):
+        """
+        Ejecuta la validación con Catastro en paralelo con el análisis de
+        capas: las descargas WMS sólo necesitan el bbox del KML, así que no
+        esperan a las consultas de Catastro. Los datos catastrales se
+        incorporan al informe al final. Las opciones se pasan a
+        analizar_todas_capas.
+        """
+        if not self.bbox:
+            self.parsear_kml()
+        
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            validacion = executor.submit(self.validar_con_catastro)
+            try:
+                self.analizar_todas_capas(width, height, **opciones)
+            finally:
+                try:
+                    validacion.result()
+                except Exception as e:
+                    # La validación es opcional: el análisis sigue siendo válido
+                    print(f"⚠ Validación con Catastro fallida: {e}")
+    
+    def _analizar_pasada_gruesa(self, width, height, capas=None):
+        """
+        Analiza las capas a baja resolución y devuelve las que necesitan
+        refinarse (cobertura mixta o descarga fallida).
+        """
+        capas = list(self.capas.keys()) if capas is None else capas
+        self.crear_mascara_poligono(width, height)
+        if not self.mascara.any():
+            return capas
+        
+        # Margen de un píxel para que el borde no decida por aproximación
+        mascara_ampliada = self._dilatar(self.mascara)
+        pendientes = []
+        
+        for nombre_capa in capas:
+            config = self.capas[nombre_capa]
+            imagen = self.obtener_capa(nombre_capa, width, height)
+            if imagen is None:
+                pendientes.append(nombre_capa)
+                continue
+            
+            _, distancias, _ = self._clasificar(imagen, config, mascara_ampliada)
+            afectados = distancias <= config['tolerancia']
+            
+            if afectados.any() and not afectados.all():
+                pendientes.append(nombre_capa)
+                continue
+            
+            print(f"\n{'─'*70}")
+            print(f"📡 {nombre_capa.replace('_', ' ').upper()} "
+                  f"({'sin afección' if not afectados.any() else 'afección total'} a {width}x{height})")
+            print(f"{'─'*70}")
+            
+            analisis, _, histograma = self._analizar_pixeles(imagen, nombre_capa)
+            analisis['resolucion_analisis'] = [width, height]
+            # Sin afección o afección total: vale para cualquier resolución
+            self._almacenar_resultado(nombre_capa, imagen, analisis,
+                                      np.bool_(afectados.any()), histograma)
+            self._mostrar_analisis(analisis)
+        
+        return pendientes
+    
+    def _almacenar_resultado(self, nombre_capa, imagen, analisis, afectados=None, histograma=None):
+        """
+        Guarda el resultado compacto de una capa: el análisis, una
+        miniatura y los píxeles afectados empaquetados en bits quedan en
+        memoria; el raster completo se escribe en directorio_rasters y se
+        vuelve a abrir sólo cuando se necesita.
+        """
+        miniatura = None
+        ruta = None
+        if imagen is not None:
+            ruta = os.path.join(self._directorio_rasters(), f"{nombre_capa}.png")
+            imagen.save(ruta, 'PNG', compress_level=1)
+            
+            miniatura = imagen.copy()
+            miniatura.thumbnail(TAM_MINIATURA)
+        
+        self.resultados[nombre_capa] = ResultadoCapa(
+            analisis, miniatura, ruta, MascaraBits.desde(afectados), histograma
+        )
+        
+        if self.cache is not None and 'error' not in analisis:
+            try:
+                self.cache.guardar(self._clave_cache(nombre_capa), {
+                    'analisis': analisis,
+                    'miniatura': miniatura,
+                    'afectados': self.resultados[nombre_capa]['afectados'],
+                    'histograma': histograma
+                }, ruta)
+            except OSError as e:
+                print(f"⚠ No se pudo guardar {nombre_capa} en caché: {e}")
+    
+    def _directorio_rasters(self):
+        """Directorio de volcado de rasters (temporal, ligado al analizador, si no se indicó)"""
+        if not self.directorio_rasters:
+            self.directorio_rasters = tempfile.mkdtemp(prefix='afecciones_')
+            weakref.finalize(self, shutil.rmtree, self.directorio_rasters, True)
+        os.makedirs(self.directorio_rasters, exist_ok=True)
+        return self.directorio_rasters
+    
+    def huella_geometria(self):
+        """Huella canónica de la geometría analizada (ver services.analysis_cache)"""
+        return huella_geometria([[np.asarray(self.coordenadas)]])
+    
+    def _huella_mascara(self):
+        """Huella de la máscara actual (y de la cobertura, con antialias)"""
+        h = hashlib.sha256(repr(self.mascara.shape).encode())
+        h.update(np.packbits(self.mascara).tobytes())
+        if self.cobertura is not None:
+            h.update(np.ascontiguousarray(self.cobertura).tobytes())
+        return h.hexdigest()[:16]
+    
+    def _clave_cache(self, nombre_capa):
+        """Clave de caché: geometría, capa, versión de su configuración y resolución"""
+        config = self.capas[nombre_capa]
+        leyenda = None
+        ruta_leyenda = config.get('leyenda') or (
+            os.path.join(self.directorio_leyendas, f"leyenda_{nombre_capa}.csv")
+            if self.directorio_leyendas else None
+        )
+        if ruta_leyenda and os.path.exists(ruta_leyenda):
+            leyenda = [os.path.abspath(ruta_leyenda), os.path.getmtime(ruta_leyenda)]
+        
+        # Una capa local cambia con su archivo
+        raster = None
+        if config.get('backend') == 'local':
+            ruta = resolver_ruta(config['ruta'], self.directorio_capas)
+            raster = [os.path.abspath(ruta), os.path.getmtime(ruta) if os.path.exists(ruta) else None]
+        
+        return self.cache.clave(
+            self.huella_geometria(), nombre_capa,
+            # El TTL no cambia el resultado: no invalida las entradas
+            version_configuracion({k: v for k, v in config.items() if k != 'ttl'},
+                                  {'leyenda': leyenda, 'raster': raster}),
+            **(self._parametros_cache or {})
+        )
+    
+    def _cargar_de_cache(self, capas):
+        """
+        Recupera de la caché las capas ya analizadas con la misma geometría
+        y configuración. Devuelve las que quedan por calcular.
+        """
+        if self.cache is None:
+            return capas
+        
+        pendientes = []
+        for nombre_capa in capas:
+            entrada = self.cache.obtener(
+                self._clave_cache(nombre_capa), max_edad=self.capas[nombre_capa].get('ttl')
+            )
+            if entrada is None:
+                pendientes.append(nombre_capa)
+                continue
+            
+            datos, ruta_cache = entrada
+            afectados = datos['afectados']
+            if (isinstance(afectados, MascaraBits) and afectados.uniforme is None
+                    and afectados.num_pixels != int(np.count_nonzero(self.mascara))):
+                # Entrada de otra rasterización: se recalcula
+                pendientes.append(nombre_capa)
+                continue
+            
+            ruta = None
+            if ruta_cache:
+                # Copia propia del raster: la caché puede expulsar la entrada
+                ruta = os.path.join(self._directorio_rasters(), f"{nombre_capa}.png")
+                shutil.copyfile(ruta_cache, ruta)
+            
+            self.resultados[nombre_capa] = ResultadoCapa(
+                datos['analisis'], datos['miniatura'], ruta,
+                datos['afectados'], datos['histograma']
+            )
+            print(f"\n♻ {nombre_capa.replace('_', ' ').upper()}: resultado en caché")
+            self._mostrar_analisis(datos['analisis'])
+        
+        return pendientes
+    
+    @staticmethod
+    def _dilatar(mascara):
+        """Dilatación 3x3 de una máscara booleana"""
+        alto, ancho = mascara.shape
+        relleno = np.pad(mascara, 1)
+        resultado = np.zeros_like(mascara)
+        for dy in range(3):
+            for dx in range(3):
+                resultado |= relleno[dy:dy + alto, dx:dx + ancho]
+        return resultado
+    
+    def _mostrar_analisis(self, analisis):
+        """Imprime el resumen de una capa analizada"""
+        if 'error' not in analisis:
+            print(f"  Píxeles en polígono: {analisis['total_pixels_poligono']:,}")
+            print(f"  Área útil analizada: {analisis['area_util']:,} píxeles")
+            print(f"  Píxeles afectados: {analisis['pixels_afectados']:,}")
+            print(f"  🎯 AFECTACIÓN: {analisis['porcentaje_afectacion']}% (del área útil)")
+            print(f"  📊 Sobre total: {analisis['porcentaje_sobre_total']}%")
+            if analisis['superficie_afectada_ha']:
+                print(f"  📐 Superficie afectada: ~{analisis['superficie_afectada_ha']} ha")
+            print(f"  Colores detectados: {analisis['colores_detectados']}")
+            print(f"  Tolerancia: ±{analisis['tolerancia_usada']} RGB")
+        else:
+            print(f"  ✗ {analisis['error']}")
+    
+    def agrupar_poligonos(self, max_extension=0.05):
+        """
+        Agrupa los polígonos del lote en extents que no superen
+        max_extension grados por lado. Un lote compacto produce un único
+        grupo; polígonos muy dispersos se reparten en unos pocos grupos.
+        """
+        orden = sorted(
+            range(len(self.poligonos)),
+            key=lambda i: (self.poligonos[i]['bbox']['minx'], self.poligonos[i]['bbox']['miny'])
+        )
+        grupos = []
+        
+        for i in orden:
+            bbox_pol = self.poligonos[i]['bbox']
+            for grupo in grupos:
+                unido = self._unir_bbox([grupo['bbox'], bbox_pol])
+                if (unido['maxx'] - unido['minx'] <= max_extension and
+                        unido['maxy'] - unido['miny'] <= max_extension):
+                    grupo['bbox'] = unido
+                    grupo['indices'].append(i)
+                    break
+            else:
+                grupos.append({'bbox': dict(bbox_pol), 'indices': [i]})
+        
+        return grupos
+    
+    def crear_imagen_etiquetas(self, indices, bbox, width, height):
+        """
+        Rasteriza los polígonos indicados en una imagen de etiquetas:
+        0 = fuera de todo polígono, k = polígono indices[k-1].
+        Si dos polígonos se solapan prevalece el último dibujado.
+        """
+        etiquetas = Image.new('I', (width, height), 0)
+        draw = ImageDraw.Draw(etiquetas)
+        ancho_grados = bbox['maxx'] - bbox['minx']
+        alto_grados = bbox['maxy'] - bbox['miny']
+        
+        for etiqueta, i in enumerate(indices, 1):
+            coords_pixel = [
+                (int((lon - bbox['minx']) / ancho_grados * width),
+                 int((bbox['maxy'] - lat) / alto_grados * height))
+                for lon, lat in self.poligonos[i]['coordenadas']
+            ]
+            draw.polygon(coords_pixel, fill=etiqueta)
+        
+        return np.array(etiquetas, dtype=np.int32)
+    
+    def analizar_zonas(self, imagen, nombre_capa, etiquetas, num_zonas):
+        """
+        Cuenta, para todas las zonas de la imagen de etiquetas a la vez,
+        píxeles totales, blancos y afectados mediante np.bincount.
+        Devuelve arrays indexados por etiqueta (posición 0 = exterior).
+        """
+        config = self.capas[nombre_capa]
+        planas = etiquetas.ravel()
+        minlength = num_zonas + 1
+        totales = np.bincount(planas, minlength=minlength)
+        
+        sondeo = sondear_imagen(imagen)
+        if sondeo is not None:
+            # Tesela uniforme: todas las zonas tienen la misma clase
+            blanco, distancia, _ = self._clasificar_uniforme(sondeo, config, None, imagen.size)
+            afectado = distancia <= config['tolerancia']
+            ceros = np.zeros(minlength, dtype=np.int64)
+            return totales, (totales if blanco else ceros), (totales if afectado else ceros)
+        
+        if imagen.mode == 'P':
+            indices = np.asarray(imagen)
+            _, lut_blancos, lut_distancias = self._tablas_paleta(imagen, config)
+            afectados = (lut_distancias <= config['tolerancia'])[indices]
+            blancos = lut_blancos[indices]
+        else:
+            transparentes = None
+            if imagen.mode in ('RGBA', 'LA', 'PA'):
+                transparentes = np.asarray(imagen.getchannel('A')) == 0
+            if imagen.mode != 'RGB':
+                imagen = imagen.convert('RGB')
+            pixels = np.array(imagen).astype(np.int16)
+            
+            afectados = self.detectar_color_multiple(
+                pixels, config['colores_posibles'], config['tolerancia']
+            )
+            blancos = np.all(pixels > 240, axis=2)
+            if transparentes is not None:
+                blancos |= transparentes
+                afectados &= ~transparentes
+        
+        num_blancos = np.bincount(planas, weights=blancos.ravel(), minlength=minlength)
+        num_afectados = np.bincount(planas, weights=afectados.ravel(), minlength=minlength)
+        
+        return totales, num_blancos.astype(np.int64), num_afectados.astype(np.int64)
+    
+    def analizar_lote(self, width=1000, height=1000, max_extension=0.05):
+        """
+        Analiza todos los polígonos del KML compartiendo descargas: cada capa
+        se descarga una sola vez por grupo de polígonos y los conteos por
+        polígono se obtienen en una única pasada vectorizada.
+        """
+        if not self.poligonos:
+            self.parsear_kml_lote()
+        
+        grupos = self.agrupar_poligonos(max_extension)
+        
+        print("\n" + "="*70)
+        print(f"ANÁLISIS POR LOTES: {len(self.poligonos)} polígonos en {len(grupos)} extent(s)")
+        print("="*70)
+        
+        resultados = [
+            {'nombre': p['nombre'], 'bbox': p['bbox'],
+             'superficie_ha': self._calcular_superficie_aproximada(p['bbox']),
+             'afecciones': {}}
+            for p in self.poligonos
+        ]
+        
+        for num_grupo, grupo in enumerate(grupos, 1):
+            indices = grupo['indices']
+            print(f"\n📦 Grupo {num_grupo}/{len(grupos)}: {len(indices)} polígonos")
+            etiquetas = self.crear_imagen_etiquetas(indices, grupo['bbox'], width, height)
+            
+            for nombre_capa in self.capas.keys():
+                imagen = self.obtener_capa(nombre_capa, width, height, bbox=grupo['bbox'])
+                
+                if imagen is None:
+                    for i in indices:
+                        resultados[i]['afecciones'][nombre_capa] = {'error': 'Imagen no disponible'}
+                    continue
+                
+                totales, blancos, afectados = self.analizar_zonas(
+                    imagen, nombre_capa, etiquetas, len(indices)
+                )
+                
+                for etiqueta, i in enumerate(indices, 1):
+                    total = int(totales[etiqueta])
+                    area_util = total - int(blancos[etiqueta])
+                    num_afectados = int(afectados[etiqueta])
+                    
+                    if total == 0:
+                        resultados[i]['afecciones'][nombre_capa] = {
+                            'error': 'Polígono sin píxeles a esta resolución'
+                        }
+                        continue
+                    
+                    porcentaje = (num_afectados / area_util * 100) if area_util > 0 else 0
+                    superficie_ha = resultados[i]['superficie_ha']
+                    resultados[i]['afecciones'][nombre_capa] = {
+                        'total_pixels_poligono': total,
+                        'pixels_blancos': int(blancos[etiqueta]),
+                        'area_util': area_util,
+                        'pixels_afectados': num_afectados,
+                        'porcentaje_afectacion': round(porcentaje, 2),
+                        'porcentaje_sobre_total': round(num_afectados / total * 100, 2),
+                        'superficie_afectada_ha': round(superficie_ha * porcentaje / 100, 4) if superficie_ha else None
+                    }
+        
+        self.resultados_lote = resultados
+        print(f"\n✓ Lote analizado: {len(resultados)} polígonos")
+        return resultados
+    
+    def estadisticas_combinadas(self, capas=None):
+        """
+        Afección combinada de varias capas a partir de las máscaras de bits
+        guardadas en el análisis (sin nuevas descargas):
+        
+        - union: píxeles afectados por al menos una capa
+        - interseccion: píxeles afectados por todas las capas
+        - exclusivas: por capa, píxeles afectados sólo por esa capa
+        - pares: intersección de cada par de capas
+        
+        Los porcentajes son sobre el total del polígono. Con cobertura
+        fraccional (antialias) cada píxel pondera por su área.
+        """
+        if self.mascara is None:
+            return None
+        
+        disponibles = [n for n, d in self.resultados.items() if d.get('afectados') is not None]
+        capas = [n for n in (capas or disponibles) if n in disponibles]
+        if not capas:
+            return None
+        
+        num_pixels = int(np.count_nonzero(self.mascara))
+        bits = {nombre: self.resultados[nombre]['afectados'].empaquetar(num_pixels) for nombre in capas}
+        
+        pesos = None
+        if self.cobertura is not None:
+            pesos = self.cobertura[self.mascara]
+        total = float(pesos.sum()) if pesos is not None else num_pixels
+        superficie_ha = self._calcular_superficie_aproximada()
+        
+        def medir(combinados):
+            if pesos is None:
+                pixels = _popcount(combinados)
             else:
-                print(f"  ✗ {analisis['error']}")
+                seleccion = np.unpackbits(combinados, count=num_pixels).astype(bool)
+                pixels = round(float(pesos[seleccion].sum()), 2)
+            fraccion = pixels / total if total else 0
+            return {
+                'pixels': pixels,
+                'porcentaje': round(fraccion * 100, 2),
+                'superficie_ha': round(float(superficie_ha * fraccion), 4) if superficie_ha else None
+            }
+        
+        union = np.bitwise_or.reduce(list(bits.values()))
+        interseccion = np.bitwise_and.reduce(list(bits.values()))
+        
+        exclusivas = {}
+        for nombre in capas:
+            otras = [bits[n] for n in capas if n != nombre]
+            resto = np.bitwise_or.reduce(otras) if otras else np.zeros_like(bits[nombre])
+            exclusivas[nombre] = medir(bits[nombre] & ~resto)
+        
+        pares = {}
+        for i, a in enumerate(capas):
+            for b in capas[i + 1:]:
+                pares[f"{a}+{b}"] = medir(bits[a] & bits[b])
+        
+        return {
+            'capas': capas,
+            'total_pixels_poligono': round(total, 2) if pesos is not None else total,
+            'union': medir(union),
+            'interseccion': medir(interseccion),
+            'exclusivas': exclusivas,
+            'pares': pares
+        }
     
     def clasificar_afectacion(self, porcentaje):
         """Clasifica el nivel de afectación"""
@@ -638,16 +1543,19 @@ class AnalizadorAfeccionesAmbientales:
         
         # Guardar imágenes de capas
         for nombre_capa, datos in self.resultados.items():
-            if datos['imagen']:
+            if datos.ruta:
+                # El raster ya está en disco: se copia sin recodificar
                 ruta = os.path.join(directorio, f"{nombre_capa}.png")
-                datos['imagen'].save(ruta)
+                if os.path.abspath(ruta) != os.path.abspath(datos.ruta):
+                    shutil.copyfile(datos.ruta, ruta)
                 print(f"✓ Guardada: {ruta}")
                 
                 # Guardar versión con máscara aplicada
                 if self.mascara is not None:
-                    img_masked = datos['imagen'].copy()
+                    img_masked = datos['imagen'].convert('RGBA')
+                    mascara, _ = self._mascara_para(img_masked)
                     pixels = np.array(img_masked)
-                    pixels[~self.mascara] = [255, 255, 255, 0]
+                    pixels[~mascara] = [255, 255, 255, 0]
                     img_masked = Image.fromarray(pixels)
                     ruta_masked = os.path.join(directorio, f"{nombre_capa}_masked.png")
                     img_masked.save(ruta_masked)
@@ -671,32 +1579,81 @@ class AnalizadorAfeccionesAmbientales:
                 analisis.pop('top_colores', None)  # Simplificar
                 datos_export['afecciones'][nombre] = analisis
         
+        datos_export['afeccion_combinada'] = self.estadisticas_combinadas()
+        
         with open(archivo, 'w', encoding='utf-8') as f:
             json.dump(datos_export, f, indent=2, ensure_ascii=False)
         
         print(f"\n✓ Datos exportados a: {archivo}")
     
+    def exportar_json_lote(self, archivo='informe_afecciones_lote.json'):
+        """Exporta los resultados del análisis por lotes a JSON"""
+        datos_export = {
+            'archivo_kml': self.kml_path,
+            'fecha_analisis': datetime.now().isoformat(),
+            'bbox': self.bbox,
+            'total_poligonos': len(self.resultados_lote),
+            'poligonos': self.resultados_lote
+        }
+        
+        with open(archivo, 'w', encoding='utf-8') as f:
+            json.dump(datos_export, f, indent=2, ensure_ascii=False)
+        
+        print(f"\n✓ Lote exportado a: {archivo}")
+    
+    def guardar_estado(self, ruta):
+        """Serializa el analizador para generar el PDF más tarde o en otro proceso"""
+        with open(ruta, 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+    
+    @classmethod
+    def cargar_estado(cls, ruta):
+        """Recupera un analizador guardado con guardar_estado"""
+        with open(ruta, 'rb') as f:
+            return pickle.load(f)
+    
+    def _paginas_pdf(self):
+        """Lista ordenada de páginas del informe"""
+        paginas = [('portada',), ('resumen',)]
+        for nombre_capa, datos in self.resultados.items():
+            if 'error' not in datos['analisis']:
+                paginas.append(('capa', nombre_capa))
+        paginas.append(('comparativo',))
+        return paginas
+    
+    def _renderizar_pagina(self, pdf, pagina):
+        """Dibuja una página del informe sobre `pdf`"""
+        tipo = pagina[0]
+        if tipo == 'portada':
+            self._generar_portada(pdf)
+        elif tipo == 'resumen':
+            self._generar_resumen_grafico(pdf)
+        elif tipo == 'capa':
+            self._generar_pagina_capa(pdf, pagina[1], self.resultados[pagina[1]])
+        elif tipo == 'comparativo':
+            self._generar_mapa_comparativo(pdf)
+    
     def generar_pdf(self, archivo='informe_afecciones.pdf'):
-        """Genera un informe completo en PDF con gráficos"""
+        """
+        Genera un informe completo en PDF con gráficos.
+        
+        El PDF se escribe en un temporal y se renombra al final, así nunca
+        queda a medias.
+        """
         print(f"\n📄 Generando informe PDF...")
         
         # Configurar matplotlib para español
         plt.rcParams['font.family'] = 'DejaVu Sans'
         
-        with PdfPages(archivo) as pdf:
-            # PÁGINA 1: Portada
-            self._generar_portada(pdf)
-            
-            # PÁGINA 2: Resumen ejecutivo con gráficos
-            self._generar_resumen_grafico(pdf)
-            
-            # PÁGINAS 3+: Detalles por capa
-            for nombre_capa, datos in self.resultados.items():
-                if 'error' not in datos['analisis']:
-                    self._generar_pagina_capa(pdf, nombre_capa, datos)
+        directorio = os.path.dirname(os.path.abspath(archivo))
+        
+        with tempfile.TemporaryDirectory(dir=directorio) as tmp:
+            archivo_tmp = os.path.join(tmp, 'informe.pdf')
+            with PdfPages(archivo_tmp) as pdf:
+                for pagina in self._paginas_pdf():
+                    self._renderizar_pagina(pdf, pagina)
             
-            # ÚLTIMA PÁGINA: Mapa de calor
-            self._generar_mapa_comparativo(pdf)
+            os.replace(archivo_tmp, archivo)
         
         print(f"✅ PDF generado: {archivo}")
     
@@ -990,7 +1947,7 @@ class AnalizadorAfeccionesAmbientales:
         fig = plt.figure(figsize=(8.27, 11.69))
         fig.suptitle('COMPARATIVA VISUAL DE CAPAS', fontsize=16, fontweight='bold', y=0.98)
         
-        num_capas = len([d for d in self.resultados.values() if d['imagen']])
+        num_capas = len([d for d in self.resultados.values() if d['miniatura']])
         
         if num_capas == 0:
             plt.close()
@@ -1000,9 +1957,9 @@ class AnalizadorAfeccionesAmbientales:
         rows = (num_capas + 1) // 2
         
         for i, (nombre, datos) in enumerate(self.resultados.items(), 1):
-            if datos['imagen']:
+            if datos['miniatura']:
                 ax = plt.subplot(rows, cols, i)
-                ax.imshow(np.array(datos['imagen']))
+                ax.imshow(np.array(datos['miniatura']))
                 
                 titulo = nombre.replace('_', ' ').title()
                 porc = datos['analisis']['porcentaje_afectacion']
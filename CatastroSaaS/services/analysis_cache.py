@@ -0,0 +1,196 @@
+"""
+Caché en disco de resultados de análisis por capa.
+
+Cada entrada se identifica por (huella canónica de la geometría, capa,
+versión de la configuración de la capa, parámetros de resolución). La
+huella no depende del sentido de los anillos, del vértice inicial ni de
+diferencias por debajo de la precisión de coordenadas, así que volver a
+subir el mismo KML (o uno equivalente) reutiliza el análisis, y añadir
+una capa nueva sólo calcula esa capa.
+"""
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+# Decimales de grado conservados al normalizar (1e-7° ≈ 1 cm)
+DECIMALES_GEOMETRIA = 7
+
+# Se incrementa cuando cambia el cálculo y los resultados guardados dejan de valer
+VERSION_ANALISIS = 1
+
+MAX_ENTRADAS = 5_000
+
+# Cada cuántas escrituras se comprueba el tamaño de la caché
+INTERVALO_RECORTE = 100
+
+
+def _anillo_canonico(anillo, decimales, antihorario):
+    """Anillo redondeado, sin cierre ni duplicados, orientado y empezando en su menor vértice"""
+    puntos = np.round(np.asarray(anillo, dtype=np.float64)[:, :2] * 10 ** decimales).astype(np.int64)
+
+    # Quitar vértices repetidos consecutivos y el de cierre
+    if len(puntos) > 1:
+        distintos = np.any(puntos != np.roll(puntos, 1, axis=0), axis=1)
+        distintos[0] = True
+        puntos = puntos[distintos]
+        if len(puntos) > 1 and np.array_equal(puntos[0], puntos[-1]):
+            puntos = puntos[:-1]
+    if len(puntos) < 3:
+        return puntos
+
+    # Orientación por el signo del área (fórmula del lazo)
+    x = puntos[:, 0].astype(np.float64)
+    y = puntos[:, 1].astype(np.float64)
+    area = np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1))
+    if (area > 0) != antihorario:
+        puntos = puntos[::-1]
+
+    # Empezar por el menor vértice (x, y)
+    inicio = np.lexsort((puntos[:, 1], puntos[:, 0]))[0]
+    return np.roll(puntos, -inicio, axis=0)
+
+
+def huella_geometria(poligonos, decimales=DECIMALES_GEOMETRIA):
+    """
+    Huella sha256 canónica de una lista de polígonos (cada uno, lista de
+    anillos con el exterior primero). Exteriores en sentido antihorario,
+    huecos en horario; huecos y polígonos se ordenan para que el orden en
+    el archivo tampoco cuente.
+    """
+    canonicos = []
+    for anillos in poligonos:
+        if not len(anillos):
+            continue
+        exterior = _anillo_canonico(anillos[0], decimales, True).tobytes()
+        huecos = sorted(_anillo_canonico(a, decimales, False).tobytes() for a in anillos[1:])
+        canonicos.append(b'|'.join([exterior] + huecos))
+
+    resumen = hashlib.sha256()
+    resumen.update(f"d{decimales}".encode())
+    for poligono in sorted(canonicos):
+        resumen.update(b'#')
+        resumen.update(poligono)
+    return resumen.hexdigest()
+
+
+def version_configuracion(config, extra=None):
+    """Huella corta de la configuración de una capa (url, colores, tolerancia...)"""
+    contenido = json.dumps(
+        {'config': config, 'extra': extra, 'version': VERSION_ANALISIS},
+        sort_keys=True, default=str
+    )
+    return hashlib.sha1(contenido.encode('utf-8')).hexdigest()[:16]
+
+
+class CacheAnalisis:
+    """
+    Resultados por capa en disco: <clave>.pkl con el análisis compacto y
+    <clave>.png con el raster. Las escrituras son atómicas (os.replace) y,
+    al superar max_entradas, se eliminan las menos usadas recientemente.
+    La fecha de modificación del .pkl es la de escritura (para el TTL) y
+    la de acceso, la del último uso (para la expulsión).
+    """
+
+    def __init__(self, directorio, max_entradas=MAX_ENTRADAS):
+        self.directorio = str(directorio)
+        self.max_entradas = max_entradas
+        self._lock = threading.Lock()
+        self._escrituras = 0
+        os.makedirs(self.directorio, exist_ok=True)
+
+    def __getstate__(self):
+        # Se serializa con el analizador (guardar_estado): sin el lock
+        return {'directorio': self.directorio, 'max_entradas': self.max_entradas}
+
+    def __setstate__(self, estado):
+        self.__init__(estado['directorio'], estado['max_entradas'])
+
+    @staticmethod
+    def clave(huella, nombre_capa, version, **parametros):
+        partes = [huella, nombre_capa, version] + [f"{k}={parametros[k]}" for k in sorted(parametros)]
+        return hashlib.sha256('|'.join(map(str, partes)).encode('utf-8')).hexdigest()
+
+    def _rutas(self, clave):
+        base = os.path.join(self.directorio, clave[:2], clave)
+        return base + '.pkl', base + '.png'
+
+    def obtener(self, clave, max_edad=None):
+        """
+        Devuelve (datos, ruta_raster o None) o None si no hay entrada o si
+        tiene más de max_edad segundos
+        """
+        ruta_datos, ruta_raster = self._rutas(clave)
+        try:
+            escrito = os.path.getmtime(ruta_datos)
+            if max_edad and time.time() - escrito > max_edad:
+                return None
+            with open(ruta_datos, 'rb') as f:
+                datos = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        # Marca de uso para la expulsión LRU (conserva la fecha de escritura)
+        try:
+            os.utime(ruta_datos, (time.time(), escrito))
+        except OSError:
+            pass
+        return datos, (ruta_raster if os.path.exists(ruta_raster) else None)
+
+    def guardar(self, clave, datos, ruta_raster=None):
+        ruta_datos, ruta_png = self._rutas(clave)
+        os.makedirs(os.path.dirname(ruta_datos), exist_ok=True)
+
+        if ruta_raster:
+            def copiar(destino):
+                with open(ruta_raster, 'rb') as origen:
+                    shutil.copyfileobj(origen, destino)
+            self._escribir_atomico(ruta_png, copiar)
+        # Los datos se escriben al final: una entrada sin .pkl no existe
+        self._escribir_atomico(
+            ruta_datos, lambda f: pickle.dump(datos, f, protocol=pickle.HIGHEST_PROTOCOL)
+        )
+
+        with self._lock:
+            self._escrituras += 1
+            recortar = self._escrituras % INTERVALO_RECORTE == 1
+        if recortar:
+            self._recortar()
+
+    def _escribir_atomico(self, ruta, escribir):
+        fd, temporal = tempfile.mkstemp(dir=os.path.dirname(ruta), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                escribir(f)
+            os.replace(temporal, ruta)
+        except BaseException:
+            if os.path.exists(temporal):
+                os.remove(temporal)
+            raise
+
+    def _recortar(self):
+        """Elimina las entradas menos usadas si se supera max_entradas"""
+        with self._lock:
+            entradas = []
+            for raiz, _, archivos in os.walk(self.directorio):
+                for nombre in archivos:
+                    if nombre.endswith('.pkl'):
+                        ruta = os.path.join(raiz, nombre)
+                        try:
+                            entradas.append((os.path.getatime(ruta), ruta))
+                        except OSError:
+                            pass
+            if len(entradas) <= self.max_entradas:
+                return
+            entradas.sort()
+            for _, ruta in entradas[:len(entradas) - self.max_entradas]:
+                for ruta_borrar in (ruta, ruta[:-4] + '.png'):
+                    try:
+                        os.remove(ruta_borrar)
+                    except OSError:
+                        pass
@@ -0,0 +1,236 @@
+"""
+Trabajos de análisis de afecciones ejecutados fuera del proceso de la API.
+
+El router guarda la subida en la carpeta del trabajo (dentro de
+settings.ANALYSIS_DIR, fuera de static) y encola aquí la ejecución en un
+ProcessPoolExecutor propio. El estado se guarda en
+<carpeta>/estado.json, de modo que cualquier worker de la API puede
+responder a las consultas de estado y de resultado.
+
+Estados: en_cola -> procesando -> completado | error
+
+Los trabajos viven en el ejecutor del proceso de la API que los encoló
+(estado.json guarda "host:pid" en `propietario`). Si ese proceso muere,
+el trabajo quedaría en cola o en curso para siempre: trabajos_huerfanos
+los localiza al arrancar y caducado los detecta al consultarlos.
+"""
+import json
+import os
+import socket
+import tempfile
+import time
+import traceback
+from pathlib import Path
+
+from services import layer_registry
+from services.advanced_analysis import AnalizadorAfeccionesAmbientales
+from services.analysis_cache import CacheAnalisis
+from services.job_events import EmisorProgreso, COMPLETADO as EVENTO_COMPLETADO, ERROR as EVENTO_ERROR
+
+ESTADO_JOB = "estado.json"
+INFORME_JSON = "informe.json"
+INFORME_LOTE_JSON = "informe_lote.json"
+PDF_FILENAME = "informe_completo.pdf"
+ESTADO_FILENAME = "estado_analisis.pkl"
+
+EN_COLA = "en_cola"
+PROCESANDO = "procesando"
+COMPLETADO = "completado"
+ERROR = "error"
+
+# Caché de resultados por capa de cada proceso de análisis
+_cache_analisis = None
+
+# Carpeta de los eventos de progreso (services/job_events.py)
+_directorio_eventos = "job_events"
+
+
+def inicializar_worker(ruta_registro=None, directorio_cache="cache_analysis",
+                       directorio_eventos="job_events"):
+    """Inicializador de los procesos del ejecutor"""
+    global _cache_analisis, _directorio_eventos
+    layer_registry.configurar(ruta_registro)
+    _cache_analisis = CacheAnalisis(Path(directorio_cache))
+    _directorio_eventos = directorio_eventos
+
+
+def escribir_estado(job_dir, estado, **campos):
+    """
+    Actualiza estado.json de forma atómica conservando los campos previos
+    (usuario, fechas, parámetros).
+    """
+    job_dir = Path(job_dir)
+    datos = leer_estado(job_dir) or {}
+    ahora = time.time()
+    datos.setdefault("creado", ahora)
+    datos.update(campos)
+    datos["estado"] = estado
+    datos["actualizado"] = ahora
+
+    fd, temporal = tempfile.mkstemp(dir=job_dir, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(datos, f, ensure_ascii=False)
+        os.replace(temporal, job_dir / ESTADO_JOB)
+    except BaseException:
+        if os.path.exists(temporal):
+            os.remove(temporal)
+        raise
+    return datos
+
+
+def leer_estado(job_dir):
+    """Contenido de estado.json o None si el trabajo no existe"""
+    try:
+        with open(Path(job_dir) / ESTADO_JOB, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def proceso_actual():
+    """Identificador del proceso que encola los trabajos (como worker.py)"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _proceso_vivo(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def propietario_vivo(estado):
+    """True si el proceso que encoló el trabajo es de este host y sigue vivo"""
+    propietario = estado.get("propietario")
+    if not propietario:
+        return False
+    host, pid_actual = proceso_actual().rsplit(":", 1)
+    host_job, _, pid = propietario.rpartition(":")
+    return host_job == host and (pid == pid_actual or _proceso_vivo(int(pid)))
+
+
+def caducado(estado, max_segundos):
+    """True si el trabajo lleva más de max_segundos en cola o en curso"""
+    if estado.get("estado") not in (EN_COLA, PROCESANDO):
+        return False
+    desde = estado.get("inicio") or estado.get("creado") or 0
+    return time.time() - desde > max_segundos
+
+
+def trabajos_huerfanos(directorio, max_segundos):
+    """
+    Carpetas de los trabajos en cola o en curso cuyo proceso ya no existe:
+    los de este host cuyo pid no está vivo (o es el del proceso actual,
+    que acaba de arrancar y aún no ha encolado nada) y los caducados. Los
+    de otros hosts sólo se detectan por caducidad.
+    """
+    host, pid_actual = proceso_actual().rsplit(":", 1)
+    try:
+        carpetas = [Path(e.path) for e in os.scandir(directorio) if e.is_dir()]
+    except OSError:
+        return []
+    huerfanos = []
+    for job_dir in carpetas:
+        estado = leer_estado(job_dir)
+        if not estado or estado.get("estado") not in (EN_COLA, PROCESANDO):
+            continue
+        propietario = estado.get("propietario")
+        if propietario:
+            host_job, _, pid = propietario.rpartition(":")
+            perdido = host_job == host and (pid == pid_actual or not _proceso_vivo(int(pid)))
+        else:
+            perdido = True  # Encolado por una versión anterior
+        if perdido or caducado(estado, max_segundos):
+            huerfanos.append(job_dir)
+    return huerfanos
+
+
+def _preparar_analizador(kml_path, job_dir, directorio_leyendas, directorio_capas):
+    analizador = AnalizadorAfeccionesAmbientales(str(kml_path))
+    analizador.directorio_rasters = str(Path(job_dir) / "imagenes")
+    analizador.directorio_leyendas = directorio_leyendas
+    analizador.directorio_capas = directorio_capas
+    analizador.cache = _cache_analisis
+    return analizador
+
+
+def _descartado(job_dir):
+    """
+    True si el trabajo ya se dio por fallido (caducado mientras estaba en
+    cola o en curso): su estado y su evento final no se sobrescriben.
+    """
+    estado = leer_estado(job_dir)
+    if estado and estado.get("estado") == ERROR:
+        print(f"⚠ Análisis {job_dir.name} ya marcado como error: se descarta")
+        return True
+    return False
+
+
+def ejecutar_analisis_kml(job_dir, kml_name, antialias=False, progresivo=False,
+                          directorio_leyendas=None, directorio_capas=None):
+    """
+    Análisis completo de una parcela: capas, validación con Catastro,
+    imágenes, JSON y PDF. Se ejecuta en un proceso del ejecutor.
+    """
+    job_dir = Path(job_dir)
+    progreso = EmisorProgreso(_directorio_eventos, job_dir.name)
+    if _descartado(job_dir):
+        return False
+    escribir_estado(job_dir, PROCESANDO, inicio=time.time())
+    try:
+        progreso("parseo", 5, "Leyendo la geometría")
+        analizador = _preparar_analizador(
+            job_dir / kml_name, job_dir, directorio_leyendas, directorio_capas
+        )
+        analizador.parsear_kml()
+
+        # Validación con Catastro (referencia oficial) en paralelo con las capas
+        progreso("capas", 10, "Analizando capas ambientales")
+        analizador.progreso = progreso
+        analizador.analizar_con_validacion(
+            width=1000, height=1000, antialias=antialias, progresivo=progresivo
+        )
+        analizador.progreso = None
+
+        progreso("imagenes", 75, "Guardando imágenes")
+        analizador.guardar_imagenes(analizador.directorio_rasters)
+        progreso("informe", 90, "Exportando resultados")
+        analizador.exportar_json(str(job_dir / INFORME_JSON))
+        analizador.guardar_estado(str(job_dir / ESTADO_FILENAME))
+
+        if _descartado(job_dir):
+            return False
+        # El resultado ya está disponible; el PDF se genera a continuación
+        escribir_estado(job_dir, COMPLETADO, fin=time.time())
+        progreso.terminar(EVENTO_COMPLETADO, "Análisis completado")
+    except Exception as e:
+        traceback.print_exc()
+        if not _descartado(job_dir):
+            escribir_estado(job_dir, ERROR, error=str(e), fin=time.time())
+            progreso.terminar(EVENTO_ERROR, str(e))
+        return False
+
+    try:
+        analizador.generar_pdf(str(job_dir / PDF_FILENAME))
+    except Exception as e:
+        print(f"❌ Error generando PDF de {job_dir.name}: {e}")
+    else:
+        # El estado serializado sólo hace falta para generar el PDF bajo demanda
+        (job_dir / ESTADO_FILENAME).unlink(missing_ok=True)
+    return True
+
+
+def ejecutar_analisis_lote(job_dir, kml_name, directorio_leyendas=None, directorio_capas=None):
+    """Análisis por lotes de un archivo con varios polígonos; devuelve los resultados"""
+    job_dir = Path(job_dir)
+    analizador = _preparar_analizador(
+        job_dir / kml_name, job_dir, directorio_leyendas, directorio_capas
+    )
+    analizador.parsear_kml_lote()
+    resultados = analizador.analizar_lote(width=1000, height=1000)
+    analizador.exportar_json_lote(str(job_dir / INFORME_LOTE_JSON))
+    return resultados
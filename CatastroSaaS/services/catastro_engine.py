@@ -6,9 +6,12 @@ import xml.etree.ElementTree as ET
 import json
 from io import BytesIO
 
+from services.layer_registry import obtener_registro, parametros_bbox
+
 # Intentar importar PIL, pero continuar si no está disponible
 try:
     from PIL import Image, ImageDraw
+    from services.raster_probe import es_imagen_vacia
     PILLOW_AVAILABLE = True
 except ImportError:
     PILLOW_AVAILABLE = False
@@ -290,90 +293,11 @@ class CatastroDownloader:
         ref = self.limpiar_referencia(referencia)
         print("\n  📋 Descargando capas de afecciones...")
         
-        coords_list = bbox_wgs84.split(",")
-        bbox_wms13 = f"{coords_list[1]},{coords_list[0]},{coords_list[3]},{coords_list[2]}"
+        minx, miny, maxx, maxy = (float(c) for c in bbox_wgs84.split(","))
+        bbox = {"minx": minx, "miny": miny, "maxx": maxx, "maxy": maxy}
         
-        capas_disponibles = {
-            # Catastro - Información básica
-            "catastro_parcelas": {
-                "url": "http://ovc.catastro.meh.es/Cartografia/WMS/ServidorWMS.aspx",
-                "version": "1.1.1",
-                "layers": "Catastro",
-                "srs_param": "SRS",
-                "bbox": bbox_wgs84,
-                "descripcion": "Plano catastral con parcelas"
-            },
-            
-            # IDEE - Planeamiento urbanístico
-            "planeamiento_urbanistico": {
-                "url": "https://www.idee.es/wms/IDEE-Planeamiento/IDEE-Planeamiento",
-                "version": "1.3.0",
-                "layers": "PlaneamientoGeneral",
-                "srs_param": "CRS",
-                "bbox": bbox_wms13,
-                "descripcion": "Planeamiento urbanístico general"
-            },
-            
-            # Catastro - Zonas de valor
-            "catastro_zonas_valor": {
-                "url": "http://ovc.catastro.meh.es/Cartografia/WMS/ServidorWMS.aspx",
-                "version": "1.1.1",
-                "layers": "ZonasValor",
-                "srs_param": "SRS",
-                "bbox": bbox_wgs84,
-                "descripcion": "Zonas de valor catastral"
-            },
-            
-            # Red Natura 2000
-            "red_natura_2000": {
-                "url": "https://wms.mapama.gob.es/sig/Biodiversidad/EENNPPZZ/wms.aspx",
-                "version": "1.3.0",
-                "layers": "RedNatura2000",
-                "srs_param": "CRS",
-                "bbox": bbox_wms13,
-                "descripcion": "Espacios Red Natura 2000"
-            },
-            
-            # Dominio público hidráulico
-            "dominio_publico_hidraulico": {
-                "url": "https://servicios.idee.es/wms-inspire/hidrografia",
-                "version": "1.3.0",
-                "layers": "HY.PhysicalWaters.Waterbodies",
-                "srs_param": "CRS",
-                "bbox": bbox_wms13,
-                "descripcion": "Hidrografía y zonas inundables"
-            },
-            
-            # Costas (zona marítimo-terrestre)
-            "dominio_maritimo": {
-                "url": "https://ideihm.covam.es/wms-c/mapas/Demarcaciones",
-                "version": "1.3.0",
-                "layers": "Demarcaciones",
-                "srs_param": "CRS",
-                "bbox": bbox_wms13,
-                "descripcion": "Dominio público marítimo-terrestre"
-            },
-            
-            # Montes de Utilidad Pública
-            "montes_utilidad_publica": {
-                "url": "https://wms.mapama.gob.es/sig/Biodiversidad/MUP/wms.aspx",
-                "version": "1.3.0",
-                "layers": "MUP",
-                "srs_param": "CRS",
-                "bbox": bbox_wms13,
-                "descripcion": "Montes de Utilidad Pública"
-            },
-            
-            # Vías pecuarias
-            "vias_pecuarias": {
-                "url": "https://wms.mapama.gob.es/sig/Biodiversidad/ViaPecuaria/wms.aspx",
-                "version": "1.3.0",
-                "layers": "ViasPecuarias",
-                "srs_param": "CRS",
-                "bbox": bbox_wms13,
-                "descripcion": "Vías pecuarias"
-            },
-        }
+        # Capas definidas en el registro compartido (services/capas.json)
+        capas_disponibles = obtener_registro().capas_descarga()
         
         capas_descargadas = []
         
@@ -385,8 +309,8 @@ class CatastroDownloader:
                     "REQUEST": "GetMap",
                     "LAYERS": config["layers"],
                     "STYLES": "",
-                    config["srs_param"]: "EPSG:4326",
-                    "BBOX": config["bbox"],
+                    # CRS/SRS y orden de ejes según la versión WMS de la capa
+                    **parametros_bbox(config, bbox),
                     "WIDTH": str(width),
                     "HEIGHT": str(height),
                     "FORMAT": "image/png",
@@ -398,7 +322,8 @@ class CatastroDownloader:
                 # Verificar que no sea un error XML
                 if response.status_code == 200 and len(response.content) > 1000:
                     # Verificar que sea una imagen válida y no esté vacía
-                    if b'PNG' in response.content[:100] or b'JFIF' in response.content[:100]:
+                    es_imagen = b'PNG' in response.content[:100] or b'JFIF' in response.content[:100]
+                    if es_imagen and not (PILLOW_AVAILABLE and es_imagen_vacia(response.content)):
                         filename = f"{self.output_dir}/{ref}_afeccion_{nombre_capa}.png"
                         with open(filename, 'wb') as f:
                             f.write(response.content)
@@ -878,8 +803,15 @@ class CatastroDownloader:
             print(f"  ✗ Error descargando edificio GML para {ref}: {e}")
             return False
 
-    def descargar_todo(self, referencia, crear_zip=False):
-        """Descarga todos los documentos para una referencia catastral."""
+    def descargar_todo(self, referencia, crear_zip=False, progreso=None):
+        """
+        Descarga todos los documentos para una referencia catastral.
+        
+        Si se indica, progreso(etapa, porcentaje, mensaje) se llama al
+        empezar cada etapa (coordenadas, gml, kml, imagenes, afecciones,
+        documentos, informe, zip).
+        """
+        avisar = progreso or (lambda *args, **kwargs: None)
         print(f"\n{'='*60}")
         print(f"Procesando referencia: {referencia}")
         print(f"{'='*60}")
@@ -892,9 +824,11 @@ class CatastroDownloader:
         self.output_dir = str(ref_dir)
 
         # Obtener coordenadas primero para KML
+        avisar("coordenadas", 5, "Obteniendo coordenadas de la parcela")
         coords = self.obtener_coordenadas(ref)
         
         # Descargar GML de parcela (necesario para KML con polígono)
+        avisar("gml", 15, "Descargando geometría GML")
         parcela_gml_descargado = self.descargar_parcela_gml(ref)
         
         # Extraer coordenadas del GML si existe
@@ -906,17 +840,21 @@ class CatastroDownloader:
         # Generar archivo KML
         kml_generado = False
         if coords:
+            avisar("kml", 25, "Generando KML")
             kml_generado = self.generar_kml(ref, coords, gml_coords)
 
         # Descargar planos y ortofotos
+        avisar("imagenes", 30, "Descargando plano y ortofoto")
         plano_descargado = self.descargar_plano_ortofoto(ref)
         
         # Descargar capas de afecciones
         afecciones_descargadas = False
         if coords:
+            avisar("afecciones", 45, "Descargando capas de afecciones")
             bbox_wgs84 = self.calcular_bbox(coords["lon"], coords["lat"], buffer_metros=200)
             afecciones_descargadas = self.descargar_capas_afecciones(ref, bbox_wgs84)
 
+        avisar("documentos", 70, "Descargando consulta descriptiva y edificio")
         resultados = {
             'consulta_descriptiva': self.descargar_consulta_pdf(ref),
             'plano_ortofoto': plano_descargado,
@@ -926,6 +864,7 @@ class CatastroDownloader:
             'capas_afecciones': afecciones_descargadas,
         }
 
+        avisar("informe", 80, "Generando informe PDF")
         try:
             generador = GeneradorInformeCatastral(ref, self.output_dir)
             generador.cargar_datos()
@@ -938,6 +877,7 @@ class CatastroDownloader:
 
         # Crear ZIP si se solicita
         if crear_zip:
+            avisar("zip", 95, "Comprimiendo resultados")
             try:
                 # Usar old_dir para la ruta de la carpeta base
                 zip_path = crear_zip_referencia(ref, old_dir) 
@@ -1194,13 +1134,14 @@ def crear_zip_referencia(referencia, directorio_base):
         return None
 
 
-def procesar_y_comprimir(referencia, directorio_base="descargas_catastro"):
+def procesar_y_comprimir(referencia, directorio_base="descargas_catastro", progreso=None):
     """
     Procesa una referencia catastral completa y genera un ZIP con todo.
     
     Args:
         referencia: Referencia catastral
         directorio_base: Directorio de salida
+        progreso: Función opcional progreso(etapa, porcentaje, mensaje)
     
     Returns:
         Ruta del archivo ZIP generado, y resultados
@@ -1208,7 +1149,7 @@ def procesar_y_comprimir(referencia, directorio_base="descargas_catastro"):
     downloader = CatastroDownloader(output_dir=directorio_base)
     
     print(f"Procesando referencia: {referencia}")
-    resultados = downloader.descargar_todo(referencia, crear_zip=True)
+    resultados = downloader.descargar_todo(referencia, crear_zip=True, progreso=progreso)
     
     zip_path = resultados.get('zip_path')
     
@@ -0,0 +1,149 @@
+"""
+Eventos de progreso de trabajos (consultas catastrales y análisis).
+
+Cada trabajo escribe sus eventos, uno por línea JSON, en
+<directorio>/<job_id>.jsonl. Lo escribe el proceso que ejecuta el
+trabajo (worker o ejecutor de análisis) y lo lee la API para servirlo
+por SSE: seguir un archivo no consulta la base de datos, así que un
+cliente conectado no genera carga de sondeo.
+
+Un evento con "final": true cierra el flujo (completado o error).
+"""
+import asyncio
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+# Segundos entre lecturas del archivo mientras el trabajo sigue vivo
+INTERVALO_LECTURA = 0.5
+
+# Comentario SSE para mantener viva la conexión a través de proxies
+INTERVALO_KEEPALIVE = 15
+
+COMPLETADO = "completado"
+ERROR = "error"
+
+
+def ruta_eventos(directorio, job_id):
+    return Path(directorio) / f"{job_id}.jsonl"
+
+
+class EmisorProgreso:
+    """
+    Añade eventos al archivo del trabajo. Cada evento se escribe con una
+    sola llamada write en modo append, así que los lectores nunca ven
+    líneas a medias de otro evento. Llamar a la instancia equivale a emitir().
+    """
+
+    def __init__(self, directorio, job_id, **contexto):
+        self.ruta = ruta_eventos(directorio, job_id)
+        self.contexto = contexto
+        self._lock = threading.Lock()
+        self.ruta.parent.mkdir(parents=True, exist_ok=True)
+
+    def emitir(self, etapa, progreso=None, mensaje=None, final=False, **datos):
+        evento = {
+            "t": round(time.time(), 3),
+            "etapa": etapa,
+            "progreso": progreso,
+            "mensaje": mensaje,
+            **self.contexto,
+            **datos,
+        }
+        if final:
+            evento["final"] = True
+        linea = json.dumps(evento, ensure_ascii=False, default=str) + "\n"
+        try:
+            with self._lock, open(self.ruta, "a", encoding="utf-8") as f:
+                f.write(linea)
+        except OSError as e:
+            # El progreso nunca debe hacer fallar el trabajo
+            print(f"⚠ No se pudo escribir el progreso de {self.ruta.name}: {e}")
+
+    __call__ = emitir
+
+    def terminar(self, estado, mensaje=None, **datos):
+        self.emitir(estado, 100 if estado == COMPLETADO else None, mensaje, final=True, **datos)
+
+    def __getstate__(self):
+        # Viaja con el analizador serializado (guardar_estado): sin el lock
+        return {"ruta": self.ruta, "contexto": self.contexto}
+
+    def __setstate__(self, estado):
+        self.__dict__.update(estado)
+        self._lock = threading.Lock()
+
+
+def leer_eventos(ruta, desde=0):
+    """Eventos completos del archivo a partir del índice `desde`"""
+    try:
+        with open(ruta, encoding="utf-8") as f:
+            lineas = f.readlines()
+    except OSError:
+        return []
+    eventos = []
+    for linea in lineas[desde:]:
+        if not linea.endswith("\n"):
+            break  # Escritura en curso
+        try:
+            eventos.append(json.loads(linea))
+        except ValueError:
+            eventos.append({"etapa": "desconocida"})
+    return eventos
+
+
+async def flujo_sse(ruta, desde=0, espera_maxima=None):
+    """
+    Generador de mensajes SSE con los eventos de un archivo: reenvía los
+    existentes desde `desde` (Last-Event-ID + 1) y sigue el archivo
+    hasta un evento final. Si el archivo no crece en `espera_maxima`
+    segundos el flujo se cierra.
+    """
+    siguiente = desde
+    ultima_actividad = time.monotonic()
+    ultimo_envio = ultima_actividad
+    tamano = -1
+
+    while True:
+        try:
+            tamano_actual = os.path.getsize(ruta)
+        except OSError:
+            tamano_actual = -1
+
+        if tamano_actual != tamano:
+            tamano = tamano_actual
+            for evento in leer_eventos(ruta, siguiente):
+                yield f"id: {siguiente}\nevent: progreso\ndata: {json.dumps(evento, ensure_ascii=False)}\n\n"
+                siguiente += 1
+                ultima_actividad = ultimo_envio = time.monotonic()
+                if evento.get("final"):
+                    return
+
+        ahora = time.monotonic()
+        if espera_maxima and ahora - ultima_actividad > espera_maxima:
+            yield "event: timeout\ndata: {}\n\n"
+            return
+        if ahora - ultimo_envio > INTERVALO_KEEPALIVE:
+            ultimo_envio = ahora
+            yield ": keepalive\n\n"
+        await asyncio.sleep(INTERVALO_LECTURA)
+
+
+def purgar(directorio, max_edad):
+    """Elimina los archivos de eventos con más de max_edad segundos"""
+    limite = time.time() - max_edad
+    try:
+        entradas = list(os.scandir(directorio))
+    except OSError:
+        return 0
+    borrados = 0
+    for entrada in entradas:
+        try:
+            if entrada.name.endswith(".jsonl") and entrada.stat().st_mtime < limite:
+                os.remove(entrada.path)
+                borrados += 1
+        except OSError:
+            pass
+    return borrados
@@ -0,0 +1,299 @@
+"""
+Cola de trabajos persistente sobre la base de datos de la aplicación.
+
+Los trabajos se guardan en la tabla `jobs` (models.Job), en la misma
+transacción que el registro que los origina, y los consumen procesos
+worker independientes (worker.py):
+
+- Reclamación: en PostgreSQL con SELECT ... FOR UPDATE SKIP LOCKED; en
+  SQLite (entorno local) con un UPDATE condicional, de modo que dos
+  workers nunca reclaman el mismo trabajo.
+- Visibilidad: un trabajo reclamado queda oculto hasta locked_until. El
+  worker lo renueva mientras trabaja; si muere, al vencer el plazo otro
+  worker lo vuelve a reclamar.
+- Reintentos: un fallo vuelve a poner el trabajo en cola con espera
+  exponencial hasta max_attempts; después queda en FAILED.
+- Prioridad: por plan del usuario (ENTERPRISE > PRO > FREE) y, a igual
+  prioridad, por orden de llegada.
+- Deduplicación: los trabajos con dedup_key comparten un único trabajo
+  activo por clave (índice único parcial) y pueden reutilizar el
+  resultado de uno terminado recientemente.
+"""
+import random
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import and_, or_, update
+from sqlalchemy.exc import IntegrityError
+
+import models
+
+# Prioridad de los trabajos según el plan del usuario (mayor = antes)
+PRIORIDAD_PLAN = {
+    models.PlanType.FREE: 0,
+    models.PlanType.PRO: 10,
+    models.PlanType.ENTERPRISE: 20,
+}
+
+# Límite de la espera exponencial entre reintentos (segundos)
+MAX_ESPERA_REINTENTO = 3600
+
+# Longitud máxima del error guardado
+MAX_LONGITUD_ERROR = 2000
+
+
+def ahora():
+    return datetime.now(timezone.utc)
+
+
+def prioridad_plan(plan_type):
+    return PRIORIDAD_PLAN.get(plan_type, 0)
+
+
+def encolar(db, job_type, payload, user_id=None, priority=0, max_attempts=3, dedup_key=None):
+    """
+    Añade un trabajo a la sesión. No hace commit: el trabajo se confirma
+    junto con el resto de la transacción del llamante.
+    """
+    job = models.Job(
+        job_type=job_type,
+        payload=payload,
+        user_id=user_id,
+        dedup_key=dedup_key,
+        status=models.JobStatus.PENDING,
+        priority=priority,
+        run_after=ahora(),
+        attempts=0,
+        max_attempts=max_attempts,
+    )
+    db.add(job)
+    return job
+
+
+def activo(db, job_type, dedup_key):
+    """Trabajo pendiente o en curso con esa clave (o None)"""
+    Job = models.Job
+    return db.query(Job).filter(
+        Job.job_type == job_type,
+        Job.dedup_key == dedup_key,
+        Job.status.in_([models.JobStatus.PENDING, models.JobStatus.RUNNING]),
+    ).first()
+
+
+def reciente(db, job_type, dedup_key, max_edad):
+    """Último trabajo terminado con esa clave hace menos de max_edad segundos"""
+    Job = models.Job
+    return db.query(Job).filter(
+        Job.job_type == job_type,
+        Job.dedup_key == dedup_key,
+        Job.status == models.JobStatus.DONE,
+        Job.finished_at >= ahora() - timedelta(seconds=max_edad),
+    ).order_by(Job.finished_at.desc()).first()
+
+
+def encolar_unico(db, job_type, dedup_key, payload, user_id=None, priority=0,
+                  max_attempts=3, frescura=None, reutilizable=None):
+    """
+    Encola un trabajo salvo que ya exista uno equivalente. Devuelve
+    (trabajo, modo):
+
+    - 'en_curso': hay uno pendiente o en curso con la misma clave; se
+      usa ése (y se sube su prioridad si la nueva es mayor).
+    - 'reutilizado': uno terminado hace menos de `frescura` segundos
+      cuyo resultado sigue siendo válido (`reutilizable(job)`).
+    - 'nuevo': se ha añadido uno nuevo a la sesión.
+
+    Como encolar, no confirma la transacción. Si otra petición crea el
+    mismo trabajo a la vez, el índice único lo impide y se usa el suyo.
+    """
+    for _ in range(3):
+        job = activo(db, job_type, dedup_key)
+        if job is not None:
+            if job.priority < priority:
+                job.priority = priority
+            return job, "en_curso"
+
+        if frescura:
+            job = reciente(db, job_type, dedup_key, frescura)
+            if job is not None and (reutilizable is None or reutilizable(job)):
+                return job, "reutilizado"
+
+        try:
+            with db.begin_nested():
+                job = encolar(db, job_type, payload, user_id, priority, max_attempts, dedup_key)
+                db.flush()
+            return job, "nuevo"
+        except IntegrityError:
+            # Otra petición acaba de crear el trabajo activo: unirse a él
+            continue
+
+    raise RuntimeError(f"No se pudo encolar el trabajo {job_type}:{dedup_key}")
+
+
+def _disponibles(instante, job_types=None):
+    """Condición de trabajos reclamables: pendientes o con la visibilidad vencida"""
+    Job = models.Job
+    condicion = and_(
+        Job.attempts < Job.max_attempts,
+        or_(
+            and_(Job.status == models.JobStatus.PENDING, Job.run_after <= instante),
+            and_(Job.status == models.JobStatus.RUNNING, Job.locked_until < instante),
+        )
+    )
+    if job_types:
+        condicion = and_(condicion, Job.job_type.in_(job_types))
+    return condicion
+
+
+def _expirar_agotados(db, instante):
+    """Los trabajos abandonados sin reintentos disponibles pasan a FAILED"""
+    Job = models.Job
+    db.execute(
+        update(Job)
+        .where(
+            Job.status == models.JobStatus.RUNNING,
+            Job.locked_until < instante,
+            Job.attempts >= Job.max_attempts,
+        )
+        .values(
+            status=models.JobStatus.FAILED,
+            finished_at=instante,
+            last_error="Tiempo de visibilidad agotado",
+        )
+        .execution_options(synchronize_session=False)
+    )
+
+
+def reclamar(db, worker_id, visibilidad, job_types=None):
+    """
+    Reclama el siguiente trabajo disponible para worker_id y lo confirma
+    en RUNNING con locked_until = ahora + visibilidad. Devuelve el
+    trabajo o None si no hay ninguno.
+
+    El trabajo se devuelve separado de la sesión y sin transacción
+    abierta: la conexión no queda "idle in transaction" mientras se
+    ejecuta. completar y fallar usan su propia sesión.
+    """
+    Job = models.Job
+    instante = ahora()
+    _expirar_agotados(db, instante)
+
+    consulta = (
+        db.query(Job)
+        .filter(_disponibles(instante, job_types))
+        .order_by(Job.priority.desc(), Job.run_after, Job.created_at)
+    )
+    postgres = db.get_bind().dialect.name == "postgresql"
+
+    if postgres:
+        job = consulta.with_for_update(skip_locked=True).first()
+        candidatos = [job] if job else []
+    else:
+        # Sin bloqueo de filas: unos pocos candidatos y UPDATE condicional
+        candidatos = consulta.limit(5).all()
+
+    for job in candidatos:
+        resultado = db.execute(
+            update(Job)
+            .where(Job.id == job.id, _disponibles(instante, job_types))
+            .values(
+                status=models.JobStatus.RUNNING,
+                locked_by=worker_id,
+                locked_until=instante + timedelta(seconds=visibilidad),
+                attempts=Job.attempts + 1,
+            )
+            .execution_options(synchronize_session=False)
+        )
+        if resultado.rowcount == 1:
+            db.commit()
+            db.refresh(job)
+            # refresh abre una transacción nueva: cerrarla con el trabajo ya cargado
+            db.expunge(job)
+            db.commit()
+            return job
+
+    db.commit()
+    return None
+
+
+def _del_worker(job_id, worker_id):
+    Job = models.Job
+    return and_(
+        Job.id == job_id,
+        Job.status == models.JobStatus.RUNNING,
+        Job.locked_by == worker_id,
+    )
+
+
+def renovar(db, job_id, worker_id, visibilidad):
+    """Amplía la visibilidad de un trabajo en curso. False si ya no es del worker"""
+    resultado = db.execute(
+        update(models.Job)
+        .where(_del_worker(job_id, worker_id))
+        .values(locked_until=ahora() + timedelta(seconds=visibilidad))
+        .execution_options(synchronize_session=False)
+    )
+    db.commit()
+    return resultado.rowcount == 1
+
+
+def completar(db, job_id, worker_id, result=None, antes_de_confirmar=None):
+    """
+    Marca el trabajo como terminado y guarda su resultado. Si se indica,
+    antes_de_confirmar(db) se ejecuta en la misma transacción (p. ej. para
+    actualizar los registros que esperan al trabajo).
+    """
+    resultado = db.execute(
+        update(models.Job)
+        .where(_del_worker(job_id, worker_id))
+        .values(
+            status=models.JobStatus.DONE,
+            finished_at=ahora(),
+            locked_until=None,
+            last_error=None,
+            result=result,
+        )
+        .execution_options(synchronize_session=False)
+    )
+    if resultado.rowcount != 1:
+        # Otro worker lo reclamó (visibilidad vencida): su ejecución manda
+        db.rollback()
+        return False
+    if antes_de_confirmar is not None:
+        antes_de_confirmar(db)
+    db.commit()
+    return True
+
+
+def espera_reintento(intento, base):
+    """Espera exponencial con jitter antes del reintento número `intento`"""
+    espera = min(base * 2 ** max(intento - 1, 0), MAX_ESPERA_REINTENTO)
+    return espera * random.uniform(0.8, 1.2)
+
+
+def fallar(db, job, worker_id, error, espera_base):
+    """
+    Registra un fallo: vuelve a la cola con espera exponencial si quedan
+    intentos o pasa a FAILED. Devuelve el nuevo estado.
+    """
+    instante = ahora()
+    if job.attempts < job.max_attempts:
+        valores = {
+            "status": models.JobStatus.PENDING,
+            "run_after": instante + timedelta(seconds=espera_reintento(job.attempts, espera_base)),
+        }
+    else:
+        valores = {"status": models.JobStatus.FAILED, "finished_at": instante}
+
+    db.execute(
+        update(models.Job)
+        .where(_del_worker(job.id, worker_id))
+        .values(
+            locked_by=None,
+            locked_until=None,
+            last_error=str(error)[:MAX_LONGITUD_ERROR],
+            **valores
+        )
+        .execution_options(synchronize_session=False)
+    )
+    db.commit()
+    return valores["status"]
@@ -0,0 +1,237 @@
+"""
+Registro de capas WMS / locales.
+
+Las capas del análisis de afecciones y las de descarga de CatastroDownloader
+se definen en un único archivo JSON (por defecto services/capas.json, o el
+de settings.CAPAS_REGISTRO): URL, versión WMS, orden de ejes del CRS,
+reglas de color, tolerancia, TTL de la caché y backend ('wms' o 'local').
+
+El archivo se lee una vez por proceso y se recarga en caliente cuando
+cambia su fecha de modificación (comprobada como mucho cada
+INTERVALO_COMPROBACION segundos), sin reiniciar los workers. Si la nueva
+versión no es válida se sigue usando la anterior.
+
+Las reglas de color se compilan una sola vez en ComparadorColores,
+compartidos por todas las peticiones del proceso, junto con las tablas de
+distancias de las paletas ya vistas.
+"""
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+RUTA_POR_DEFECTO = Path(__file__).parent / "capas.json"
+
+# Segundos entre comprobaciones de la fecha del archivo
+INTERVALO_COMPROBACION = 2.0
+
+# Tablas de paleta guardadas por comparador
+MAX_TABLAS_PALETA = 64
+
+# Distancia de los píxeles que no se comparan (igual que SIN_DISTANCIA del análisis)
+SIN_DISTANCIA = 256
+
+
+def _color_rgb(color):
+    """Acepta [r, g, b], {'rgb': [r, g, b], 'nombre': ...} o '#RRGGBB'"""
+    if isinstance(color, dict):
+        color = color['rgb']
+    if isinstance(color, str):
+        texto = color.lstrip('#')
+        return tuple(int(texto[i:i + 2], 16) for i in (0, 2, 4))
+    return tuple(int(c) for c in color[:3])
+
+
+class ComparadorColores:
+    """
+    Reglas de color compiladas de una capa: los colores buscados como array
+    int16 y las tablas de distancias (256,) de las paletas ya vistas, por
+    huella de la paleta (los servidores WMS repiten la misma paleta).
+    """
+
+    def __init__(self, colores):
+        self.colores = np.array([_color_rgb(c) for c in colores], dtype=np.int16).reshape(-1, 3)
+        self._tablas = OrderedDict()
+        self._lock = threading.Lock()
+
+    def distancias(self, pixels):
+        """
+        Distancia de cada píxel (array (..., 3)) al color buscado más
+        cercano, medida como la mayor diferencia entre canales.
+        """
+        pixels = np.asarray(pixels, dtype=np.int16)
+        distancia = np.full(pixels.shape[:-1], SIN_DISTANCIA, dtype=np.int16)
+        for color in self.colores:
+            np.minimum(distancia, np.abs(pixels - color).max(axis=-1), out=distancia)
+        return distancia
+
+    def tabla_paleta(self, paleta):
+        """Distancias de las 256 entradas de una paleta (copia modificable)"""
+        paleta = np.ascontiguousarray(paleta, dtype=np.int16)
+        huella = paleta.tobytes()
+        with self._lock:
+            tabla = self._tablas.get(huella)
+            if tabla is not None:
+                self._tablas.move_to_end(huella)
+                return tabla.copy()
+
+        tabla = self.distancias(paleta)
+        with self._lock:
+            self._tablas[huella] = tabla
+            while len(self._tablas) > MAX_TABLAS_PALETA:
+                self._tablas.popitem(last=False)
+        return tabla.copy()
+
+
+# Comparadores por conjunto de colores (también para capas fuera del registro)
+_comparadores = {}
+_comparadores_lock = threading.Lock()
+
+
+def comparador_para(colores):
+    """Devuelve el comparador compilado de una lista de colores"""
+    clave = tuple(_color_rgb(c) for c in colores)
+    with _comparadores_lock:
+        comparador = _comparadores.get(clave)
+        if comparador is None:
+            comparador = _comparadores[clave] = ComparadorColores(clave)
+    return comparador
+
+
+def parametros_bbox(config, bbox):
+    """
+    Parámetros de CRS y BBOX de una petición GetMap en EPSG:4326 según la
+    versión WMS y el orden de ejes de la capa: WMS 1.3.0 usa CRS y, para
+    EPSG:4326, latitud primero; 1.1.1 usa SRS y longitud primero.
+    """
+    version = config.get('version', '1.3.0')
+    srs_param = config.get('srs_param') or ('CRS' if version >= '1.3' else 'SRS')
+    orden = config.get('orden_ejes') or ('latlon' if srs_param == 'CRS' else 'lonlat')
+
+    if orden == 'latlon':
+        coords = (bbox['miny'], bbox['minx'], bbox['maxy'], bbox['maxx'])
+    else:
+        coords = (bbox['minx'], bbox['miny'], bbox['maxx'], bbox['maxy'])
+    return {srs_param: 'EPSG:4326', 'BBOX': ','.join(str(c) for c in coords)}
+
+
+class RegistroCapas:
+    """Contenido compilado de un archivo de registro"""
+
+    def __init__(self, datos, ruta=None, mtime=None):
+        self.ruta = ruta
+        self.mtime = mtime
+        self.version = datos.get('version', 1)
+        self.analisis = {
+            nombre: self._compilar_analisis(nombre, config)
+            for nombre, config in (datos.get('analisis') or {}).items()
+        }
+        self.descargas = {
+            nombre: self._compilar_descarga(nombre, config)
+            for nombre, config in (datos.get('descargas') or {}).items()
+        }
+
+    @classmethod
+    def desde_archivo(cls, ruta):
+        mtime = os.path.getmtime(ruta)
+        with open(ruta, encoding='utf-8') as f:
+            return cls(json.load(f), str(ruta), mtime)
+
+    @staticmethod
+    def _compilar_analisis(nombre, config):
+        config = dict(config)
+        config.setdefault('backend', 'wms')
+        if config['backend'] == 'local':
+            if not config.get('ruta'):
+                raise ValueError(f"La capa local '{nombre}' no tiene 'ruta'")
+        elif not config.get('url') or not config.get('layer'):
+            raise ValueError(f"La capa WMS '{nombre}' necesita 'url' y 'layer'")
+        config.setdefault('version', '1.3.0')
+
+        colores = config.get('colores_posibles') or []
+        if not colores:
+            raise ValueError(f"La capa '{nombre}' no tiene colores_posibles")
+        config['colores_posibles'] = [_color_rgb(c) for c in colores]
+        config['tolerancia'] = int(config.get('tolerancia', 0))
+
+        # Compilar una vez: las peticiones reutilizan el mismo comparador
+        comparador_para(config['colores_posibles'])
+        return config
+
+    @staticmethod
+    def _compilar_descarga(nombre, config):
+        config = dict(config)
+        if not config.get('url') or not config.get('layers'):
+            raise ValueError(f"La capa de descarga '{nombre}' necesita 'url' y 'layers'")
+        config.setdefault('version', '1.3.0')
+        config.setdefault('descripcion', nombre)
+        return config
+
+    def capas_analisis(self):
+        """Copia de las capas del análisis (las tablas compiladas se comparten)"""
+        return {nombre: dict(config) for nombre, config in self.analisis.items()}
+
+    def capas_descarga(self):
+        return {nombre: dict(config) for nombre, config in self.descargas.items()}
+
+
+_ruta_registro = None
+_registro = None
+_ultima_comprobacion = 0.0
+_registro_lock = threading.Lock()
+
+
+def configurar(ruta=None):
+    """Fija el archivo de registro (None = services/capas.json) y lo carga"""
+    global _ruta_registro, _registro
+    with _registro_lock:
+        _ruta_registro = str(ruta) if ruta else None
+        _registro = None
+    return obtener_registro()
+
+
+def ruta_registro():
+    return _ruta_registro or os.environ.get('CAPAS_REGISTRO') or str(RUTA_POR_DEFECTO)
+
+
+def obtener_registro():
+    """
+    Registro vigente del proceso. Se recarga si el archivo ha cambiado
+    desde la última lectura; un archivo inválido no sustituye al anterior.
+    """
+    global _registro, _ultima_comprobacion
+    ahora = time.monotonic()
+    registro = _registro
+    if registro is not None and ahora - _ultima_comprobacion < INTERVALO_COMPROBACION:
+        return registro
+
+    with _registro_lock:
+        ruta = ruta_registro()
+        _ultima_comprobacion = ahora
+        try:
+            mtime = os.path.getmtime(ruta)
+        except OSError as e:
+            if _registro is None:
+                raise
+            print(f"⚠ Registro de capas no accesible ({e}): se mantiene el cargado")
+            return _registro
+
+        if _registro is not None and _registro.ruta == ruta and _registro.mtime == mtime:
+            return _registro
+
+        try:
+            nuevo = RegistroCapas.desde_archivo(ruta)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            if _registro is None:
+                raise
+            print(f"⚠ Registro de capas no válido ({e}): se mantiene el cargado")
+            return _registro
+
+        if _registro is not None:
+            print(f"♻ Registro de capas recargado: {ruta}")
+        _registro = nuevo
+        return _registro
@@ -0,0 +1,198 @@
+"""
+Clasificación de rasters temáticos por leyenda.
+
+Una leyenda es una lista de registros con 'color' y 'etiqueta' (el formato
+de los leyenda_<capa>.csv que usan 15.py y IntersectionService). El
+clasificador la compila una vez en una tabla color -> clase y clasifica
+cada raster en una sola pasada: sólo se comparan con la leyenda los
+colores distintos de la imagen (o las 256 entradas de la paleta), y los
+píxeles se resuelven con una búsqueda por índice.
+"""
+import csv
+import os
+import threading
+
+import numpy as np
+from PIL import ImageColor
+
+# Clases especiales (índices negativos en el array de clases)
+SIN_CLASE = -1   # color que no está en la leyenda
+SIN_DATO = -2    # píxel transparente
+
+
+def color_a_rgb(color):
+    """Convierte '#RRGGBB', nombres CSS, 'rgb(...)', 'r,g,b' o tuplas en (r, g, b)"""
+    if isinstance(color, (tuple, list)):
+        return tuple(int(c) for c in color[:3])
+    texto = str(color).strip()
+    if texto.count(',') >= 2 and not texto.lower().startswith(('rgb', 'hsl', 'hsv')):
+        return tuple(int(float(c)) for c in texto.split(',')[:3])
+    return ImageColor.getrgb(texto)[:3]
+
+
+def cargar_leyenda_csv(ruta):
+    """Lee un leyenda_<capa>.csv como lista de registros"""
+    with open(ruta, newline='', encoding='utf-8') as f:
+        return list(csv.DictReader(f))
+
+
+class ClasificadorLeyenda:
+    """
+    Clasificador compilado a partir de una leyenda.
+
+    Cada color de la leyenda se asigna a su etiqueta; varias filas con la
+    misma etiqueta forman una única clase. Un píxel pertenece a la clase
+    del color de leyenda más cercano (mayor diferencia entre canales)
+    siempre que esté a distancia <= tolerancia.
+    """
+
+    def __init__(self, leyenda, tolerancia=0, nombre=None):
+        self.nombre = nombre
+        self.tolerancia = tolerancia
+        self.etiquetas = []
+        colores = []
+        clase_color = []
+
+        for registro in leyenda:
+            try:
+                rgb = color_a_rgb(registro['color'])
+            except (KeyError, ValueError):
+                continue
+            etiqueta = str(registro.get('etiqueta') or rgb)
+            if etiqueta not in self.etiquetas:
+                self.etiquetas.append(etiqueta)
+            colores.append(rgb)
+            clase_color.append(self.etiquetas.index(etiqueta))
+
+        if not colores:
+            raise ValueError("La leyenda no contiene colores válidos")
+
+        self.colores = np.array(colores, dtype=np.int16)
+        self.clase_color = np.array(clase_color, dtype=np.int16)
+        # Color representativo de cada clase (el primero de la leyenda)
+        self.color_clase = [colores[clase_color.index(i)] for i in range(len(self.etiquetas))]
+
+    @classmethod
+    def desde_csv(cls, ruta, tolerancia=0):
+        nombre = os.path.splitext(os.path.basename(ruta))[0].replace('leyenda_', '')
+        return cls(cargar_leyenda_csv(ruta), tolerancia=tolerancia, nombre=nombre)
+
+    def clases_de_colores(self, colores):
+        """
+        Clase de cada color de un array (N, 3): el índice de etiqueta o
+        SIN_CLASE si ningún color de la leyenda está dentro de la tolerancia.
+        """
+        colores = np.asarray(colores, dtype=np.int16)
+        # (N, K): distancia de cada color a cada entrada de la leyenda
+        distancias = np.abs(colores[:, None, :] - self.colores[None, :, :]).max(axis=2)
+        mas_cercano = distancias.argmin(axis=1)
+        clases = self.clase_color[mas_cercano].astype(np.int16)
+        clases[distancias[np.arange(len(colores)), mas_cercano] > self.tolerancia] = SIN_CLASE
+        return clases
+
+    def clasificar_imagen(self, imagen, mascara=None):
+        """
+        Clase de cada píxel de la imagen (aplanado y restringido a la
+        máscara si se indica). Devuelve un array int16 con índices de
+        etiqueta, SIN_CLASE o SIN_DATO.
+        """
+        if imagen.mode == 'P':
+            paleta = imagen.getpalette() or []
+            paleta = paleta[:768] + [0] * (768 - len(paleta[:768]))
+            lut = self.clases_de_colores(np.array(paleta).reshape(256, 3))
+
+            transparencia = imagen.info.get('transparency')
+            if isinstance(transparencia, int) and transparencia < 256:
+                lut[transparencia] = SIN_DATO
+            elif isinstance(transparencia, bytes):
+                alfa = np.full(256, 255, dtype=np.uint8)
+                alfa[:len(transparencia)] = np.frombuffer(transparencia[:256], dtype=np.uint8)
+                lut[alfa == 0] = SIN_DATO
+
+            indices = np.asarray(imagen)
+            indices = indices[mascara] if mascara is not None else indices.ravel()
+            return lut[indices]
+
+        transparentes = None
+        if imagen.mode in ('RGBA', 'LA', 'PA'):
+            alfa = np.asarray(imagen.getchannel('A'))
+            alfa = alfa[mascara] if mascara is not None else alfa.ravel()
+            transparentes = alfa == 0
+        if imagen.mode != 'RGB':
+            imagen = imagen.convert('RGB')
+
+        pixels = np.asarray(imagen)
+        pixels = pixels[mascara] if mascara is not None else pixels.reshape(-1, 3)
+
+        # Colores distintos empaquetados en 24 bits: la leyenda sólo se
+        # compara con ellos y cada píxel se resuelve por índice
+        empaquetados = (pixels[:, 0].astype(np.int32) << 16) | \
+                       (pixels[:, 1].astype(np.int32) << 8) | pixels[:, 2]
+        valores, inverso = np.unique(empaquetados, return_inverse=True)
+        unicos = np.stack([valores >> 16, (valores >> 8) & 0xFF, valores & 0xFF], axis=1)
+        clases = self.clases_de_colores(unicos)[inverso.ravel()]
+
+        if transparentes is not None:
+            clases[transparentes] = SIN_DATO
+        return clases
+
+    def resumen(self, clases, pesos=None, superficie_ha=None):
+        """
+        Recuento por clase de un array de clases (p. ej. el de
+        clasificar_imagen). Los porcentajes son sobre los píxeles con dato.
+        """
+        num_clases = len(self.etiquetas)
+        # Desplazamiento para que SIN_DATO y SIN_CLASE queden en 0 y 1
+        cuentas = np.bincount(clases.astype(np.int64) + 2, weights=pesos, minlength=num_clases + 2)
+
+        def valor(x):
+            return round(float(x), 2) if pesos is not None else int(x)
+
+        total = cuentas.sum()
+        con_dato = total - cuentas[0]
+
+        categorias = []
+        for i, etiqueta in enumerate(self.etiquetas):
+            pixels = cuentas[i + 2]
+            if pixels <= 0:
+                continue
+            fraccion = pixels / con_dato if con_dato else 0
+            categorias.append({
+                'etiqueta': etiqueta,
+                'color': list(self.color_clase[i]),
+                'pixels': valor(pixels),
+                'porcentaje': round(float(fraccion) * 100, 2),
+                'superficie_ha': round(float(superficie_ha * pixels / total), 4) if superficie_ha and total else None
+            })
+        categorias.sort(key=lambda c: c['pixels'], reverse=True)
+
+        return {
+            'leyenda': self.nombre,
+            'total_pixels': valor(total),
+            'pixels_sin_dato': valor(cuentas[0]),
+            'pixels_sin_clase': valor(cuentas[1]),
+            'clases': categorias
+        }
+
+    def clasificar(self, imagen, mascara=None, pesos=None, superficie_ha=None):
+        """Clasifica la imagen y devuelve el recuento por clase dentro de la máscara"""
+        return self.resumen(self.clasificar_imagen(imagen, mascara), pesos, superficie_ha)
+
+
+# Clasificadores compilados por ruta de CSV, invalidados si cambia el archivo
+_clasificadores = {}
+_clasificadores_lock = threading.Lock()
+
+
+def clasificador_para(ruta, tolerancia=0):
+    """Devuelve el clasificador compilado de un CSV de leyenda (con caché)"""
+    clave = (os.path.abspath(ruta), tolerancia)
+    mtime = os.path.getmtime(ruta)
+    with _clasificadores_lock:
+        entrada = _clasificadores.get(clave)
+        if entrada and entrada[0] == mtime:
+            return entrada[1]
+    clasificador = ClasificadorLeyenda.desde_csv(ruta, tolerancia=tolerancia)
+    with _clasificadores_lock:
+        _clasificadores[clave] = (mtime, clasificador)
+    return clasificador
@@ -0,0 +1,95 @@
+"""
+Sondeo rápido de rasters WMS vacíos.
+
+Cuando una capa no tiene elementos en el bbox el servidor devuelve una
+imagen totalmente transparente o de un único color. Detectarlo con
+getextrema() (un recorrido en C, sin pasar a NumPy) permite resolver el
+análisis sin clasificar píxel a píxel. El veredicto se guarda por huella
+del contenido descargado, de modo que la misma tesela no se examina dos
+veces.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+from PIL import Image
+
+MAX_ENTRADAS_CACHE = 1024
+
+# huella sha1 -> resultado del sondeo (None = imagen con varios colores)
+_cache_sondeos = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def huella_contenido(contenido):
+    """Huella del contenido binario de una respuesta"""
+    return hashlib.sha1(contenido).hexdigest()
+
+
+def _sondear(imagen):
+    """
+    Devuelve None si la imagen tiene más de un color. Si es uniforme
+    devuelve (rgb, transparente); rgb es None cuando es toda transparente.
+    """
+    if imagen.mode == 'P':
+        minimo, maximo = imagen.getextrema()
+        if minimo != maximo:
+            return None
+        paleta = imagen.getpalette() or []
+        rgb = tuple(paleta[minimo * 3:minimo * 3 + 3]) or (0, 0, 0)
+        transparencia = imagen.info.get('transparency')
+        if isinstance(transparencia, int):
+            transparente = transparencia == minimo
+        elif isinstance(transparencia, bytes):
+            transparente = minimo < len(transparencia) and transparencia[minimo] == 0
+        else:
+            transparente = False
+        return (None, True) if transparente else (rgb, False)
+
+    if imagen.mode not in ('RGB', 'RGBA'):
+        imagen = imagen.convert('RGBA')
+
+    extremos = imagen.getextrema()
+    if imagen.mode == 'RGBA' and extremos[3][1] == 0:
+        return None, True
+    if any(minimo != maximo for minimo, maximo in extremos):
+        return None
+    return tuple(minimo for minimo, _ in extremos[:3]), False
+
+
+def sondear_imagen(imagen, huella=None):
+    """
+    Sondea si una imagen PIL es uniforme (vacía o de un solo color).
+    Si se conoce la huella del contenido (o viene en imagen.info['sha1'])
+    el resultado se guarda en una caché acotada.
+    """
+    huella = huella or imagen.info.get('sha1')
+    if huella:
+        with _cache_lock:
+            if huella in _cache_sondeos:
+                _cache_sondeos.move_to_end(huella)
+                return _cache_sondeos[huella]
+
+    resultado = _sondear(imagen)
+
+    if huella:
+        with _cache_lock:
+            _cache_sondeos[huella] = resultado
+            while len(_cache_sondeos) > MAX_ENTRADAS_CACHE:
+                _cache_sondeos.popitem(last=False)
+
+    return resultado
+
+
+def es_imagen_vacia(contenido):
+    """Indica si un PNG/JPEG descargado es totalmente transparente o blanco"""
+    try:
+        imagen = Image.open(BytesIO(contenido))
+        sondeo = sondear_imagen(imagen, huella_contenido(contenido))
+    except Exception:
+        return False
+    if sondeo is None:
+        return False
+    rgb, transparente = sondeo
+    return transparente or all(c > 240 for c in rgb)
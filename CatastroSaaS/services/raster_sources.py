@@ -0,0 +1,140 @@
+"""
+Fuente de rasters locales (GeoTIFF / COG) para el análisis de afecciones.
+
+Devuelve la misma imagen PIL que una petición WMS GetMap (bbox en
+EPSG:4326, tamaño width x height), pero leyendo sólo los bloques del
+archivo que caen bajo el bbox. Un WarpedVRT con la rejilla de salida
+remuestrea (y reproyecta si el archivo no está en EPSG:4326) al vuelo.
+
+En GeoTIFF sin comprimir GDAL lee los bloques mediante memory mapping
+(GTIFF_VIRTUAL_MEM_IO); en COG comprimidos se descomprimen sólo los
+bloques de la ventana.
+
+Requiere rasterio (opcional: sin él las capas locales no están disponibles).
+"""
+import os
+
+import numpy as np
+from PIL import Image
+
+try:
+    import rasterio
+    from rasterio.enums import ColorInterp, Resampling
+    from rasterio.transform import from_bounds as transform_from_bounds
+    from rasterio.vrt import WarpedVRT
+    RASTERIO_AVAILABLE = True
+except ImportError:
+    RASTERIO_AVAILABLE = False
+
+# Opciones de GDAL para lectura local
+OPCIONES_GDAL = {
+    'GTIFF_VIRTUAL_MEM_IO': 'IF_ENOUGH_RAM',  # mmap en GeoTIFF sin comprimir
+    'GDAL_DISABLE_READDIR_ON_OPEN': 'EMPTY_DIR',
+}
+
+
+def resolver_ruta(ruta, directorio=None):
+    """Ruta absoluta de una capa local (relativa a `directorio` si no es absoluta)"""
+    if directorio and not os.path.isabs(ruta):
+        return os.path.join(directorio, ruta)
+    return ruta
+
+
+def leer_ventana(ruta, bbox, width, height):
+    """
+    Lee la ventana `bbox` (dict minx/miny/maxx/maxy en grados) de un raster
+    local remuestreada a width x height (vecino más próximo, como un WMS).
+
+    - Una banda con tabla de color -> imagen 'P' (nodata transparente)
+    - Una banda sin tabla -> 'L' (o 'RGBA' si hay zonas sin dato)
+    - Tres o cuatro bandas -> 'RGB' / 'RGBA' (nodata transparente)
+
+    Sólo admite bandas de 8 bits (uint8), como las imágenes de un WMS: otro
+    tipo de dato no se reescala y se rechaza con ValueError.
+    """
+    if not RASTERIO_AVAILABLE:
+        raise RuntimeError("rasterio no está instalado: las capas locales no están disponibles")
+
+    # La rejilla de salida es la del VRT: GDAL sólo lee (y reproyecta si
+    # hace falta) los bloques del archivo que la cubren
+    opciones = {
+        'crs': 'EPSG:4326',
+        'transform': transform_from_bounds(
+            bbox['minx'], bbox['miny'], bbox['maxx'], bbox['maxy'], width, height
+        ),
+        'width': width,
+        'height': height,
+        'resampling': Resampling.nearest,
+    }
+
+    with rasterio.Env(**OPCIONES_GDAL):
+        with rasterio.open(ruta) as src:
+            tipos = sorted({src.dtypes[b - 1] for b in _bandas_leidas(src.count)})
+            if tipos != ['uint8']:
+                raise ValueError(
+                    f"{ruta}: sólo se admiten rasters de 8 bits (uint8), no {', '.join(tipos)}"
+                )
+            interpretacion = list(src.colorinterp)
+            if src.nodata is None and ColorInterp.alpha not in interpretacion:
+                # Banda alfa para distinguir lo que queda fuera del archivo
+                opciones['add_alpha'] = True
+            with WarpedVRT(src, **opciones) as vrt:
+                return _a_imagen(vrt, src, interpretacion, width, height)
+
+
+def _bandas_leidas(count):
+    """Bandas que se leen: la primera (gris o paleta, con alfa si hay dos) o hasta RGBA"""
+    num_bandas = min(count, 4)
+    return [1] if num_bandas == 2 else list(range(1, num_bandas + 1))
+
+
+def _a_imagen(vrt, original, interpretacion, width, height):
+    bandas = _bandas_leidas(original.count)
+
+    datos = vrt.read(bandas)
+    # Píxeles fuera del archivo o sin dato
+    valido = vrt.dataset_mask() > 0
+
+    if len(bandas) == 1:
+        banda = datos[0]
+        paleta = None
+        if interpretacion and interpretacion[0] == ColorInterp.palette:
+            try:
+                paleta = original.colormap(1)
+            except ValueError:
+                paleta = None
+
+        if paleta is not None:
+            imagen = Image.fromarray(banda.astype(np.uint8), mode='P')
+            valores = []
+            for indice in range(256):
+                valores.extend(paleta.get(indice, (0, 0, 0, 255))[:3])
+            imagen.putpalette(valores)
+            if not valido.all():
+                # Índice transparente: nodata o uno libre de la paleta
+                libre = int(original.nodata) if original.nodata is not None else _indice_libre(banda)
+                if libre is not None:
+                    imagen = Image.fromarray(np.where(valido, banda, libre).astype(np.uint8), mode='P')
+                    imagen.putpalette(valores)
+                    imagen.info['transparency'] = libre
+            return imagen
+
+        banda = banda.astype(np.uint8)
+        if valido.all():
+            return Image.fromarray(banda, mode='L')
+        rgba = np.dstack([banda, banda, banda, np.where(valido, 255, 0).astype(np.uint8)])
+        return Image.fromarray(rgba, mode='RGBA')
+
+    rgb = np.moveaxis(datos[:3], 0, -1).astype(np.uint8)
+    alfa = datos[3].astype(np.uint8) if len(bandas) == 4 else np.full((height, width), 255, np.uint8)
+    alfa = np.where(valido, alfa, 0).astype(np.uint8)
+    if len(bandas) == 3 and valido.all():
+        return Image.fromarray(np.ascontiguousarray(rgb), mode='RGB')
+    return Image.fromarray(np.dstack([rgb, alfa]), mode='RGBA')
+
+
+def _indice_libre(banda):
+    """Primer índice de paleta que no aparece en la banda (None si están todos)"""
+    usados = np.bincount(banda.ravel().astype(np.int64), minlength=256)[:256]
+    libres = np.flatnonzero(usados == 0)
+    return int(libres[0]) if len(libres) else None
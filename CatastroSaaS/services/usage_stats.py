@@ -0,0 +1,148 @@
+"""
+Contadores de uso por usuario (tabla usage_stats, models.UsageStats).
+
+Las estadísticas del panel se leen de una sola fila por clave primaria en
+lugar de contar el historial de consultas. Los contadores se incrementan
+con un UPSERT en la misma transacción que los cambios que los originan:
+
+- Al crear una consulta: total, consultas del mes y, si reutiliza un
+  resultado, los PDF y datos climáticos que entrega.
+- Al completar un trabajo: los resultados de las consultas unidas a él
+  que aún no lo tenían.
+
+Las sentencias sirven tanto para sesiones síncronas (worker.py) como
+asíncronas (routers).
+"""
+from datetime import datetime, timezone
+
+from sqlalchemy import case, exists, func, insert, literal, select, update
+from sqlalchemy.dialects.postgresql import insert as insert_postgresql
+from sqlalchemy.dialects.sqlite import insert as insert_sqlite
+from sqlalchemy.exc import IntegrityError
+
+from database import engine
+import models
+
+_INSERT_UPSERT = {
+    "postgresql": insert_postgresql,
+    "sqlite": insert_sqlite,
+}
+
+
+def mes_actual(instante=None):
+    return (instante or datetime.now(timezone.utc)).strftime("%Y-%m")
+
+
+def incremento(user_id, consultas=0, pdfs=0, datos_climaticos=0):
+    """
+    UPSERT que suma los contadores de un usuario (crea la fila si no
+    existe). Las consultas del mes vuelven a empezar al cambiar de mes.
+    """
+    Stats = models.UsageStats
+    instante = datetime.now(timezone.utc)
+    mes = mes_actual(instante)
+
+    valores = {
+        "user_id": user_id,
+        "total_queries": consultas,
+        "month": mes if consultas else None,
+        "month_queries": consultas,
+        "pdfs_generated": pdfs,
+        "climate_datasets": datos_climaticos,
+        "last_query_at": instante if consultas else None,
+    }
+    cambios = {
+        "total_queries": Stats.total_queries + consultas,
+        "pdfs_generated": Stats.pdfs_generated + pdfs,
+        "climate_datasets": Stats.climate_datasets + datos_climaticos,
+        "updated_at": instante,
+    }
+    if consultas:
+        cambios.update({
+            "month": mes,
+            "month_queries": case(
+                (Stats.month == mes, Stats.month_queries + consultas),
+                else_=consultas
+            ),
+            "last_query_at": instante,
+        })
+
+    sentencia = _INSERT_UPSERT[engine.dialect.name](Stats).values(**valores)
+    return sentencia.on_conflict_do_update(index_elements=[Stats.user_id], set_=cambios)
+
+
+def aplicar_resultado(db, condicion, resultado):
+    """
+    Vuelca el resultado de un trabajo en las consultas que cumplen
+    `condicion` y aún no tienen ninguno, y suma a cada usuario los PDF y
+    datos climáticos entregados. Cada consulta cuenta una sola vez aunque
+    el worker y la API apliquen el mismo resultado a la vez. Sesión síncrona.
+    """
+    Query = models.Query
+    has_pdf = bool(resultado.get("has_pdf", False))
+    has_climate_data = bool(resultado.get("has_climate_data", False))
+    if not (has_pdf or has_climate_data):
+        return
+
+    usuarios = db.execute(
+        update(Query)
+        .where(condicion, Query.has_pdf.is_(False), Query.has_climate_data.is_(False))
+        .values(has_pdf=has_pdf, has_climate_data=has_climate_data)
+        .returning(Query.user_id)
+        .execution_options(synchronize_session=False)
+    ).scalars().all()
+
+    por_usuario = {}
+    for user_id in usuarios:
+        if user_id is not None:
+            por_usuario[user_id] = por_usuario.get(user_id, 0) + 1
+    for user_id, n in por_usuario.items():
+        db.execute(incremento(
+            user_id, pdfs=n if has_pdf else 0, datos_climaticos=n if has_climate_data else 0
+        ))
+
+
+def inicializar():
+    """
+    Crea los contadores a partir del historial la primera vez (tabla
+    vacía). Después se mantienen de forma incremental. Se llama al arrancar.
+    """
+    Stats = models.UsageStats
+    Query = models.Query
+    instante = datetime.now(timezone.utc)
+    inicio_mes = instante.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+    try:
+        with engine.begin() as conn:
+            if conn.execute(select(Stats.user_id).limit(1)).first() is not None:
+                return
+
+            agregados = (
+                select(
+                    Query.user_id,
+                    func.count(),
+                    literal(mes_actual(instante)),
+                    func.sum(case((Query.created_at >= inicio_mes, 1), else_=0)),
+                    func.sum(case((Query.has_pdf.is_(True), 1), else_=0)),
+                    func.sum(case((Query.has_climate_data.is_(True), 1), else_=0)),
+                    func.max(Query.created_at),
+                )
+                .where(
+                    Query.user_id.isnot(None),
+                    ~exists().where(Stats.user_id == Query.user_id),
+                )
+                .group_by(Query.user_id)
+            )
+            resultado = conn.execute(
+                insert(Stats).from_select(
+                    ["user_id", "total_queries", "month", "month_queries",
+                     "pdfs_generated", "climate_datasets", "last_query_at"],
+                    agregados
+                )
+            )
+    except IntegrityError:
+        # Otro proceso (API o worker) los ha creado a la vez
+        return
+
+    if resultado.rowcount and resultado.rowcount > 0:
+        print(f"✓ Contadores de uso creados para {resultado.rowcount} usuarios")
@@ -0,0 +1,431 @@
+"""
+Lectura incremental de geometrías vectoriales (KML y GeoJSON).
+
+Los parsers recorren el documento de forma incremental y devuelven una
+feature cada vez, con las coordenadas como arrays NumPy (N, 2) de
+(lon, lat). Los límites de vértices y features se comprueban mientras se
+lee, de modo que un fichero desmesurado se rechaza sin cargarlo entero.
+Aceptan una ruta o cualquier objeto tipo fichero binario (p. ej. el
+stream de un UploadFile).
+"""
+import codecs
+import json
+import re
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+# Límites por defecto para una subida
+MAX_VERTICES = 500_000
+MAX_FEATURES = 5_000
+MAX_BYTES_FEATURE = 32 * 1024 * 1024
+
+TAM_BLOQUE = 64 * 1024
+
+# Caracteres que delimitan objetos, arrays y cadenas JSON (y los que
+# cierran una cadena)
+_RE_ESTRUCTURA = re.compile(r'["{}\[\]]')
+_RE_CADENA = re.compile(r'["\\]')
+
+
+class CopiaLectura:
+    """
+    Envoltorio de un stream binario que copia a `destino` todo lo leído.
+    Permite parsear la subida y guardarla en disco en una sola pasada.
+    """
+
+    def __init__(self, stream, destino):
+        self.stream = stream
+        self.destino = destino
+
+    def read(self, size=-1):
+        datos = self.stream.read(size)
+        if datos:
+            self.destino.write(datos)
+        return datos
+
+    def vaciar(self):
+        """Copia lo que quede sin leer en el stream"""
+        while self.read(TAM_BLOQUE):
+            pass
+
+
+class _Contador:
+    """Aplica los límites de vértices y features durante la lectura"""
+
+    def __init__(self, max_vertices, max_features):
+        self.max_vertices = max_vertices
+        self.max_features = max_features
+        self.vertices = 0
+        self.features = 0
+
+    def sumar_vertices(self, n):
+        self.vertices += n
+        if self.vertices > self.max_vertices:
+            raise ValueError(f"El archivo supera el límite de {self.max_vertices:,} vértices")
+
+    def sumar_feature(self):
+        self.features += 1
+        if self.features > self.max_features:
+            raise ValueError(f"El archivo supera el límite de {self.max_features:,} geometrías")
+
+
+def _nombre_local(tag):
+    """'{ns}Placemark' -> 'Placemark'"""
+    return tag.rsplit('}', 1)[-1]
+
+
+def _parsear_coordenadas_kml(texto):
+    """Convierte 'lon,lat[,alt] lon,lat[,alt] ...' en un array (N, 2)"""
+    valores = []
+    for tupla in texto.split():
+        partes = tupla.split(',')
+        if len(partes) >= 2:
+            valores.append((float(partes[0]), float(partes[1])))
+    return np.array(valores, dtype=np.float64).reshape(-1, 2)
+
+
+def _eventos_kml(fuente, max_bytes_feature):
+    """
+    Eventos (evento, elem) de un XMLPullParser alimentado en bloques de
+    TAM_BLOQUE. El texto de un <coordinates> abierto se cuenta bloque a
+    bloque: pasado max_bytes_feature se rechaza antes de que el parser
+    lo acumule entero.
+    """
+    if isinstance(fuente, (str, bytes)) or hasattr(fuente, '__fspath__'):
+        with open(fuente, 'rb') as f:
+            yield from _eventos_kml(f, max_bytes_feature)
+        return
+
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    abierto = False
+    bytes_coordenadas = 0
+
+    while True:
+        bloque = fuente.read(TAM_BLOQUE)
+        if not bloque:
+            parser.close()
+            yield from parser.read_events()
+            return
+
+        parser.feed(bloque)
+        if abierto:
+            bytes_coordenadas += len(bloque)
+
+        eventos = list(parser.read_events())
+        for evento, elem in eventos:
+            if _nombre_local(elem.tag) == 'coordinates':
+                abierto = evento == 'start'
+                bytes_coordenadas = 0
+
+        if abierto and bytes_coordenadas > max_bytes_feature:
+            raise ValueError("Geometría demasiado grande en el KML")
+        yield from eventos
+
+
+def iterar_kml(fuente, max_vertices=MAX_VERTICES, max_features=MAX_FEATURES,
+               max_bytes_feature=MAX_BYTES_FEATURE):
+    """
+    Recorre un KML de forma incremental y devuelve un dict por polígono:
+    {'nombre': str, 'anillos': [exterior, interior1, ...]}.
+
+    Los elementos ya procesados se liberan a medida que se cierran los
+    Placemark, así que la memoria no crece con el tamaño del documento.
+    Un <coordinates> de más de max_bytes_feature bytes se rechaza mientras
+    se lee.
+    """
+    contador = _Contador(max_vertices, max_features)
+    pila = []
+    raiz = None
+    nombre = None
+    num_placemark = 0
+    anillos = []
+
+    try:
+        for evento, elem in _eventos_kml(fuente, max_bytes_feature):
+            etiqueta = _nombre_local(elem.tag)
+
+            if evento == 'start':
+                if raiz is None:
+                    raiz = elem
+                pila.append(etiqueta)
+                if etiqueta == 'Placemark':
+                    num_placemark += 1
+                    nombre = None
+                elif etiqueta == 'Polygon':
+                    anillos = []
+                continue
+
+            pila.pop()
+
+            if etiqueta == 'name' and pila and pila[-1] == 'Placemark':
+                nombre = (elem.text or '').strip() or None
+
+            elif etiqueta == 'coordinates' and 'Polygon' in pila:
+                coords = _parsear_coordenadas_kml(elem.text or '')
+                contador.sumar_vertices(len(coords))
+                if len(coords) >= 3:
+                    if 'innerBoundaryIs' in pila:
+                        anillos.append(coords)
+                    else:
+                        anillos.insert(0, coords)
+                elem.clear()
+
+            elif etiqueta == 'Polygon':
+                if anillos:
+                    contador.sumar_feature()
+                    yield {
+                        'nombre': nombre or f"poligono_{num_placemark}",
+                        'anillos': anillos
+                    }
+                anillos = []
+
+            elif etiqueta == 'Placemark':
+                # Liberar el Placemark ya procesado
+                elem.clear()
+                if raiz is not None:
+                    raiz.clear()
+    except ET.ParseError as e:
+        raise ValueError(f"KML no válido: {e}")
+
+
+class _LectorJSON:
+    """Buffer de texto sobre un stream binario para decodificar JSON por partes"""
+
+    def __init__(self, stream, max_bytes):
+        self.stream = stream
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.json = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.fin = False
+        self.max_bytes = max_bytes
+
+    def _leer_mas(self):
+        if self.fin:
+            return False
+        datos = self.stream.read(TAM_BLOQUE)
+        if not datos:
+            self.fin = True
+            self.buffer += self.decoder.decode(b'', final=True)
+            return False
+        # Descartar lo ya consumido antes de ampliar el buffer
+        self.buffer = self.buffer[self.pos:] + self.decoder.decode(datos)
+        self.pos = 0
+        return True
+
+    def caracter(self):
+        """Siguiente carácter no blanco (sin consumirlo)"""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._leer_mas():
+                raise ValueError("GeoJSON incompleto")
+
+    def consumir(self, esperado):
+        if self.caracter() != esperado:
+            raise ValueError(f"GeoJSON no válido: se esperaba '{esperado}'")
+        self.pos += 1
+
+    def _fin_compuesto(self):
+        """
+        Recorre un objeto, array o cadena desde donde lo dejó la llamada
+        anterior (profundidad, cadenas y escapes) y devuelve la posición
+        en la que termina, o None si aún no está entero en el buffer.
+        Cada carácter se examina una sola vez aunque el valor llegue en
+        muchos bloques.
+        """
+        buffer = self.buffer
+        i = self.pos + self._escaneo
+        while True:
+            if self._en_cadena:
+                m = _RE_CADENA.search(buffer, i)
+                if m is None:
+                    i = len(buffer)
+                    break
+                i = m.start()
+                if buffer[i] == '\\':
+                    # El carácter escapado puede estar en el bloque siguiente
+                    if i + 1 >= len(buffer):
+                        break
+                    i += 2
+                    continue
+                i += 1
+                self._en_cadena = False
+                if self._profundidad == 0:
+                    return i
+            else:
+                m = _RE_ESTRUCTURA.search(buffer, i)
+                if m is None:
+                    i = len(buffer)
+                    break
+                i = m.end()
+                c = m.group()
+                if c == '"':
+                    self._en_cadena = True
+                elif c in '{[':
+                    self._profundidad += 1
+                else:
+                    self._profundidad -= 1
+                    if self._profundidad <= 0:
+                        return i
+        self._escaneo = i - self.pos
+        return None
+
+    def valor(self):
+        """
+        Decodifica el siguiente valor JSON completo.
+        
+        Para objetos, arrays y cadenas se localiza primero el final del
+        valor leyendo bloques y se decodifica una sola vez: decodificar el
+        buffer entero tras cada bloque costaría un tiempo cuadrático en
+        el tamaño de la feature.
+        """
+        if self.caracter() in '{["':
+            self._escaneo = 0
+            self._profundidad = 0
+            self._en_cadena = False
+            while True:
+                fin = self._fin_compuesto()
+                if fin is not None:
+                    break
+                if len(self.buffer) - self.pos > self.max_bytes:
+                    raise ValueError("Geometría demasiado grande en el GeoJSON")
+                if not self._leer_mas():
+                    raise ValueError("GeoJSON incompleto")
+            try:
+                valor, fin = self.json.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                raise ValueError("GeoJSON no válido")
+            self.pos = fin
+            return valor
+
+        # Números y literales (cortos)
+        while True:
+            try:
+                valor, fin = self.json.raw_decode(self.buffer, self.pos)
+                # Un número al final del buffer puede estar cortado
+                if fin < len(self.buffer) or self.fin:
+                    self.pos = fin
+                    return valor
+            except json.JSONDecodeError:
+                if self.fin:
+                    raise ValueError("GeoJSON no válido")
+            if len(self.buffer) - self.pos > self.max_bytes:
+                raise ValueError("Geometría demasiado grande en el GeoJSON")
+            self._leer_mas()
+
+
+def _poligonos_geojson(geometria):
+    """Devuelve la lista de polígonos (lista de anillos) de una geometría"""
+    if not geometria:
+        return []
+    tipo = geometria.get('type')
+    if tipo == 'Polygon':
+        return [geometria.get('coordinates') or []]
+    if tipo == 'MultiPolygon':
+        return geometria.get('coordinates') or []
+    if tipo == 'GeometryCollection':
+        return [p for g in geometria.get('geometries', []) for p in _poligonos_geojson(g)]
+    return []
+
+
+def _features_de_objeto(objeto, indice, contador):
+    """Convierte una Feature (o geometría suelta) GeoJSON en dicts de polígono"""
+    if objeto.get('type') == 'Feature':
+        propiedades = objeto.get('properties') or {}
+        geometria = objeto.get('geometry')
+    else:
+        propiedades = {}
+        geometria = objeto
+
+    nombre = propiedades.get('name') or propiedades.get('nombre') or objeto.get('id')
+    poligonos = _poligonos_geojson(geometria)
+
+    for j, anillos_json in enumerate(poligonos, 1):
+        anillos = []
+        for anillo in anillos_json:
+            coords = np.array([p[:2] for p in anillo], dtype=np.float64).reshape(-1, 2)
+            contador.sumar_vertices(len(coords))
+            if len(coords) >= 3:
+                anillos.append(coords)
+        if not anillos:
+            continue
+        contador.sumar_feature()
+        base = str(nombre) if nombre is not None else f"poligono_{indice}"
+        yield {
+            'nombre': base if len(poligonos) == 1 else f"{base}_{j}",
+            'anillos': anillos
+        }
+
+
+def iterar_geojson(fuente, max_vertices=MAX_VERTICES, max_features=MAX_FEATURES,
+                   max_bytes_feature=MAX_BYTES_FEATURE):
+    """
+    Recorre un GeoJSON y devuelve un dict por polígono con el mismo formato
+    que iterar_kml. En una FeatureCollection el array 'features' se
+    decodifica elemento a elemento; el resto de claves se lee entero.
+    """
+    if isinstance(fuente, (str, bytes)) or hasattr(fuente, '__fspath__'):
+        with open(fuente, 'rb') as f:
+            yield from iterar_geojson(f, max_vertices, max_features, max_bytes_feature)
+        return
+
+    contador = _Contador(max_vertices, max_features)
+    lector = _LectorJSON(fuente, max_bytes_feature)
+    resto = {}
+    indice = 0
+
+    lector.consumir('{')
+    if lector.caracter() == '}':
+        return
+
+    while True:
+        clave = lector.valor()
+        lector.consumir(':')
+
+        if clave == 'features':
+            lector.consumir('[')
+            if lector.caracter() == ']':
+                lector.pos += 1
+            else:
+                while True:
+                    indice += 1
+                    feature = lector.valor()
+                    yield from _features_de_objeto(feature, indice, contador)
+                    separador = lector.caracter()
+                    lector.pos += 1
+                    if separador == ']':
+                        break
+                    if separador != ',':
+                        raise ValueError("GeoJSON no válido en 'features'")
+        else:
+            resto[clave] = lector.valor()
+
+        separador = lector.caracter()
+        lector.pos += 1
+        if separador == '}':
+            break
+        if separador != ',':
+            raise ValueError("GeoJSON no válido")
+
+    # Feature o geometría suelta en lugar de FeatureCollection
+    if indice == 0 and resto.get('type') not in (None, 'FeatureCollection'):
+        yield from _features_de_objeto(resto, 1, contador)
+
+
+def iterar_vectorial(fuente, formato='kml', **limites):
+    """Selecciona el parser según el formato ('kml' o 'geojson')"""
+    if formato in ('geojson', 'json'):
+        return iterar_geojson(fuente, **limites)
+    return iterar_kml(fuente, **limites)
+
+
+def formato_de_archivo(nombre):
+    """Deduce el formato a partir de la extensión del archivo"""
+    nombre = str(nombre).lower()
+    if nombre.endswith('.geojson') or nombre.endswith('.json'):
+        return 'geojson'
+    return 'kml'
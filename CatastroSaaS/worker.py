@@ -0,0 +1,189 @@
+"""
+Worker de la cola de trabajos - Sistema SaaS Catastro
+
+Proceso independiente de la API que consume la tabla `jobs`
+(services/job_queue.py). Se pueden lanzar tantos workers como se quiera,
+en la misma máquina o en otros contenedores; cada uno ejecuta hasta
+settings.WORKER_CONCURRENCY trabajos a la vez.
+
+Uso:
+    python worker.py [--concurrencia N] [--tipos catastro,...]
+"""
+import argparse
+import os
+import signal
+import socket
+import threading
+import traceback
+from pathlib import Path
+
+from config import settings
+from database import SessionLocal, asegurar_esquema
+import models
+from services import job_queue, job_events, usage_stats
+from services.catastro_engine import procesar_y_comprimir
+
+
+# ============================
+#   Tareas
+# ============================
+def procesar_consulta_catastro(job, progreso):
+    """
+    Procesa una referencia catastral. Devuelve el resumen que se guarda en
+    el trabajo y que reutilizan las consultas posteriores de la referencia.
+    """
+    payload = job.payload
+    ref = payload["referencia"]
+    output_dir = payload.get("output_dir", "static/downloads")
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+
+    print(f"🔄 Iniciando procesamiento para {ref}...")
+    zip_path, results = procesar_y_comprimir(ref, output_dir, progreso=progreso)
+    print(f"✅ Procesamiento finalizado para {ref}")
+
+    return {
+        "has_pdf": bool(results.get('informe_pdf', False)),
+        # Mapeamos 'capas_afecciones' a 'has_climate_data' como proxy temporal
+        "has_climate_data": bool(results.get('capas_afecciones', False)),
+        "zip_path": str(zip_path) if zip_path else None,
+    }
+
+
+def actualizar_consultas_catastro(db, job, resultado):
+    """Vuelca el resultado en todas las consultas unidas al trabajo (y en los contadores de uso)"""
+    usage_stats.aplicar_resultado(db, models.Query.job_id == job.id, resultado)
+
+
+# Tipo de trabajo -> función que lo ejecuta: recibe el trabajo y un emisor de
+# progreso (services/job_events.py) y devuelve su resultado
+TAREAS = {
+    "catastro": procesar_consulta_catastro,
+}
+
+# Tipo de trabajo -> actualización de la BD en la misma transacción que lo da por terminado
+AL_COMPLETAR = {
+    "catastro": actualizar_consultas_catastro,
+}
+
+
+# ============================
+#   Worker
+# ============================
+class Worker:
+    """
+    Reclama y ejecuta trabajos con `concurrencia` hilos. Un hilo de
+    latido renueva la visibilidad de los trabajos en curso para que no
+    los reclame otro worker mientras siguen vivos.
+    """
+
+    def __init__(self, concurrencia=None, tipos=None):
+        self.concurrencia = concurrencia or settings.WORKER_CONCURRENCY
+        self.tipos = list(tipos or TAREAS)
+        self.id = f"{socket.gethostname()}:{os.getpid()}"
+        self.visibilidad = settings.JOB_VISIBILITY_TIMEOUT
+        self._parar = threading.Event()
+        self._en_curso = set()
+        self._lock = threading.Lock()
+
+    def parar(self, *_):
+        print(f"⏹ Worker {self.id}: terminando los trabajos en curso...")
+        self._parar.set()
+
+    def ejecutar(self):
+        print(f"🚀 Worker {self.id}: {self.concurrencia} hilos, tipos {self.tipos}")
+        hilos = [threading.Thread(target=self._latido, daemon=True)]
+        hilos += [
+            threading.Thread(target=self._bucle, name=f"worker-{i}")
+            for i in range(self.concurrencia)
+        ]
+        for hilo in hilos:
+            hilo.start()
+        for hilo in hilos[1:]:
+            hilo.join()
+        print(f"👋 Worker {self.id} detenido")
+
+    def _bucle(self):
+        while not self._parar.is_set():
+            try:
+                if not self._siguiente():
+                    self._parar.wait(settings.WORKER_POLL_INTERVAL)
+            except Exception as e:
+                # Error de base de datos: esperar y volver a intentar
+                print(f"⚠ Worker {self.id}: {e}")
+                self._parar.wait(settings.WORKER_POLL_INTERVAL)
+
+    def _siguiente(self):
+        """Reclama y ejecuta un trabajo. False si la cola estaba vacía"""
+        # Sesión sólo para reclamar: no se mantiene durante la tarea
+        db = SessionLocal()
+        try:
+            job = job_queue.reclamar(db, self.id, self.visibilidad, self.tipos)
+        finally:
+            db.close()
+        if job is None:
+            return False
+
+        with self._lock:
+            self._en_curso.add(job.id)
+        print(f"▶ {job.job_type} {job.id} (intento {job.attempts}/{job.max_attempts})")
+        progreso = job_events.EmisorProgreso(settings.JOB_EVENTS_DIR, job.id, intento=job.attempts)
+        progreso("inicio", 0, "Procesamiento iniciado")
+        try:
+            resultado = TAREAS[job.job_type](job, progreso)
+        except Exception as e:
+            traceback.print_exc()
+            with SessionLocal() as db:
+                estado = job_queue.fallar(db, job, self.id, e, settings.JOB_RETRY_BACKOFF)
+            print(f"✗ {job.job_type} {job.id}: {e} -> {estado.value}")
+            if estado == models.JobStatus.FAILED:
+                progreso.terminar(job_events.ERROR, str(e))
+            else:
+                progreso("reintento", None, f"Error: {e}. Se reintentará")
+        else:
+            al_completar = AL_COMPLETAR.get(job.job_type)
+            with SessionLocal() as db:
+                job_queue.completar(
+                    db, job.id, self.id, resultado,
+                    (lambda sesion: al_completar(sesion, job, resultado)) if al_completar else None
+                )
+            progreso.terminar(job_events.COMPLETADO, "Procesamiento completado")
+            print(f"✓ {job.job_type} {job.id} completado")
+        finally:
+            with self._lock:
+                self._en_curso.discard(job.id)
+        return True
+
+    def _latido(self):
+        while not self._parar.wait(self.visibilidad / 3):
+            with self._lock:
+                en_curso = list(self._en_curso)
+            if not en_curso:
+                continue
+            db = SessionLocal()
+            try:
+                for job_id in en_curso:
+                    job_queue.renovar(db, job_id, self.id, self.visibilidad)
+            except Exception as e:
+                print(f"⚠ Worker {self.id}: no se pudo renovar la visibilidad: {e}")
+            finally:
+                db.close()
+
+
+# ============================
+#   Ejecución directa
+# ============================
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Worker de la cola de trabajos")
+    parser.add_argument("--concurrencia", type=int, default=None)
+    parser.add_argument("--tipos", default=None, help="Tipos de trabajo separados por comas")
+    args = parser.parse_args()
+
+    # Crear la tabla de trabajos si el worker arranca antes que la API
+    asegurar_esquema()
+    usage_stats.inicializar()
+    job_events.purgar(settings.JOB_EVENTS_DIR, settings.JOB_EVENTS_RETENTION_DAYS * 86400)
+
+    worker = Worker(args.concurrencia, args.tipos.split(",") if args.tipos else None)
+    signal.signal(signal.SIGTERM, worker.parar)
+    signal.signal(signal.SIGINT, worker.parar)
+    worker.ejecutar()